@@ -9,17 +9,24 @@ controller from the taskwatcher suite
 
 import logging as log
 import argparse
+import csv
 import json
 import sys
-import psutil
-from taskwatcher.database import Database
+import time
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from taskwatcher.database import Database, DURABILITY, HISTORY_COLUMNS, summarize_samples
+from taskwatcher.parse import Parse, ParseCache
+from taskwatcher.proctree import ProcTree
 
 class Control(object):
     """
     Controller from the taskwatcher suite
     Called with db
+    Optional : durability profile (see Database), cache_size (parsed feedback files kept)
     """
-    def __init__(self, db='', debug=False):
+    def __init__(self, db='', debug=False, durability=None, cache_size=256):
 
         # create logger
         log.basicConfig(
@@ -37,13 +44,14 @@ class Control(object):
             self.debug = False
             log.basicConfig(level='ERROR')
 
-        log.info("Constructor with db={} debug={}".format(db, debug))
+        log.info("Constructor with db={} debug={} durability={} cache_size={}".format(db, debug, durability, cache_size))
  
         # Public attributs
         self.db = db
+        self.cache = ParseCache(size=cache_size)
 
         # Private attributs
-        self._DB = Database(db=db, debug=debug)
+        self._DB = Database(db=db, debug=debug, durability=durability)
 
 
     def initialize(self):
@@ -55,12 +63,25 @@ class Control(object):
         self._DB.create()
 
 
+    def set_durability(self, durability=''):
+        """
+        Sets the durability profile of the database (fast|safe|paranoid)
+        The profile is stored in the database and used by all its clients
+        """
+        log.info("Enter with durability={}".format(durability))
+        print ("Setting database {} durability to {}".format(self.db, durability))
+        self._DB.set_durability(durability=durability)
+
+
     def update(self):
         """
         Update database timing information like tasks duration
+        Returns a json formatted summary of the update
+        (expired reservations, updated tasks, tasks in timeout)
         """
         log.info("Enter")
-        self._DB.update()
+        summary = self._DB.update()
+        return json.dumps(summary)
 
     def reserve(self, taskname="", unique=False):
         """
@@ -77,20 +98,111 @@ class Control(object):
             sys.exit("Could not reserve task, already exist and unique is set")
         return taskid
 
-    def get_tasks(self, reserved=True):
+    def get_tasks(self, reserved=True, where=None):
         """
         Returns a dictionary listing the current tasks
         By default, reserved tasks are returned, use reserved=Fasle otherwise
+        With where (dictionary), only tasks with these feedback key=value pairs
         """
-        log.info("Enter")
-        task = self._DB.get_tasks(reserved=reserved)
+        log.info("Enter with where={}".format(where))
+        task = self._DB.get_tasks(reserved=reserved, where=where)
         log.debug("task={}".format(task))
         return task
 
 
+    def get_feedback(self, taskid='all', workers=None, where=None):
+        """
+        Returns the feedback of a task as a json string, keyed by taskid
+        With taskid 'all', returns the feedback of every RUNNING task (with
+        the feedback key=value pairs of dictionary where if given).
+        Feedback files are parsed concurrently on a pool of 'workers' threads
+        Each task gives its key/values (None without feedback file), the file
+        size and the parse time in seconds. Unchanged files are served from
+        the parse cache (see cache_stats)
+        """
+        log.info("Enter with taskid={} workers={} where={}".format(taskid, workers, where))
+
+        if taskid == 'all':
+            tasks = self._DB.fetch_tasks(status='RUNNING', where=where)
+        else:
+            tasks = self._DB.fetch_tasks(taskid=taskid)
+            if not tasks:
+                log.error("unknown taskid={}".format(taskid))
+                sys.exit("unknown taskid={}".format(taskid))
+
+        result = {}
+        if tasks:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for (task, feedback) in zip(tasks, executor.map(self._parse_feedback, tasks)):
+                    result[task.id] = feedback
+
+        result_json = json.dumps(result)
+        log.debug("return result_json={}".format(result_json))
+        return result_json
+
+
+    def cache_stats(self):
+        """
+        Returns the feedback parse cache counters (hits, misses, evictions)
+        """
+        log.info("Enter")
+        return self.cache.stats()
+
+
+    def _parse_feedback(self, task):
+        """
+        Parses the feedback file of a task (from its end, stops on a clear all)
+        Returns a dictionary with feedback, size and parse_time
+        """
+        result = { 'feedback' : None, 'size' : 0, 'parse_time' : 0.0 }
+        if not task.feedfile or not os.path.isfile(task.feedfile):
+            log.debug("taskid={} has no feedback file".format(task.id))
+            return result
+
+        start = time.perf_counter()
+        parser = Parse(cache=self.cache)
+        parser.load_file_reverse(file=task.feedfile)
+        result['parse_time'] = round(time.perf_counter() - start, 6)
+        result['feedback'] = parser.dict
+        result['size'] = os.path.getsize(task.feedfile)
+        return result
+
+
+    def get_stats(self, taskid=None):
+        """
+        Returns the resource usage of a task as a json string, from its
+        samples (launch.py --sample-interval) while it runs, from the summary
+        archived in its latest history entry once ended (see summarize_samples) :
+        cpu (% of one cpu), rss (KB) and threads peak and average (weighted
+        by the sample intervals), io_read and io_write total bytes and peak
+        rate (bytes/sec)
+        """
+        log.info("Enter with taskid={}".format(taskid))
+
+        if self._DB.fetch_tasks(taskid=taskid):
+            result = { 'taskid' : int(taskid), 'running' : True }
+            result.update(summarize_samples(self._DB.fetch_task_samples(taskid=taskid)))
+        else:
+            history = self._DB.fetch_history(taskid=taskid, newest_first=True, limit=1, with_feedback=True)
+            if not history:
+                log.error("unknown taskid={}".format(taskid))
+                sys.exit("unknown taskid={}".format(taskid))
+            result = { 'taskid' : int(taskid), 'running' : False, 'historyid' : history[0].id }
+            snapshot = history[0].feedback
+            if isinstance(snapshot, dict) and snapshot.get('stats'):
+                result.update(snapshot['stats'])
+            else:
+                result.update(summarize_samples([]))
+
+        result_json = json.dumps(result)
+        log.debug("return result_json={}".format(result_json))
+        return result_json
+
+
     def kill_task(self, taskid=None):
         """
-        Kills a task from its taskid
+        Kills a task from its taskid, with all its processes (process group
+        and descendants, see ProcTree)
         """
         log.info("Enter with taskid={}".format(taskid))
         if not taskid:
@@ -98,20 +210,17 @@ class Control(object):
             sys.exit("taskid is required")
 
         # make sure task is still active
-        tasks = json.loads(self.get_tasks())
-        if str(taskid) in tasks:
-            if tasks[taskid]['status'] == "RESERVED":
+        tasks = self._DB.fetch_tasks(taskid=taskid)
+        if tasks:
+            task = tasks[0]
+            if task.status == "RESERVED":
                 log.warning("task is in status reserved, not running, won't kill")
                 sys.exit("task is in status reserved, not running, won't kill")
                 
-            pid = tasks[taskid]['pid']
-            status = tasks[taskid]['status']
+            pid = task.pid
+            status = task.status
             log.debug("Task is still active killing pid={} status={}".format(pid,status))
-            p = psutil.Process(pid)
-            if p.username != 'SYSTEM':
-                p.kill()
-            else:
-                log.warning("This is a system process, won't kill")
+            ProcTree(debug=self.debug).kill(pid, signal.SIGKILL)
 
         else:
             log.warning("unknown taskid={} won't kill".format(taskid))
@@ -120,7 +229,8 @@ class Control(object):
 
     def killall_tasks(self, taskname=None):
         """
-        Kills all tasks with the given name
+        Kills all tasks with the given name, with all their processes
+        (a single /proc scan for all the tasks)
         """
         log.info("Enter with taskname={}".format(taskname))
 
@@ -134,24 +244,22 @@ class Control(object):
             sys.exit("Taskname cannot be empty string")
 
         # Go through task list, check name, make sure this is not a task in
-        # status RESERVED and kill if not a system task 
-        tasks = json.loads(self.get_tasks())
-        for taskid in tasks:
-            name = tasks[taskid]['name']
-            pid = tasks[taskid]['pid']
-            status = tasks[taskid]['status']
+        # status RESERVED and kill
+        tree = ProcTree(debug=self.debug)
+        for task in self._DB.fetch_tasks():
+            taskid = task.id
+            name = task.name
+            pid = task.pid
+            status = task.status
 
             if name == taskname:
                 log.debug("Found taskid={} pid={} status={}".format(taskid, pid, status))
                 if status == "RESERVED":
                     log.info("task is in status reserved, not running, won't kill")
+                    continue
 
-                p = psutil.Process(pid)
-                if p.username != 'SYSTEM':
-                    log.info("killing taskid={} name={} pid={} status={}".format(taskid,name,pid,status))
-                    p.kill()
-                else:
-                    log.warning("This is a system process, won't kill")
+                log.info("killing taskid={} name={} pid={} status={}".format(taskid,name,pid,status))
+                tree.kill(pid, signal.SIGKILL)
 
 
     def get_number_of_tasks(self):
@@ -164,12 +272,13 @@ class Control(object):
         return nb_task
 
 
-    def print_tasks(self):
+    def print_tasks(self, where=None):
         """
         Prints a human formatted listing of the current tasks
+        With where (dictionary), only tasks with these feedback key=value pairs
         """
-        log.info("Enter")
-        tasklist = json.loads(self.get_tasks())
+        log.info("Enter with where={}".format(where))
+        tasklist = self._DB.fetch_tasks(where=where)
 
 
         line = 1 ;
@@ -179,19 +288,19 @@ class Control(object):
                 print("| task id  |      task name       |     info1    |     info2    |     info3    |   pid  |   status   | feedback | reserve time | starting time | duration | last update  | timeout  |")
                 print("-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------")
                 print("| {:>8} | {:20} | {:12} | {:12} | {:12} | {:>6} | {:>10} | {:>8} | {:>12} | {:>13} | {:>8} | {:>12} | {:>8} |".
-                  format(task, 
-                         str(tasklist[task]['name']),
-                         str(tasklist[task]['info1']),
-                         str(tasklist[task]['info2']),
-                         str(tasklist[task]['info3']),
-                         str(tasklist[task]['pid']),
-                         str(tasklist[task]['status']),
-                         str(tasklist[task]['feedback']),
-                         str(tasklist[task]['reservetime']),
-                         str(tasklist[task]['starttime']),
-                         str(tasklist[task]['duration']),
-                         str(tasklist[task]['lastupdate']),
-                         str(tasklist[task]['timeout']),
+                  format(task.id, 
+                         str(task.name),
+                         str(task.info1),
+                         str(task.info2),
+                         str(task.info3),
+                         str(task.pid),
+                         str(task.status),
+                         str(task.feedback),
+                         str(task.reservetime),
+                         str(task.starttime),
+                         str(task.duration),
+                         str(task.lastupdate),
+                         str(task.timeout),
                         ))
             line = line+1
         if line > 1:
@@ -201,46 +310,168 @@ class Control(object):
             print("No tasks.")
 
 
-    def get_history(self):
+    def get_history(self, **filters):
         """
         Returns history list in json format
+        Optional filters (see Database.fetch_history) : limit, after_id,
+        taskname, since, until, status, newest_first, where, with_feedback
         """
-        log.info("Enter")
-        history = self._DB.get_history()
+        log.info("Enter with filters={}".format(filters))
+        history = self._DB.get_history(**filters)
         log.debug("history={}".format(history))
         return history
 
 
-    def print_history(self):
+    def export_history(self, format='ndjson', out='-', **filters):
+        """
+        Streams history to file 'out' ('-' for stdout) in format ndjson (one
+        json object per line) or csv (with header line)
+        Rows are read by batch and written as they come, memory does not
+        grow with the history size.
+        Accepts the filters of get_history
+        Returns a tuple (number of rows, elapsed seconds)
+        """
+        log.info("Enter with format={} out={} filters={}".format(format, out, filters))
+
+        if format not in ('ndjson', 'csv'):
+            log.error("unknown export format={}".format(format))
+            sys.exit("unknown export format {}".format(format))
+
+        start = time.perf_counter()
+        rows = 0
+        if out == '-':
+            F = sys.stdout
+        else:
+            F = open(out, 'w', newline='', encoding='utf-8')
+
+        try:
+            if format == 'csv':
+                writer = csv.writer(F)
+                writer.writerow(('id',) + HISTORY_COLUMNS)
+                for entry in self._DB.iter_history(**filters):
+                    if isinstance(entry.feedback, dict):
+                        entry = entry._replace(feedback=json.dumps(entry.feedback))
+                    writer.writerow(entry)
+                    rows = rows + 1
+            else:
+                for entry in self._DB.iter_history(**filters):
+                    F.write(json.dumps(entry._asdict()))
+                    F.write("\n")
+                    rows = rows + 1
+
+        finally:
+            if F is not sys.stdout:
+                F.close()
+            else:
+                F.flush()
+
+        elapsed = time.perf_counter() - start
+        log.debug("exported rows={} elapsed={}".format(rows, elapsed))
+        return (rows, elapsed)
+
+
+    def purge_history(self, keep_rows=None, keep_days=None, keep_per_name=None, batch=500, archive=None):
+        """
+        Applies history retention policies, see Database.purge_history
+        Purged entries are optionally moved to the archive db file
+        Returns the number of purged entries
+        """
+        log.info("Enter with keep_rows={} keep_days={} keep_per_name={} batch={} archive={}".
+                 format(keep_rows, keep_days, keep_per_name, batch, archive))
+        purged = self._DB.purge_history(keep_rows=keep_rows, keep_days=keep_days, keep_per_name=keep_per_name,
+                                        batch=batch, archive=archive)
+        return purged
+
+
+    def clear_history(self, archive=None):
+        """
+        Deletes all history entries (optionally moved to the archive db file)
+        Returns the number of deleted entries
+        """
+        log.info("Enter with archive={}".format(archive))
+        return self.purge_history(keep_rows=0, archive=archive)
+
+
+    def print_history(self, **filters):
         """
         Print a human formatted listing of history
+        Accepts the filters of get_history
         """
-        log.info("Enter")
-        historylist =  json.loads(self.get_history())
+        log.info("Enter with filters={}".format(filters))
+        historylist = self._DB.fetch_history(**filters)
 
         print("------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------")
         print("|    id    | task id  |      task name       |     info1    |     info2    |     info3    |termsignal | termerror | starting time | ending time | duration |      feedback         |") 
         print("------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------")
 
-        for task in historylist:
+        for entry in historylist:
             print("| {:>8} | {:>8} | {:20} | {:12} | {:12} | {:12} |{:>10} | {:>9} | {:>13} | {:>11} | {:>8} | {:>21} |".format(
-                task,
-                str(historylist[task]['taskid']),
-                str(historylist[task]['taskname']),
-                str(historylist[task]['info1']),
-                str(historylist[task]['info2']),
-                str(historylist[task]['info3']),
-                str(historylist[task]['termsignal']),
-                str(historylist[task]['termerror']),
-                str(historylist[task]['starttime']),
-                str(historylist[task]['endtime']),
-                str(historylist[task]['duration']),
-                str(historylist[task]['feedback'])
+                entry.id,
+                str(entry.taskid),
+                str(entry.taskname),
+                str(entry.info1),
+                str(entry.info2),
+                str(entry.info3),
+                str(entry.termsignal),
+                str(entry.termerror),
+                str(entry.starttime),
+                str(entry.endtime),
+                str(entry.duration),
+                self._feedback_summary(entry.feedback)
             ))
 
         print("------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------")
 
 
+    def _feedback_summary(self, feedback):
+        """
+        Returns the printable form of a history feedback snapshot
+        (its final key/values)
+        """
+        if isinstance(feedback, dict):
+            return json.dumps(feedback['feedback'])
+        if feedback is None:
+            return ''
+        return str(feedback)
+
+
+def parse_time(value=None):
+    """
+    Returns a unix time from a command line value : either a unix time or an
+    age with a unit s|m|h|d (ex: 30m is 30 minutes ago). None if no value
+    """
+    if value is None:
+        return None
+
+    units = { 's' : 1, 'm' : 60, 'h' : 3600, 'd' : 86400 }
+    try:
+        if value[-1:] in units:
+            return int(time.time()) - int(value[:-1]) * units[value[-1]]
+        return int(value)
+
+    except ValueError:
+        log.error("invalid time value={}".format(value))
+        sys.exit("invalid time value {}".format(value))
+
+
+def parse_where(values=None):
+    """
+    Returns a dictionary from command line key=value strings (list)
+    None if no value
+    """
+    if not values:
+        return None
+
+    where = {}
+    for value in values:
+        (key, sep, data) = value.partition('=')
+        if not sep or not key:
+            log.error("invalid key=value={}".format(value))
+            sys.exit("invalid key=value {}".format(value))
+        where[key] = data
+    return where
+
+
 if __name__ == '__main__': #pragma: no cover
 
     parser = argparse.ArgumentParser(description='Task controller')
@@ -259,7 +490,10 @@ if __name__ == '__main__': #pragma: no cover
     parser_task.add_argument('--info1', help="any information")
     parser_task.add_argument('--info2', help="any information")
     parser_task.add_argument('--info3', help="any information")
-    parser_task.add_argument('--feedback', metavar='taskid', help="returns feedback")
+    parser_task.add_argument('--feedback', metavar='taskid', help="returns feedback of a task, or of all running tasks with 'all'")
+    parser_task.add_argument('--workers', metavar='N', type=int, help="feedback: number of parsing threads")
+    parser_task.add_argument('--where', metavar='key=value', action='append', help="list/feedback all: tasks with this feedback value (repeatable)")
+    parser_task.add_argument('--stats', metavar='taskid', help="resource usage peak/avg of a task sampled by launch.py --sample-interval (running, or its last archived run)")
     parser_task.add_argument('--kill', metavar='taskid', help="kill task from its taskid")
     parser_task.add_argument('--killall', metavar='taskname', help="kill all tasks by name")
     parser_task.add_argument('--json', help="json output", action="store_true")
@@ -271,17 +505,38 @@ if __name__ == '__main__': #pragma: no cover
     parser_history.add_argument('--list', help="display all completed tasks", action="store_true")
     parser_history.add_argument('--human', help="human readable output", action="store_true")
     parser_history.add_argument('--clear', help="clear history", action="store_true")
+    parser_history.add_argument('--purge', help="purge history with retention policies --keep-*", action="store_true")
+    parser_history.add_argument('--keep-rows', metavar='N', type=int, help="purge: keep the last N entries")
+    parser_history.add_argument('--keep-days', metavar='N', type=float, help="purge: keep entries ended in the last N days")
+    parser_history.add_argument('--keep-per-name', metavar='N', type=int, help="purge: keep the last N entries of each task name")
+    parser_history.add_argument('--batch', metavar='N', type=int, help="purge: entries deleted per transaction (default 500)", default=500)
+    parser_history.add_argument('--archive', metavar='file', help="purge/clear: move purged entries to this compressed archive db")
+    parser_history.add_argument('--export', help="streams history to --out file", choices=['ndjson', 'csv'])
+    parser_history.add_argument('--out', metavar='file', help="export file (default stdout)", default='-')
+    parser_history.add_argument('--limit', metavar='N', type=int, help="at most N entries")
+    parser_history.add_argument('--after', metavar='id', type=int, help="entries after this id (next page)")
+    parser_history.add_argument('--newest', help="newest entries first (latest page with --limit)", action="store_true")
+    parser_history.add_argument('--name', metavar='taskname', help="entries with this task name")
+    parser_history.add_argument('--since', metavar='time', help="entries ended since unix time or age (ex: 1588874292, 30m, 2h, 7d)")
+    parser_history.add_argument('--until', metavar='time', help="entries ended before unix time or age")
+    parser_history.add_argument('--status', metavar='status', help="entries with this termination status")
+    parser_history.add_argument('--where', metavar='key=value', action='append', help="entries with this final feedback value (repeatable)")
+    parser_history.add_argument('--feedback', help="list/export: includes the final feedback (decompressed)", action="store_true")
 
     # database
     parser_db =  subparsers.add_parser('database', help='database maintenance')
     parser_db.set_defaults(func='database')
     parser_db.add_argument('--initialize', help="creates or recreates a task database (all info are lost)", action="store_true")
     parser_db.add_argument('--update', help="updates database timing information (taks durations)",  action="store_true")
+    parser_db.add_argument('--durability', help="sets database durability profile (default safe)", choices=sorted(DURABILITY))
 
 
     args = parser.parse_args()
     #print("args={}".format(args))
-    controller=Control(db=args.db,debug=args.debug)
+    durability = None
+    if args.func == 'database' and args.initialize:
+        durability = args.durability
+    controller=Control(db=args.db,debug=args.debug,durability=durability)
 
 
 
@@ -290,9 +545,9 @@ if __name__ == '__main__': #pragma: no cover
 
         if args.list:
             if args.json:
-            	print(controller.get_tasks())
+            	print(controller.get_tasks(where=parse_where(args.where)))
             else:
-            	controller.print_tasks()
+            	controller.print_tasks(where=parse_where(args.where))
 
         elif args.reserve:
             taskname = args.taskname
@@ -301,6 +556,12 @@ if __name__ == '__main__': #pragma: no cover
             taskid = controller.reserve(taskname=taskname, unique=args.unique)
             print("Taskid {} has been reserved".format(taskid))
 
+        elif args.feedback:
+            print(controller.get_feedback(taskid=args.feedback, workers=args.workers, where=parse_where(args.where)))
+
+        elif args.stats:
+            print(controller.get_stats(taskid=args.stats))
+
         elif args.kill:
             controller.kill_task(taskid=args.kill)
 
@@ -311,18 +572,40 @@ if __name__ == '__main__': #pragma: no cover
     elif args.func == 'database':
         if args.initialize:
             controller.initialize()
-            
+
+        elif args.durability:
+            controller.set_durability(durability=args.durability)
+
         if args.update:
-            controller.update()
+            print(controller.update())
 
     # history
     elif args.func == 'history':
-        if args.list:
+        filters = { 'limit' : args.limit, 'after_id' : args.after, 'taskname' : args.name,
+                    'since' : parse_time(args.since), 'until' : parse_time(args.until),
+                    'status' : args.status, 'newest_first' : args.newest, 'where' : parse_where(args.where),
+                    'with_feedback' : args.feedback }
+        if args.clear:
+            purged = controller.clear_history(archive=args.archive)
+            print("Cleared {} history entries".format(purged))
+
+        elif args.purge:
+            if args.keep_rows is None and args.keep_days is None and args.keep_per_name is None:
+                sys.exit("--purge requires a retention policy : --keep-rows, --keep-days or --keep-per-name")
+            purged = controller.purge_history(keep_rows=args.keep_rows, keep_days=args.keep_days,
+                                              keep_per_name=args.keep_per_name, batch=args.batch,
+                                              archive=args.archive)
+            print("Purged {} history entries".format(purged))
+
+        elif args.export:
+            (rows, elapsed) = controller.export_history(format=args.export, out=args.out, **filters)
+            rate = rows / elapsed if elapsed else 0
+            print("Exported {} rows in {:.3f}s ({:.0f} rows/sec)".format(rows, elapsed, rate), file=sys.stderr)
+
+        elif args.list:
             if args.human:
-                controller.print_history()
+                controller.print_history(**filters)
             else:
-                print(controller.get_history())
-
-            controller._DB.get_history()
+                print(controller.get_history(**filters))
         
 
@@ -12,13 +12,191 @@ import os
 import sqlite3
 import json
 import time
+import zlib
+from collections import namedtuple
+
+# Durability profiles, selected with Database(durability=) and stored in the
+# database config table so every process opening the database applies it :
+# - journal_mode       : WAL lets readers run while launchers are writing
+# - synchronous        : OFF no flush, NORMAL flush on checkpoint only, FULL flush on each commit
+# - busy_timeout       : ms to wait for a lock held by another process
+# - wal_autocheckpoint : WAL size (pages) triggering a checkpoint on commit
+# - checkpoint         : checkpoint mode run when the connection is closed (None: no checkpoint)
+DURABILITY = {
+    'fast'     : { 'journal_mode' : 'WAL', 'synchronous' : 'OFF', 'busy_timeout' : 5000,
+                   'wal_autocheckpoint' : 10000, 'checkpoint' : None },
+    'safe'     : { 'journal_mode' : 'WAL', 'synchronous' : 'NORMAL', 'busy_timeout' : 10000,
+                   'wal_autocheckpoint' : 1000, 'checkpoint' : 'PASSIVE' },
+    'paranoid' : { 'journal_mode' : 'WAL', 'synchronous' : 'FULL', 'busy_timeout' : 30000,
+                   'wal_autocheckpoint' : 1000, 'checkpoint' : 'TRUNCATE' },
+}
+DEFAULT_DURABILITY = 'safe'
+
+# Schema version, kept in sqlite user_version
+# MIGRATIONS lists (version, statements) applied in order on a database with an
+# older user_version (see _upgrade). A new database gets all of them.
+SCHEMA_VERSION = 5
+MIGRATIONS = [
+    (1, ['''CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)''']),
+    (2, ['''CREATE INDEX IF NOT EXISTS tasks_name ON tasks(name)''',
+         '''CREATE INDEX IF NOT EXISTS tasks_status ON tasks(status, reservetime)''',
+         '''CREATE INDEX IF NOT EXISTS history_taskname ON history(taskname)''',
+         '''CREATE INDEX IF NOT EXISTS history_endtime ON history(endtime)''',
+         '''CREATE INDEX IF NOT EXISTS history_taskid ON history(taskid)''']),
+    (3, ['''ALTER TABLE tasks ADD COLUMN feedfile TEXT''']),
+    (4, ['''CREATE TABLE IF NOT EXISTS feedback_kv (taskid INTEGER, key TEXT, value TEXT,
+            PRIMARY KEY (taskid, key)) WITHOUT ROWID''',
+         '''CREATE INDEX IF NOT EXISTS feedback_kv_key ON feedback_kv(key, value)''',
+         '''CREATE TABLE IF NOT EXISTS history_kv (historyid INTEGER, key TEXT, value TEXT,
+            PRIMARY KEY (historyid, key)) WITHOUT ROWID''',
+         '''CREATE INDEX IF NOT EXISTS history_kv_key ON history_kv(key, value)''']),
+    (5, ['''CREATE TABLE IF NOT EXISTS task_samples (taskid INTEGER, elapsed INTEGER, cpu INTEGER,
+            rss INTEGER, io_read INTEGER, io_write INTEGER, threads INTEGER,
+            PRIMARY KEY (taskid, elapsed)) WITHOUT ROWID''']),
+]
+
+# Columns of table tasks (besides id) which can be given to update_task
+TASK_COLUMNS = ('name', 'info1', 'info2', 'info3', 'pid', 'status', 'feedback',
+                'reservetime', 'starttime', 'duration', 'lastupdate', 'timeout', 'feedfile')
+
+# Columns of table history (besides id)
+HISTORY_COLUMNS = ('taskid', 'taskname', 'info1', 'info2', 'info3', 'termsignal', 'termerror',
+                   'starttime', 'endtime', 'duration', 'feedback')
+
+# Columns of table task_samples (besides taskid), resources of a running task
+# process tree, all integers :
+# - elapsed           : ms since the task start, end of the sampled interval
+# - cpu               : CPU time (user+system ms) used during the interval
+# - rss               : resident memory (KB) at the end of the interval
+# - io_read, io_write : storage bytes read and written during the interval
+# - threads           : number of threads at the end of the interval
+# Counters are stored as deltas : small integers, compact in sqlite records
+SAMPLE_COLUMNS = ('elapsed', 'cpu', 'rss', 'io_read', 'io_write', 'threads')
+
+# Format version of the history feedback snapshots (first byte of the blob)
+FEEDBACK_FORMAT = 1
+
+# Native records returned by the fetch_* methods
+Task = namedtuple('Task', ('id',) + TASK_COLUMNS)
+Feedback = namedtuple('Feedback', ('id', 'feedback', 'lastupdate'))
+HistoryEntry = namedtuple('HistoryEntry', ('id',) + HISTORY_COLUMNS)
+TaskSample = namedtuple('TaskSample', SAMPLE_COLUMNS)
+
+
+def record_to_dict(record):
+    """
+    Returns the dictionary of a record without its id
+    (format used in the json outputs, keyed by id)
+    """
+    result = record._asdict()
+    result.pop('id')
+    return result
+
+
+def encode_feedback(feedback=None, tail=None, stats=None):
+    """
+    Returns the history blob of a final feedback snapshot : format version
+    byte followed by the zlib compressed json { feedback, tail }
+    feedback is the final key/values, tail the optional end of the file,
+    stats the optional resource usage summary (see summarize_samples)
+    """
+    snapshot = { 'feedback' : feedback, 'tail' : tail }
+    if stats:
+        snapshot['stats'] = stats
+    data = json.dumps(snapshot).encode('utf-8')
+    return bytes([FEEDBACK_FORMAT]) + zlib.compress(data)
+
+
+def decode_feedback(value=None):
+    """
+    Returns the snapshot { feedback, tail } of a history feedback blob
+    Values stored before the snapshot format (text) are returned as is
+    """
+    if not isinstance(value, bytes) or not value:
+        return value
+    if value[0] != FEEDBACK_FORMAT:
+        log.error("unknown feedback format={}".format(value[0]))
+        raise SystemExit
+    return json.loads(zlib.decompress(value[1:]).decode('utf-8'))
+
+
+def summarize_samples(samples=None):
+    """
+    Returns the resource usage summary of a task from its samples
+    (TaskSample list ordered by elapsed) as a dictionary :
+    samples, elapsed (ms), cpu (% of one cpu), rss (KB) and threads peak
+    and average (weighted by the sample intervals), io_read and io_write
+    total bytes and peak rate (bytes/sec)
+    """
+    result = { 'samples' : len(samples), 'elapsed' : 0 }
+    if not samples:
+        return result
+
+    elapsed = samples[-1].elapsed
+    result['elapsed'] = elapsed
+    previous = 0
+    peak = { 'cpu' : 0.0, 'io_read' : 0.0, 'io_write' : 0.0 }
+    weighted = { 'rss' : 0, 'threads' : 0 }
+    for sample in samples:
+        interval = max(1, sample.elapsed - previous)
+        previous = sample.elapsed
+        peak['cpu'] = max(peak['cpu'], sample.cpu * 100.0 / interval)
+        peak['io_read'] = max(peak['io_read'], sample.io_read * 1000.0 / interval)
+        peak['io_write'] = max(peak['io_write'], sample.io_write * 1000.0 / interval)
+        weighted['rss'] = weighted['rss'] + sample.rss * interval
+        weighted['threads'] = weighted['threads'] + sample.threads * interval
+
+    span = max(1, elapsed)
+    result['cpu'] = { 'peak' : round(peak['cpu'], 1),
+                      'avg' : round(sum([ s.cpu for s in samples ]) * 100.0 / span, 1) }
+    result['rss'] = { 'peak' : max([ s.rss for s in samples ]),
+                      'avg' : int(weighted['rss'] / span) }
+    result['threads'] = { 'peak' : max([ s.threads for s in samples ]),
+                          'avg' : round(weighted['threads'] / span, 1) }
+    for key in ('io_read', 'io_write'):
+        result[key] = { 'total' : sum([ getattr(s, key) for s in samples ]),
+                        'peak_rate' : int(peak[key]) }
+    return result
+
+
+def feedback_items(feedback=None):
+    """
+    Returns the key/values of a feedback (json object string or dictionary)
+    as a dictionary of strings, as stored in the feedback_kv and history_kv
+    tables. Returns None if the feedback is not a key/value object
+    """
+    if isinstance(feedback, (str, bytes)):
+        try:
+            feedback = json.loads(feedback)
+        except ValueError:
+            return None
+    if not isinstance(feedback, dict):
+        return None
+    return { str(key) : str(feedback[key]) for key in feedback }
+
+
+def kv_condition(column, table, where):
+    """
+    Returns (condition, params) selecting the ids in 'column' matching all
+    the key=value pairs of dictionary 'where' in the kv 'table' (feedback_kv
+    on taskid or history_kv on historyid), resolved with its (key, value) index
+    """
+    conditions = []
+    params = []
+    idcolumn = 'taskid' if table == 'feedback_kv' else 'historyid'
+    for key in sorted(where):
+        conditions.append("{} IN (SELECT {} FROM {} WHERE key=? AND value=?)".format(column, idcolumn, table))
+        params.extend([str(key), str(where[key])])
+    return (" AND ".join(conditions), params)
+
 
 class Database(object):
     """
     Datanse from the taskwatcher suite
     Called with db : sqlite file
+    Optional : durability (fast|safe|paranoid), defaults to the profile stored in db
     """
-    def __init__(self, db='', debug=False):
+    def __init__(self, db='', debug=False, durability=None):
 
         # create logger
         log.basicConfig(
@@ -36,19 +214,242 @@ class Database(object):
             self.debug = False
             log.basicConfig(level='ERROR')
 
-        log.info("Constructor with db={} debug={}".format(db, debug))
+        log.info("Constructor with db={} debug={} durability={}".format(db, debug, durability))
 
         # Sanity checks
         if not db:
             log.error("db filename is required")
             raise SystemExit
 
+        if durability and durability not in DURABILITY:
+            log.error("unknown durability={}".format(durability))
+            raise SystemExit
+
         # Attributs
         self.db = db
         self.reserve_timeout = 5
+        self.cached_statements = 64
+        self.durability = durability
 
         # Private Attributs
         self._DB = None
+        self._DB_pid = None
+        self._DB_inherited = []
+        self._profile = DEFAULT_DURABILITY
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        """
+        Closes the database connection if opened
+        A new connection is opened on the next call needing it
+        """
+        log.info("Enter")
+
+        if self._DB is not None:
+            if self._DB_pid == os.getpid():
+                checkpoint = DURABILITY[self._profile]['checkpoint']
+                if checkpoint:
+                    try:
+                        self._DB.execute("PRAGMA wal_checkpoint({})".format(checkpoint))
+                    except sqlite3.Error as e:
+                        log.warning("checkpoint {} failed: {}".format(checkpoint, e))
+                self._DB.close()
+            else:
+                self._DB_inherited.append(self._DB)
+        self._DB = None
+        self._DB_pid = None
+
+
+    def _connect(self):
+        """
+        Returns the database connection, opening it on first use
+        The connection is kept opened for the life of the object so sqlite
+        schema parsing and prepared statements are reused between calls.
+        A process forked after the connection was opened (launcher) does not
+        share it with its father : a new connection is opened in the child.
+        """
+        pid = os.getpid()
+        if self._DB is not None and self._DB_pid == pid:
+            return self._DB
+
+        if self._DB is not None:
+            # Never close a connection inherited from the father, keep it aside
+            log.debug("connection inherited from pid={}, reopen in pid={}".format(self._DB_pid, pid))
+            self._DB_inherited.append(self._DB)
+
+        log.debug("Open connection to {}".format(self.db))
+        self._DB = sqlite3.connect(self.db, cached_statements=self.cached_statements)
+        self._DB_pid = pid
+        self._upgrade()
+        self._configure()
+        return self._DB
+
+
+    def _upgrade(self):
+        """
+        Brings the schema of an existing database to SCHEMA_VERSION
+        Applies the missing MIGRATIONS in one transaction. An empty database
+        (file not created yet) is left untouched.
+        """
+        cursor = self._DB.cursor()
+        try:
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                return
+
+            cursor.execute("BEGIN IMMEDIATE")
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='tasks'")
+            if version < SCHEMA_VERSION and cursor.fetchone():
+                log.info("upgrade schema from version={} to version={}".format(version, SCHEMA_VERSION))
+                self._migrate(cursor, version)
+            self._DB.commit()
+
+        except Exception as e:
+            self._DB.rollback()
+            raise e
+
+        finally:
+            cursor.close()
+
+
+    def _migrate(self, cursor, version):
+        """
+        Runs the migrations above the given version on cursor
+        and sets the schema version. Caller commits.
+        """
+        for (target, statements) in MIGRATIONS:
+            if target <= version:
+                continue
+            log.debug("apply migration version={}".format(target))
+            for statement in statements:
+                cursor.execute(statement)
+        cursor.execute("PRAGMA user_version={}".format(int(SCHEMA_VERSION)))
+
+
+    def _configure(self):
+        """
+        Applies the durability profile on the connection
+        Profile is the one given to the constructor, otherwise the one stored
+        in the database config table, otherwise DEFAULT_DURABILITY
+        """
+        profile = self.durability
+        if not profile:
+            profile = self.get_config(key='durability')
+        if profile not in DURABILITY:
+            profile = DEFAULT_DURABILITY
+        self._profile = profile
+        settings = DURABILITY[profile]
+        log.debug("durability={} settings={}".format(profile, settings))
+
+        self._DB.execute("PRAGMA busy_timeout={}".format(int(settings['busy_timeout'])))
+        self._DB.execute("PRAGMA synchronous={}".format(settings['synchronous']))
+        self._DB.execute("PRAGMA wal_autocheckpoint={}".format(int(settings['wal_autocheckpoint'])))
+
+        # journal mode is persistent in the file, only switch it when needed
+        # and when the database has been created
+        journal_mode = self._DB.execute("PRAGMA journal_mode").fetchone()[0]
+        if journal_mode.upper() != settings['journal_mode'] and self._is_created():
+            log.debug("switch journal_mode from {} to {}".format(journal_mode, settings['journal_mode']))
+            self._DB.execute("PRAGMA journal_mode={}".format(settings['journal_mode']))
+
+
+    def _is_created(self):
+        """
+        Returns True if the database schema exists
+        """
+        cursor = self._DB.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='tasks'")
+        try:
+            return cursor.fetchone() is not None
+        finally:
+            cursor.close()
+
+
+    def query_plan(self, statement='', params=()):
+        """
+        Returns the sqlite query plan of a statement as a list of strings
+        (detail column of EXPLAIN QUERY PLAN), used to check index usage
+        """
+        log.info("Enter with statement={}".format(statement))
+
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute("EXPLAIN QUERY PLAN "+statement, params)
+            plan = [ row[3] for row in cursor ]
+
+        finally:
+            cursor.close()
+
+        log.debug("plan={}".format(plan))
+        return plan
+
+
+    def get_config(self, key=''):
+        """
+        Returns the value of a configuration key from the config table
+        or None if unknown (or if the database has no config table)
+        """
+        log.info("Enter with key={}".format(key))
+        value = None
+
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute('''SELECT value FROM config WHERE key=?''', [key])
+            row = cursor.fetchone()
+            if row:
+                value = row[0]
+
+        except sqlite3.OperationalError as e:
+            log.debug("no config available: {}".format(e))
+
+        finally:
+            cursor.close()
+
+        log.debug("key={} value={}".format(key, value))
+        return value
+
+
+    def set_config(self, key='', value=None):
+        """
+        Stores a configuration key/value in the config table
+        """
+        log.info("Enter with key={} value={}".format(key, value))
+
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute('''INSERT OR REPLACE INTO config(key, value) VALUES(?,?)''', [key, value])
+            self._DB.commit()
+
+        except Exception as e:
+            # Roll back
+            self._DB.rollback()
+            raise e
+
+        finally:
+            cursor.close()
+
+
+    def set_durability(self, durability=''):
+        """
+        Stores the durability profile in the database so all processes
+        opening it use the same settings, and applies it on this connection
+        """
+        log.info("Enter with durability={}".format(durability))
+
+        if durability not in DURABILITY:
+            log.error("unknown durability={}".format(durability))
+            raise SystemExit
+
+        self.set_config(key='durability', value=durability)
+        self.durability = durability
+        self._configure()
 
 
     def create(self):
@@ -59,14 +460,20 @@ class Database(object):
         log.info("Enter")
 
         # Create new db file
+        self.close()
         if os.path.isfile(self.db):
             log.debug("{} exists, delete it".format(self.db))
             os.remove(self.db)
-        
+
+        # Leftovers from the previous database would be applied to the new one
+        for suffix in ['-wal', '-shm', '-journal']:
+            if os.path.isfile(self.db+suffix):
+                log.debug("delete {}".format(self.db+suffix))
+                os.remove(self.db+suffix)
+
         log.debug("Create database {}".format(self.db))
+        cursor = self._connect().cursor()
         try:
-            self._DB = sqlite3.connect(self.db)
-            cursor = self._DB.cursor()
             cursor.execute('''
                 CREATE TABLE tasks (id INTEGER PRIMARY KEY, name TEXT, info1
                            TEXT, info2 TEXT, info3 TEXT, pid INTEGER, status TEXT, feedback INTEGER,
@@ -81,6 +488,9 @@ class Database(object):
                            starttime INTEGER, endtime INTEGER, duration INTEGER,
                            feedback BLOB)
             ''')
+            self._migrate(cursor, 0)
+            cursor.execute('''INSERT INTO config(key, value) VALUES(?,?)''',
+                           ['durability', self.durability or DEFAULT_DURABILITY])
             self._DB.commit()
 
         except Exception as e:
@@ -89,7 +499,11 @@ class Database(object):
             raise e
 
         finally:
-             self._DB.close()
+            cursor.close()
+
+        # Switch to the journal mode of the profile now that db exists
+        self._configure()
+
 
     # --- tasks ---
 
@@ -97,47 +511,66 @@ class Database(object):
         """
         Update database information
         This command should be call on a regular basis to update duration information
+        If a taskid is provided, only the specific task is updated
 
+        The sweep is done with a few statements in a single transaction :
         - delete tasks with reservation timeout
-        - running task has timeout :  If a taskid is provided, only the specific task is updated
-          In this case only, a True/False is return to tell if the task has timed-out
+        - update running tasks duration (lastupdate is left untouched)
+        - flag running tasks which duration is over their timeout
+
+        Returns a summary dictionary :
+        { 'expired' : <number of reservations deleted>,
+          'updated' : <number of durations updated>,
+          'timeout' : [ <taskid of tasks in timeout>, ... ] }
         """
-        log.info("Enter")
+        log.info("Enter with taskid={}".format(taskid))
 
-        tasks = json.loads(self.get_tasks(taskid=taskid))
         updatetime = int(time.time())
-        duration = None
+        summary = { 'expired' : 0, 'updated' : 0, 'timeout' : [] }
 
-        for t in tasks:
+        where = ""
+        params = []
+        if taskid:
+            where = " AND id=?"
+            params = [taskid]
+
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
 
             # Reserved task timeout
-            status = tasks[t]['status']
-            reservetime = tasks[t]['reservetime']
-            delta = updatetime - reservetime
-            if status=='RESERVED' and ( delta > self.reserve_timeout):
-                log.warning("reservation timeout updatetime={} reservetime={} (delta={}) reserve_timeout={}, delete task".
-                            format(updatetime, reservetime, delta, self.reserve_timeout))
-                self.delete_task(taskid=t)
-
-            # running task timeout
-            starttime = tasks[t]['starttime']
-            timeout = tasks[t]['timeout']
-            if starttime:
-                duration = updatetime - starttime
-                log.debug("Duration update needed for taskid={} startime={} now={} duration={} timeout={}".
-                          format(taskid, starttime, updatetime, duration, timeout))
-                update = {}
-                update['duration'] = duration
-                # Do not change the lastupdate here
-                self.update_task(taskid=t, update=update, do_lastupdate=False)
-
-        if taskid and timeout and starttime and duration:
-            has_timeout = False
-            if duration > timeout:
-                log.debug("Task has timed-out duration={} timeout={}".format(duration, timeout))
-                has_timeout = True
-            return has_timeout
-    
+            cursor.execute("DELETE FROM tasks WHERE status='RESERVED' AND reservetime < ?"+where,
+                           [updatetime - self.reserve_timeout] + params)
+            summary['expired'] = cursor.rowcount
+
+            # Running tasks duration
+            cursor.execute("UPDATE tasks SET duration = ? - starttime WHERE starttime > 0 "
+                           "AND (duration IS NULL OR duration != ? - starttime)"+where,
+                           [updatetime, updatetime] + params)
+            summary['updated'] = cursor.rowcount
+
+            # Running tasks timeout
+            cursor.execute("SELECT id FROM tasks WHERE starttime > 0 AND timeout > 0 "
+                           "AND duration > timeout"+where, params)
+            summary['timeout'] = [ row[0] for row in cursor ]
+
+            self._DB.commit()
+
+        except Exception as e:
+            # Roll back
+            self._DB.rollback()
+            raise e
+
+        finally:
+            cursor.close()
+
+        if summary['expired']:
+            log.warning("reservation timeout reserve_timeout={}, deleted {} tasks".
+                        format(self.reserve_timeout, summary['expired']))
+
+        log.debug("summary={}".format(summary))
+        return summary
+
 
     def timeout_status (self, taskid):
         """
@@ -150,7 +583,9 @@ class Database(object):
             log.error("taskid is required")
             raise SystemExit
         
-        status  = self.update(taskid=taskid)
+        summary = self.update(taskid=taskid)
+        status = int(taskid) in summary['timeout']
+        log.debug("taskid={} timeout={}".format(taskid, status))
         return status
 
 
@@ -177,9 +612,8 @@ class Database(object):
                 log.warning("a task with the same name is currently active and unique is set. Can't reserve")
                 return 0
 
+        cursor = self._connect().cursor()
         try:
-            self._DB = sqlite3.connect(self.db)
-            cursor = self._DB.cursor()
             cursor.execute('''INSERT INTO tasks(id, name, status, reservetime)
                            VALUES(?,?,?,?)''', [ None, taskname, 'RESERVED', reservetime])
             lastid = cursor.lastrowid
@@ -191,7 +625,7 @@ class Database(object):
             raise e
 
         finally:
-             self._DB.close()
+            cursor.close()
 
         log.debug("lastid={}".format(lastid))
         return (lastid)
@@ -203,9 +637,8 @@ class Database(object):
         """
         log.info("Enter with taskname={}".format(taskname))
 
+        cursor = self._connect().cursor()
         try:
-            self._DB = sqlite3.connect(self.db)
-            cursor = self._DB.cursor()
             cursor.execute('''SELECT id, name, status FROM tasks WHERE name=?''', [taskname])  
             task = cursor.fetchone()
             if task:
@@ -219,7 +652,7 @@ class Database(object):
             raise e
 
         finally:
-            self._DB.close()
+            cursor.close()
 
 
     def is_task_reserved(self, taskid=''):
@@ -230,9 +663,8 @@ class Database(object):
         """
         log.info("Enter with taskid={}".format(taskid))
 
+        cursor = self._connect().cursor()
         try:
-            self._DB = sqlite3.connect(self.db)
-            cursor = self._DB.cursor()
             cursor.execute('''SELECT id, status FROM tasks WHERE status="RESERVED" and id=?''', [taskid])  
             task = cursor.fetchone()
             if task:
@@ -244,13 +676,14 @@ class Database(object):
             raise e
 
         finally:
-            self._DB.close()
+            cursor.close()
 
 
     def update_task(self, taskid='', update=None, do_lastupdate=True):
         """
         Updates a task from its taskid with the given information in the update dictionary
-        Updates the lastupdate timer
+        Only the columns given in update are written, in a single statement.
+        Keys should be columns from TASK_COLUMNS
 
         Per default (do_lastupdate=True) the 'lastupdate' is updated.
         Use do_lastupdate=False to keep it untouched
@@ -265,50 +698,72 @@ class Database(object):
             log.warning("no updated provided, ignoring")
             return 
 
-        # taskid need to be a string to be used as a dictionary key
-        taskid=str(taskid)
-        log.debug("update={}".format(update))
-        task = json.loads(self.get_tasks(taskid=taskid))
-        log.debug("task={}".format(task))
         for key in update:
-            log.debug("key={} taskid={}".format(key,taskid))
-            if key not in task[taskid]:
+            if key not in TASK_COLUMNS:
                 log.error("key={} is unknown from table tasks".format(key))
                 raise SystemExit
-            current_value = task[taskid][key]
-            if current_value==update[key]:
-                log.debug("key={} has already value={}, do nothing".format(key,update[key]))
-            else:
-                log.debug("update key={} with value={}".format(key,update[key]))
-                task[taskid][key] = update[key]
-
-        log.debug("updating with task={}".format(task[taskid]))
 
+        values = dict(update)
         if do_lastupdate:
-            updatetime = int(time.time())
-        else:
-            updatetime = task[taskid]['lastupdate']
+            values['lastupdate'] = int(time.time())
 
+        # Sorted columns keep the statement text stable for the statement cache
+        columns = sorted(values)
+        statement = "UPDATE tasks SET "+", ".join([ "{}=?".format(c) for c in columns ])+" WHERE id=?"
+        params = [ values[c] for c in columns ] + [taskid]
+        log.debug("statement={} params={}".format(statement, params))
+
+        cursor = self._connect().cursor()
         try:
-            self._DB = sqlite3.connect(self.db)
-            cursor = self._DB.cursor()
-            cursor.execute('''UPDATE tasks SET name=?, info1=?, info2=?,
-                           info3=?, pid=?, status=?,
-                           feedback=?, reservetime=?, starttime=?, duration=?,
-                           lastupdate=?, timeout=?  WHERE id=?''',
-                           (task[taskid]['name'],
-                           task[taskid]['info1'],
-                           task[taskid]['info2'],
-                           task[taskid]['info3'],
-                            task[taskid]['pid'],
-                            task[taskid]['status'],
-                            task[taskid]['feedback'],
-                            task[taskid]['reservetime'],
-                            task[taskid]['starttime'],
-                            task[taskid]['duration'],
-                            updatetime,
-                            task[taskid]['timeout'],
-                            taskid))
+            cursor.execute(statement, params)
+            if not cursor.rowcount:
+                log.warning("taskid={} is unknown, nothing updated".format(taskid))
+            self._DB.commit()
+
+        except Exception as e:
+            # Roll back
+            self._DB.rollback()
+            raise e
+
+        finally:
+            cursor.close()
+
+
+    def update_tasks(self, updates=None, do_lastupdate=True):
+        """
+        Updates several tasks in a single transaction
+        updates is a dictionary { taskid : update } (see update_task)
+        Tasks with the same updated columns are written with one executemany
+        Returns the number of tasks updated
+        """
+        log.info("Enter with {} updates do_lastupdate={}".format(len(updates or {}), do_lastupdate))
+
+        if not updates:
+            log.debug("no updates provided, ignoring")
+            return 0
+
+        lastupdate = int(time.time())
+        groups = {}
+        for taskid, update in updates.items():
+            for key in update:
+                if key not in TASK_COLUMNS:
+                    log.error("key={} is unknown from table tasks".format(key))
+                    raise SystemExit
+            values = dict(update)
+            if do_lastupdate:
+                values['lastupdate'] = lastupdate
+            columns = tuple(sorted(values))
+            groups.setdefault(columns, []).append([ values[c] for c in columns ] + [taskid])
+
+        updated = 0
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for columns, params in groups.items():
+                statement = "UPDATE tasks SET "+", ".join([ "{}=?".format(c) for c in columns ])+" WHERE id=?"
+                log.debug("statement={} rows={}".format(statement, len(params)))
+                cursor.executemany(statement, params)
+                updated = updated + cursor.rowcount
             self._DB.commit()
 
         except Exception as e:
@@ -317,62 +772,70 @@ class Database(object):
             raise e
 
         finally:
-             self._DB.close()
+            cursor.close()
+
+        log.debug("updated={}".format(updated))
+        return updated
 
     
-    def get_tasks(self, taskid=None, reserved=True):
+    def fetch_tasks(self, taskid=None, reserved=True, status=None, where=None):
         """
-        Returns all tasks as a string in a json format
+        Returns all tasks as a list of Task records
         If a taskid is provided, only return for this task
+        If a status is provided, only return tasks with this status
+        If where (dictionary) is provided, only return tasks with all these
+        feedback key=value pairs
         By default, reserved tasks are returned
         """
-        log.info("Enter with taskid={}".format(taskid))
-        result={}
-
+        log.info("Enter with taskid={} reserved={} status={} where={}".format(taskid, reserved, status, where))
+
+        statement = "SELECT id, "+", ".join(TASK_COLUMNS)+" FROM tasks"
+        conditions = []
+        params = []
+        if taskid:
+            conditions.append("id=?")
+            params.append(taskid)
+        if not reserved:
+            conditions.append("status IS NOT 'RESERVED'")
+        if status:
+            conditions.append("status=?")
+            params.append(status)
+        if where:
+            (condition, kvparams) = kv_condition('id', 'feedback_kv', where)
+            conditions.append(condition)
+            params.extend(kvparams)
+        if conditions:
+            statement = statement+" WHERE "+" AND ".join(conditions)
+
+        cursor = self._connect().cursor()
         try:
-            self._DB = sqlite3.connect(self.db)
-            cursor = self._DB.cursor()
-            if taskid:
-                cursor.execute('''SELECT id, name, info1, info2, info3, pid, status, feedback, reservetime, 
-                                  starttime, duration, lastupdate, timeout FROM
-                                  tasks WHERE id=?''', [taskid])
-            else:
-                cursor.execute('''SELECT id, name, info1, info2, info3, pid, status, feedback, reservetime, 
-                                  starttime, duration, lastupdate, timeout FROM tasks''')
- 
-            for row in cursor:
-                log.debug('''tasks {0} : name={1}, info1={2} info2={3}
-                          info3={4} pid={5}, status={6}, feedback={7},
-                          reservetime={8}, starttime={9}, duration={10},
-                          lastupdate={11} timeout={12}'''
-                          .format(row[0], row[1], row[2], row[3],row[4],
-                                  row[5], row[6], row[7], row[8], row[9],
-                                  row[10], row[11], row[12]))
-
-                if not reserved and row[6] == 'RESERVED':
-                    log.debug("ignore reserved task")
-                    continue
-
-                result[row[0]]= {}
-                result[row[0]]['name'] = row[1]
-                result[row[0]]['info1'] = row[2]
-                result[row[0]]['info2'] = row[3]
-                result[row[0]]['info3'] = row[4]
-                result[row[0]]['pid'] = row[5]
-                result[row[0]]['status'] = row[6]
-                result[row[0]]['feedback'] = row[7]
-                result[row[0]]['reservetime'] = row[8]
-                result[row[0]]['starttime'] = row[9]
-                result[row[0]]['duration'] = row[10]
-                result[row[0]]['lastupdate'] = row[11]
-                result[row[0]]['timeout'] = row[12]
+            cursor.execute(statement, params)
+            tasks = list(map(Task._make, cursor))
 
         except Exception as e:
             self._DB.rollback()
             raise e
 
         finally:
-            self._DB.close()
+            cursor.close()
+
+        log.debug("nb tasks={}".format(len(tasks)))
+        return tasks
+
+
+    def get_tasks(self, taskid=None, reserved=True, where=None):
+        """
+        Returns all tasks as a string in a json format
+        If a taskid is provided, only return for this task
+        If where (dictionary) is provided, only return tasks with all these
+        feedback key=value pairs
+        By default, reserved tasks are returned
+        """
+        log.info("Enter with taskid={} where={}".format(taskid, where))
+
+        result = {}
+        for task in self.fetch_tasks(taskid=taskid, reserved=reserved, where=where):
+            result[task.id] = record_to_dict(task)
 
         result_json = json.dumps(result)
         log.debug("return result_json={}".format(result_json))
@@ -386,9 +849,8 @@ class Database(object):
         log.info("Enter")
         nb_tasks = 0 
 
+        cursor = self._connect().cursor()
         try:
-            self._DB = sqlite3.connect(self.db)
-            cursor = self._DB.cursor()
             cursor.execute('''SELECT count(id) FROM tasks''')
             result = cursor.fetchone()
             if result:
@@ -401,7 +863,7 @@ class Database(object):
             raise e
 
         finally:
-            self._DB.close()
+            cursor.close()
        
         log.debug("nb_tasks={}".format(nb_tasks))
         return nb_tasks 
@@ -417,11 +879,14 @@ class Database(object):
             log.error("taskid is required")
             raise SystemExit
  
+        cursor = self._connect().cursor()
         try:
-            self._DB = sqlite3.connect(self.db)
-            cursor = self._DB.cursor()
             log.debug("deleting task taskid={}".format(taskid))
             cursor.execute('''DELETE FROM tasks WHERE id=?''', [taskid])
+            # task ids may be reused, the task feedback goes with it
+            cursor.execute('''DELETE FROM feedbacks WHERE id=?''', [taskid])
+            cursor.execute('''DELETE FROM feedback_kv WHERE taskid=?''', [taskid])
+            cursor.execute('''DELETE FROM task_samples WHERE taskid=?''', [taskid])
             self._DB.commit()
 
         except Exception as e:
@@ -430,37 +895,46 @@ class Database(object):
             raise e
 
         finally:
-             self._DB.close()
+            cursor.close()
 
     # --- feedbacks ---
 
-    def get_feedbacks(self, taskid=None):
+    def fetch_feedbacks(self, taskid=None):
         """
-        Returns all feedbacks as a string in a json format
+        Returns all feedbacks as a list of Feedback records
         If a taskid is provided, only return for this task
         """
         log.info("Enter with taskid={}".format(taskid))
-        result={}
 
+        cursor = self._connect().cursor()
         try:
-            self._DB = sqlite3.connect(self.db)
-            cursor = self._DB.cursor()
             if taskid:
-                cursor.execute('''SELECT id, feedback FROM feedbacks WHERE id=?''', [taskid])
+                cursor.execute('''SELECT id, feedback, lastupdate FROM feedbacks WHERE id=?''', [taskid])
             else:
-                cursor.execute('''SELECT id, feedback FROM feedbacks''')
-
-            for row in cursor:
-                log.debug('''feedbacks {0} : feedback={1}'''.format(row[0], row[1]))
-                result[row[0]]= {}
-                result[row[0]]['feedback'] = row[1]
+                cursor.execute('''SELECT id, feedback, lastupdate FROM feedbacks''')
+            feedbacks = list(map(Feedback._make, cursor))
 
         except Exception as e:
             self._DB.rollback()
             raise e
 
         finally:
-            self._DB.close()
+            cursor.close()
+
+        log.debug("nb feedbacks={}".format(len(feedbacks)))
+        return feedbacks
+
+
+    def get_feedbacks(self, taskid=None):
+        """
+        Returns all feedbacks as a string in a json format
+        If a taskid is provided, only return for this task
+        """
+        log.info("Enter with taskid={}".format(taskid))
+
+        result = {}
+        for fb in self.fetch_feedbacks(taskid=taskid):
+            result[fb.id] = { 'feedback' : fb.feedback }
 
         result_json = json.dumps(result)
         log.debug("return result_json={}".format(result_json))
@@ -471,7 +945,9 @@ class Database(object):
     def update_feedback(self, taskid=None, feedback=None):
         """
         Updates feedback from given taskid
-        Feedback is created if not
+        Feedback is created if not (feedback id is the taskid)
+        If feedback is a json object, its key/values are also kept in table
+        feedback_kv, only the changed pairs are written
         """
         log.info("Enter with taskid={} feedback={}".format(taskid, feedback))
 
@@ -482,56 +958,138 @@ class Database(object):
             log.error("no feedback provided")
             raise SystemExit
 
-        fb = json.loads(self.get_feedbacks(taskid=taskid))
+        self.update_feedbacks(feedbacks={ taskid : feedback })
 
-        if not fb:
-            # This is a new entry 
-            log.debug("No feedback for this taskid, need new entry")
-            updatetime = int(time.time())
 
-            try:
-                self._DB = sqlite3.connect(self.db)
-                cursor = self._DB.cursor()
-                cursor.execute('''INSERT INTO feedbacks(id,feedback,lastupdate) 
-                               VALUES(?,?,?)''',(None,feedback,updatetime))
-                self._DB.commit()
+    def update_feedbacks(self, feedbacks=None):
+        """
+        Updates the feedback of several tasks in a single transaction
+        feedbacks is a dictionary { taskid : feedback } (see update_feedback)
+        """
+        log.info("Enter with {} feedbacks".format(len(feedbacks or {})))
 
-            except Exception as e:
-                # Roll back
-                self._DB.rollback()
-                raise e
+        if not feedbacks:
+            log.debug("no feedbacks provided, ignoring")
+            return
 
-            finally:
-                 self._DB.close()
+        updatetime = int(time.time())
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for taskid, feedback in feedbacks.items():
+                taskid = int(taskid)
+                items = feedback_items(feedback)
+                cursor.execute('''INSERT OR REPLACE INTO feedbacks(id,feedback,lastupdate)
+                               VALUES(?,?,?)''', (taskid, feedback, updatetime))
+                if items is None:
+                    continue
+                cursor.execute('''SELECT key, value FROM feedback_kv WHERE taskid=?''', [taskid])
+                current = dict(cursor.fetchall())
+                removed = [ (taskid, key) for key in current if key not in items ]
+                changed = [ (taskid, key, items[key]) for key in items if current.get(key) != items[key] ]
+                log.debug("taskid={} feedback_kv removed={} changed={}".format(taskid, len(removed), len(changed)))
+                cursor.executemany('''DELETE FROM feedback_kv WHERE taskid=? AND key=?''', removed)
+                cursor.executemany('''INSERT OR REPLACE INTO feedback_kv(taskid, key, value) VALUES(?,?,?)''', changed)
+            self._DB.commit()
 
+        except Exception as e:
+            # Roll back
+            self._DB.rollback()
+            raise e
 
-        else :
-            # This is an update
-            current_value = fb[taskid]['feedback']
-            log.debug("Current feedback={}".format(current_value))
-            if current_value==feedback:
-                log.debug("feedback is unchanged, do nothing")
-            else:
-                log.debug("update feedback with {}".format(feedback))
-                fb[taskid]['feedback'] = feedback
+        finally:
+            cursor.close()
 
-            log.debug("updating with feedback={}".format(fb[taskid]))
-            updatetime = int(time.time())
 
-            try:
-                self._DB = sqlite3.connect(self.db)
-                cursor = self._DB.cursor()
-                cursor.execute('''UPDATE feedbacks SET feedback=?, lastupdate=? WHERE  id=?''',
-                               (fb[taskid]['feedback'], updatetime, taskid))
-                self._DB.commit()
+    # --- samples
 
-            except Exception as e:
-                # Roll back
-                self._DB.rollback()
-                raise e
+    def add_task_sample(self, taskid=None, sample=None):
+        """
+        Adds a resource sample of a running task
+        sample is a dictionary with the SAMPLE_COLUMNS keys
+        Returns the number of samples of the task
+        """
+        log.info("Enter with taskid={} sample={}".format(taskid, sample))
 
-            finally:
-                 self._DB.close()
+        if not taskid:
+            log.error("no taskid provided")
+            raise SystemExit
+
+        params = [int(taskid)] + [ int(sample.get(c) or 0) for c in SAMPLE_COLUMNS ]
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute('''INSERT OR REPLACE INTO task_samples(taskid, '''+", ".join(SAMPLE_COLUMNS)+''')
+                           VALUES(?,?,?,?,?,?,?)''', params)
+            cursor.execute('''SELECT count(*) FROM task_samples WHERE taskid=?''', [params[0]])
+            count = cursor.fetchone()[0]
+            self._DB.commit()
+
+        except Exception as e:
+            # Roll back
+            self._DB.rollback()
+            raise e
+
+        finally:
+            cursor.close()
+
+        return count
+
+
+    def fetch_task_samples(self, taskid=None):
+        """
+        Returns the samples of a task as a list of TaskSample records,
+        ordered by elapsed time
+        """
+        log.info("Enter with taskid={}".format(taskid))
+
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute('''SELECT '''+", ".join(SAMPLE_COLUMNS)+''' FROM task_samples
+                           WHERE taskid=? ORDER BY elapsed''', [int(taskid)])
+            return [ TaskSample(*row) for row in cursor ]
+
+        finally:
+            cursor.close()
+
+
+    def downsample_task_samples(self, taskid=None):
+        """
+        Halves the number of samples of a long running task : consecutive
+        pairs are merged (cpu and io deltas summed, rss and threads peaks
+        kept, elapsed of the later one)
+        Returns the number of samples left
+        """
+        log.info("Enter with taskid={}".format(taskid))
+
+        taskid = int(taskid)
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute('''SELECT '''+", ".join(SAMPLE_COLUMNS)+''' FROM task_samples
+                           WHERE taskid=? ORDER BY elapsed''', [taskid])
+            samples = [ TaskSample(*row) for row in cursor.fetchall() ]
+            merged = []
+            for i in range(0, len(samples), 2):
+                pair = samples[i:i+2]
+                merged.append((taskid, pair[-1].elapsed,
+                               sum([ s.cpu for s in pair ]), max([ s.rss for s in pair ]),
+                               sum([ s.io_read for s in pair ]), sum([ s.io_write for s in pair ]),
+                               max([ s.threads for s in pair ])))
+            cursor.execute('''DELETE FROM task_samples WHERE taskid=?''', [taskid])
+            cursor.executemany('''INSERT INTO task_samples(taskid, '''+", ".join(SAMPLE_COLUMNS)+''')
+                               VALUES(?,?,?,?,?,?,?)''', merged)
+            self._DB.commit()
+
+        except Exception as e:
+            # Roll back
+            self._DB.rollback()
+            raise e
+
+        finally:
+            cursor.close()
+
+        log.debug("taskid={} samples={} merged to {}".format(taskid, len(samples), len(merged)))
+        return len(merged)
 
 
     # --- history
@@ -540,13 +1098,21 @@ class Database(object):
         """
         Adds a new entry in the history
         entry is a dictionary
+        A feedback given as a dictionary (final key/values) is stored as a
+        compressed snapshot with the optional entry['tail'] and entry['stats']
+        (see encode_feedback), so is a stats summary without feedback
         """
         log.info("Enter")
 
         log.debug("add entry={}".format(entry))
+        feedback = entry['feedback']
+        if isinstance(feedback, dict) or entry.get('stats'):
+            if not isinstance(feedback, dict):
+                feedback = None
+            feedback = encode_feedback(feedback=feedback, tail=entry.get('tail'), stats=entry.get('stats'))
+
+        cursor = self._connect().cursor()
         try:
-            self._DB = sqlite3.connect(self.db)
-            cursor = self._DB.cursor()
             cursor.execute('''INSERT INTO history
                            (taskid,taskname,info1,info2,info3,termsignal,termerror,starttime,endtime,duration,feedback)
                            VALUES(?,?,?,?,?,?,?,?,?,?,?)''',
@@ -560,10 +1126,14 @@ class Database(object):
                                 entry['starttime'],
                                 entry['endtime'],
                                 entry['duration'],
-                                entry['feedback'],
+                                feedback,
                            ))
             lastid = cursor.lastrowid
             log.debug("lastid={}".format(lastid))
+            if isinstance(entry['feedback'], dict):
+                items = feedback_items(entry['feedback'])
+                cursor.executemany('''INSERT INTO history_kv(historyid, key, value) VALUES(?,?,?)''',
+                                   [ (lastid, key, items[key]) for key in items ])
             self._DB.commit()
 
         except Exception as e:
@@ -572,44 +1142,280 @@ class Database(object):
             raise e
 
         finally:
-             self._DB.close()
+            cursor.close()
 
 
-    def get_history(self):
+    def _history_query(self, columns=None, limit=None, after_id=None, taskname=None, since=None,
+                       until=None, status=None, newest_first=False, where=None, taskid=None):
         """
-        Return all historical tasks in a json format
+        Returns (statement, params) selecting history rows with the given
+        filters, see fetch_history
         """
-        log.info("Enter")
-        result={}
+        if not columns:
+            columns = ('id',) + HISTORY_COLUMNS
+
+        conditions = []
+        params = []
+        if after_id is not None:
+            if newest_first:
+                conditions.append("id < ?")
+            else:
+                conditions.append("id > ?")
+            params.append(int(after_id))
+        if taskname is not None:
+            conditions.append("taskname = ?")
+            params.append(taskname)
+        if taskid is not None:
+            conditions.append("taskid = ?")
+            params.append(int(taskid))
+        if since is not None:
+            conditions.append("endtime >= ?")
+            params.append(int(since))
+        if until is not None:
+            conditions.append("endtime < ?")
+            params.append(int(until))
+        if status is not None:
+            conditions.append("termsignal = ?")
+            params.append(str(status))
+        if where:
+            (condition, kvparams) = kv_condition('id', 'history_kv', where)
+            conditions.append(condition)
+            params.extend(kvparams)
+
+        statement = "SELECT "+", ".join(columns)+" FROM history"
+        if conditions:
+            statement = statement+" WHERE "+" AND ".join(conditions)
+        if newest_first:
+            statement = statement+" ORDER BY id DESC"
+        else:
+            statement = statement+" ORDER BY id"
+        if limit is not None:
+            statement = statement+" LIMIT ?"
+            params.append(int(limit))
 
-        try:
-            self._DB = sqlite3.connect(self.db)
-            cursor = self._DB.cursor()
-            cursor.execute('''SELECT id, taskid, taskname, info1, info2, info3, termsignal,
-                           termerror, starttime, endtime, duration, feedback
-                           FROM history''')
-            for row in cursor:
-                result[row[0]]= {}
-                result[row[0]]['taskid'] = row[1]
-                result[row[0]]['taskname'] = row[2]
-                result[row[0]]['info1'] = row[3]
-                result[row[0]]['info2'] = row[4]
-                result[row[0]]['info3'] = row[5]
-                result[row[0]]['termsignal'] = row[6]
-                result[row[0]]['termerror'] = row[7]
-                result[row[0]]['starttime'] = row[8]
-                result[row[0]]['endtime'] = row[9]
-                result[row[0]]['duration'] = row[10]
-                result[row[0]]['feedback'] = row[11]
+        return (statement, params)
 
-        except Exception as e:
-            self._DB.rollback()
-            raise e
+
+    def fetch_history(self, limit=None, after_id=None, taskname=None, since=None,
+                      until=None, status=None, newest_first=False, where=None, with_feedback=False,
+                      taskid=None):
+        """
+        Return historical tasks as a list of HistoryEntry records, ordered by id
+        All filters are optional and done in SQL :
+        - limit        : maximum number of entries returned (page size)
+        - after_id     : keyset cursor, only entries after this id in the
+                         returned order (use the id of the last entry of the previous page)
+        - taskname     : only entries with this task name
+        - taskid       : only entries of this taskid (reused : several runs)
+        - since, until : only entries with since <= endtime < until (unix time)
+        - status       : only entries with this termination status (termsignal)
+        - newest_first : order from the latest entry (latest page with limit)
+        - where        : only entries with all these final feedback key=value
+                         pairs (dictionary)
+        Feedback is None unless with_feedback is set : it is then read and
+        decoded to its snapshot { feedback, tail, stats } (see decode_feedback)
+        """
+        log.info("Enter with limit={} after_id={} taskname={} since={} until={} status={} newest_first={} where={} with_feedback={} taskid={}".
+                 format(limit, after_id, taskname, since, until, status, newest_first, where, with_feedback, taskid))
+
+        history = list(self.iter_history(limit=limit, after_id=after_id, taskname=taskname,
+                                         since=since, until=until, status=status,
+                                         newest_first=newest_first, where=where,
+                                         with_feedback=with_feedback, taskid=taskid))
+        log.debug("nb history={}".format(len(history)))
+        return history
+
+
+    def iter_history(self, batch=500, with_feedback=False, **filters):
+        """
+        Generator of HistoryEntry records, fetched from the database by batch
+        of 'batch' rows so memory stays flat whatever the size of the history
+        Accepts the filters and with_feedback of fetch_history
+        """
+        log.info("Enter with batch={} with_feedback={} filters={}".format(batch, with_feedback, filters))
+
+        columns = ('id',) + HISTORY_COLUMNS
+        if not with_feedback:
+            columns = tuple([ 'NULL' if column == 'feedback' else column for column in columns ])
+        (statement, params) = self._history_query(columns=columns, **filters)
+        log.debug("statement={} params={}".format(statement, params))
+
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute(statement, params)
+            rows = cursor.fetchmany(batch)
+            while rows:
+                for row in rows:
+                    entry = HistoryEntry._make(row)
+                    if with_feedback:
+                        entry = entry._replace(feedback=decode_feedback(entry.feedback))
+                    yield entry
+                rows = cursor.fetchmany(batch)
 
         finally:
-            self._DB.close()
+            cursor.close()
+
+
+    def get_history(self, **filters):
+        """
+        Return historical tasks in a json format
+        Accepts the filters and with_feedback of fetch_history
+        """
+        log.info("Enter with filters={}".format(filters))
+
+        result = {}
+        for entry in self.fetch_history(**filters):
+            result[entry.id] = record_to_dict(entry)
 
         result_json = json.dumps(result)
         log.debug("return result_json={}".format(result_json))
 
         return result_json
+
+
+    def purge_history(self, keep_rows=None, keep_days=None, keep_per_name=None, batch=500, archive=None):
+        """
+        Deletes history entries according to the retention policies :
+        - keep_rows     : keep the last keep_rows entries (0 purges everything)
+        - keep_days     : keep the entries ended during the last keep_days days
+        - keep_per_name : keep the last keep_per_name entries of each task name
+        An entry is purged as soon as one policy does not keep it.
+
+        Entries are deleted by transactions of 'batch' rows so launchers are
+        never locked out for long. If an archive db file is given, the
+        purged entries are first stored in it as zlib compressed ndjson,
+        one row per batch (see iter_archive).
+        Returns the number of purged entries
+        """
+        log.info("Enter with keep_rows={} keep_days={} keep_per_name={} batch={} archive={}".
+                 format(keep_rows, keep_days, keep_per_name, batch, archive))
+
+        # conditions on history selecting the entries to purge
+        conditions = []
+        cursor = self._connect().cursor()
+        try:
+            if keep_rows is not None:
+                if int(keep_rows) <= 0:
+                    conditions.append(("1", []))
+                else:
+                    cursor.execute('''SELECT id FROM history ORDER BY id DESC LIMIT 1 OFFSET ?''', [int(keep_rows)-1])
+                    row = cursor.fetchone()
+                    if row:
+                        conditions.append(("id < ?", [row[0]]))
+
+            if keep_days is not None:
+                conditions.append(("endtime < ?", [int(time.time() - float(keep_days) * 86400)]))
+
+            if keep_per_name is not None:
+                if int(keep_per_name) <= 0:
+                    conditions.append(("1", []))
+                else:
+                    # id of the oldest entry to keep for each name
+                    cursor.execute('''SELECT taskname, id FROM (SELECT taskname, id, ROW_NUMBER()
+                                   OVER (PARTITION BY taskname ORDER BY id DESC) AS rank FROM history)
+                                   WHERE rank=?''', [int(keep_per_name)])
+                    for (taskname, first_id) in cursor.fetchall():
+                        conditions.append(("taskname IS ? AND id < ?", [taskname, first_id]))
+
+        finally:
+            cursor.close()
+
+        if not conditions:
+            log.debug("nothing to purge")
+            return 0
+
+        if archive:
+            self._attach_archive(archive)
+
+        purged = 0
+        try:
+            for (where, params) in conditions:
+                purged = purged + self._purge_batches(where, params, batch, archive)
+
+        finally:
+            if archive:
+                self._DB.execute("DETACH DATABASE archive")
+
+        log.debug("purged={}".format(purged))
+        return purged
+
+
+    def _attach_archive(self, archive):
+        """
+        Attaches the archive db file as schema 'archive', creating its table
+        """
+        log.debug("attach archive={}".format(archive))
+        self._DB.execute("ATTACH DATABASE ? AS archive", [archive])
+        self._DB.execute('''CREATE TABLE IF NOT EXISTS archive.history_archive (id INTEGER PRIMARY KEY,
+                         first_id INTEGER, last_id INTEGER, rows INTEGER, archivetime INTEGER, data BLOB)''')
+        self._DB.commit()
+
+
+    def _purge_batches(self, where, params, batch, archive):
+        """
+        Deletes the history entries matching where/params, 'batch' entries
+        per transaction, archiving them first if requested
+        Returns the number of deleted entries
+        """
+        purged = 0
+        select = "SELECT id FROM history WHERE "+where+" ORDER BY id LIMIT ?"
+        delete = "DELETE FROM history WHERE id >= ? AND id <= ? AND "+where
+
+        while True:
+            cursor = self._DB.cursor()
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute(select, params + [int(batch)])
+                ids = [ row[0] for row in cursor.fetchall() ]
+                if not ids:
+                    self._DB.commit()
+                    break
+
+                if archive:
+                    cursor.execute("SELECT id, "+", ".join(HISTORY_COLUMNS)+" FROM history"
+                                   " WHERE id >= ? AND id <= ? AND "+where+" ORDER BY id", [ids[0], ids[-1]] + params)
+                    lines = []
+                    for row in cursor:
+                        entry = HistoryEntry._make(row)
+                        entry = entry._replace(feedback=decode_feedback(entry.feedback))
+                        lines.append(json.dumps(entry._asdict()))
+                    data = zlib.compress(("\n".join(lines)+"\n").encode('utf-8'), 9)
+                    cursor.execute('''INSERT INTO archive.history_archive(first_id, last_id, rows, archivetime, data)
+                                   VALUES(?,?,?,?,?)''', [ids[0], ids[-1], len(lines), int(time.time()), data])
+
+                cursor.execute(delete, [ids[0], ids[-1]] + params)
+                rows = cursor.rowcount
+                purged = purged + rows
+                cursor.execute('''DELETE FROM history_kv WHERE historyid >= ? AND historyid <= ?
+                               AND historyid NOT IN (SELECT id FROM history WHERE id >= ? AND id <= ?)''',
+                               [ids[0], ids[-1], ids[0], ids[-1]])
+                self._DB.commit()
+                log.debug("purged batch first_id={} last_id={} rows={}".format(ids[0], ids[-1], rows))
+
+            except Exception as e:
+                # Roll back
+                self._DB.rollback()
+                raise e
+
+            finally:
+                cursor.close()
+
+        return purged
+
+
+    def iter_archive(self, archive=''):
+        """
+        Generator of the history entries stored in an archive db file by
+        purge_history, as dictionaries
+        """
+        log.info("Enter with archive={}".format(archive))
+
+        connection = sqlite3.connect(archive)
+        try:
+            cursor = connection.execute('''SELECT data FROM history_archive ORDER BY id''')
+            for (data,) in cursor:
+                for line in zlib.decompress(data).decode('utf-8').splitlines():
+                    yield json.loads(line)
+
+        finally:
+            connection.close()
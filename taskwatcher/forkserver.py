@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18th, 2026
+@author: cgustave
+
+Fork server (zygote) from the taskwatcher suite
+"""
+
+import logging as log
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+from taskwatcher.database import Database
+from taskwatcher.launch import Launch, command_argv, send_request
+
+# Keys of a launch request : Launch options a client may set (db, debug,
+# supervisor and forkserver are the fork server ones)
+LAUNCH_KEYS = ('command', 'taskid', 'cwd', 'env', 'name', 'info1', 'info2', 'info3', 'feedpath',
+               'timeout', 'feedback_interval', 'compact_size', 'feedback_tail', 'spawn',
+               'sample_interval')
+
+
+class ForkServer(object):
+    """
+    Fork server (zygote) from the taskwatcher suite
+    Called with db, socket (unix socket path to listen on)
+    A pre-warmed process : python started, modules imported and database
+    opened once. Each launch request forks a launcher from it (Launch, as
+    launch.py would do) so a task does not pay the interpreter startup.
+    The launchers are detached : the reply is sent as soon as the launcher
+    is forked, it then watches its task and archives it as launch.py does.
+
+    Protocol : one json request per connection, one json reply
+      { "op" : "launch", "command" : "...", "taskid" : 1, "cwd" : "/path", "env" : { ... }, ... }
+        (other keys : Launch options listed in LAUNCH_KEYS, others are refused)
+        (command : argv list, or a string split as a shell would do)
+        (cwd, env : directory and environment of the task, the caller ones
+         with launch.py)
+      => { "ok" : true, "taskid" : 1, "pid" : <launcher pid> }
+      { "op" : "shutdown" } => { "ok" : true }
+    Errors are replied as { "ok" : false, "error" : "..." }
+    """
+    def __init__(self, db='', socket='', debug=False):
+
+        # create logger
+        log.basicConfig(
+            format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-\
+            10.10s.%(funcName)-20.20s:%(lineno)5d] %(message)s',
+            datefmt='%Y%m%d:%H:%M:%S',
+            filename='debug.log',
+            level=log.NOTSET)
+
+        # Set debug level first
+        if debug:
+            self.debug = True
+            log.basicConfig(level='DEBUG')
+        else:
+            self.debug = False
+            log.basicConfig(level='ERROR')
+
+        log.info("Constructor with db={} socket={} debug={}".format(db, socket, debug))
+
+        # Sanity checks
+        if not (os.path.isfile(db)):
+            log.error("db file {} does not exist".format(db))
+            raise SystemExit
+
+        if not socket:
+            log.error("socket is required")
+            raise SystemExit
+
+        # Public attributs
+        self.db = os.path.abspath(db)
+        self.socket = socket
+        self.launches = 0
+
+        # Private attributs
+        self._DB = Database(db=self.db, debug=debug)
+        self._server = None
+        self._running = False
+
+
+    def serve(self):
+        """
+        Serves the requests until a shutdown request
+        """
+        log.info("Enter")
+
+        # Launchers are reaped by the kernel
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+        # Warm up : sqlite library and schema loaded before the first fork
+        self._DB.get_number_of_tasks()
+
+        if os.path.exists(self.socket):
+            os.unlink(self.socket)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Commands are run as our user : socket only usable by our user
+        umask = os.umask(0o177)
+        try:
+            self._server.bind(self.socket)
+        finally:
+            os.umask(umask)
+        self._server.listen(128)
+        log.debug("listening on socket={}".format(self.socket))
+
+        self._running = True
+        try:
+            while self._running:
+                (client, _) = self._server.accept()
+                with client:
+                    self._serve_client(client)
+        finally:
+            self._server.close()
+            self._server = None
+            if os.path.exists(self.socket):
+                os.unlink(self.socket)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            self._DB.close()
+
+        log.debug("fork server stopped after {} launches".format(self.launches))
+
+
+    def _serve_client(self, client):
+        """
+        Reads one request from the client connection and replies
+        """
+        with client.makefile('rb') as F:
+            line = F.readline()
+        if not line:
+            return
+        try:
+            reply = self.handle_request(json.loads(line), client=client)
+        except (ValueError, TypeError) as e:
+            reply = { 'ok' : False, 'error' : "invalid request: {}".format(e) }
+        try:
+            client.sendall(json.dumps(reply).encode()+b"\n")
+        except OSError as e:
+            log.debug("client gone error={}".format(e))
+
+
+    def handle_request(self, request, client=None):
+        """
+        Returns the reply (dictionary) for the request (dictionary)
+        """
+        log.info("Enter with request={}".format(request))
+
+        op = request.get('op') if isinstance(request, dict) else None
+        if op == 'launch':
+            options = { k : v for (k, v) in request.items() if k != 'op' }
+            unknown = sorted(set(options) - set(LAUNCH_KEYS))
+            if unknown:
+                log.warning("refused options={}".format(unknown))
+                return { 'ok' : False, 'error' : "unknown options {}".format(', '.join(unknown)) }
+            return self.launch(client=client, **options)
+        if op == 'shutdown':
+            self._running = False
+            return { 'ok' : True }
+
+        log.warning("unknown op={}".format(op))
+        return { 'ok' : False, 'error' : "unknown op {}".format(op) }
+
+
+    def launch(self, command='', taskid=None, cwd=None, env=None, client=None, **options):
+        """
+        Forks a launcher running command as task taskid (see Launch for the
+        options), in directory cwd with environment env (default : the fork
+        server ones). The reservation and the options are checked before the fork.
+        Returns the reply dictionary
+        """
+        log.info("Enter with command={} taskid={} cwd={} options={}".format(command, taskid, cwd, options))
+
+        argv = command_argv(command)
+        if not argv:
+            return { 'ok' : False, 'error' : "command is required" }
+
+        if not taskid:
+            if '--feedback' in argv:
+                return { 'ok' : False, 'error' : "taskid is required if task is expected to feedback, --feedback is set" }
+            taskid = self._DB.reserve_task(taskname=options.get('name') or '')
+            log.debug("automatique reservation gave taskid={}".format(taskid))
+
+        if not self._DB.is_task_reserved(taskid=taskid):
+            log.warning("taskid={} is not clear to start".format(taskid))
+            return { 'ok' : False, 'error' : "taskid={} is not clear to start".format(taskid) }
+
+        if env is not None and not isinstance(env, dict):
+            return { 'ok' : False, 'error' : "env should be an object" }
+
+        if cwd and options.get('feedpath'):
+            options['feedpath'] = os.path.join(cwd, options['feedpath'])
+        try:
+            launcher = Launch(taskid=taskid, db=self.db, debug=self.debug, **options)
+        except SystemExit as e:
+            log.warning("taskid={} invalid options={}".format(taskid, options))
+            return { 'ok' : False, 'error' : "taskid={} invalid options {}".format(taskid, e) }
+
+        pid = os.fork()
+        if not pid:
+            self._launcher(launcher=launcher, command=argv, cwd=cwd, env=env, client=client)
+
+        self.launches = self.launches + 1
+        log.debug("taskid={} launcher pid={}".format(taskid, pid))
+        return { 'ok' : True, 'taskid' : taskid, 'pid' : pid }
+
+
+    def _launcher(self, launcher=None, command='', cwd=None, env=None, client=None):
+        """
+        Forked launcher : runs the task as launch.py does, never returns
+        """
+        status = 1
+        try:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            self._server.close()
+            if client:
+                client.close()
+            if cwd:
+                os.chdir(cwd)
+            if env is not None:
+                # Inherited by the task
+                os.environ.clear()
+                os.environ.update({ str(k) : str(v) for (k, v) in env.items() })
+            if launcher.execute(command=command):
+                status = 0
+        except BaseException as e:
+            log.error("taskid={} launcher error={}".format(launcher.taskid, e))
+        finally:
+            os._exit(status)
+
+
+
+if __name__ == '__main__': #pragma: no cover
+
+    parser = argparse.ArgumentParser(description='Fork server (zygote) from the taskwatcher suite.')
+    parser.add_argument('--db', help="sqlite db file", required=True)
+    parser.add_argument('--socket', help="unix socket to listen on", required=True)
+    parser.add_argument('--shutdown', help="stops a running fork server", action="store_true")
+    parser.add_argument('--debug', '-d', help="Debugging on", action="store_true")
+    args = parser.parse_args()
+
+    if args.shutdown:
+        reply = send_request(path=args.socket, request={ 'op' : 'shutdown' })
+        print(json.dumps(reply))
+        sys.exit(0 if reply.get('ok') else 1)
+
+    server = ForkServer(db=args.db, socket=args.socket, debug=args.debug)
+    server.serve()
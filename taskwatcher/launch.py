@@ -8,22 +8,37 @@ launcher from the taskwatcher suite
 """
 
 import logging as log
+import json
 import os
 import sys
-import json
-import psutil
+import select
+import shlex
+import signal
+import socket
 import time
 import argparse
-from taskwatcher.database import Database
+from taskwatcher.database import Database, summarize_samples
+from taskwatcher.parse import Parse
+from taskwatcher.proctree import ProcTree
+from taskwatcher.watch import Watch
+
+# How the command process is started
+SPAWN = ('fork', 'posix_spawn')
 
 class Launch(object):
     """
     Launcher from taskwatcher suite
     Called with taskid, db
-    Optional : name, feedpath, timeout
+    Optional : name, feedpath, timeout, feedback_interval, compact_size, feedback_tail,
+               supervisor (unix socket of a supervisor daemon to hand the task off to),
+               forkserver (unix socket of a fork server to start the launcher from),
+               spawn (fork|posix_spawn : how the command process is started),
+               sample_interval (seconds between 2 resource samples of the task)
     Requirement : a taskid should have been reserved
     """
-    def __init__(self, taskid='', db='', name='', info1='', info2='', info3='', feedpath=None, timeout=30, debug=False):
+    def __init__(self, taskid='', db='', name='', info1='', info2='', info3='', feedpath=None, timeout=30,
+                 feedback_interval=5, compact_size=None, feedback_tail=0, supervisor=None, forkserver=None, spawn='fork',
+                 sample_interval=None, debug=False):
 
         # create logger
         log.basicConfig(
@@ -51,8 +66,12 @@ class Launch(object):
                print ("feedpath does not exist or is not a directory\n")
                raise SystemExit
 
-        log.info("Constructor with taskid={} db={}  name={} info1={} info2={} info3={} feedpath={} timeout={} debug={}".
-          format(taskid, db, name, info1, info2, info3, feedpath, timeout, debug))
+        if spawn not in SPAWN:
+            print ("spawn should be one of {}\n".format(", ".join(SPAWN)))
+            raise SystemExit
+
+        log.info("Constructor with taskid={} db={}  name={} info1={} info2={} info3={} feedpath={} timeout={} feedback_interval={} compact_size={} feedback_tail={} supervisor={} forkserver={} spawn={} sample_interval={} debug={}".
+          format(taskid, db, name, info1, info2, info3, feedpath, timeout, feedback_interval, compact_size, feedback_tail, supervisor, forkserver, spawn, sample_interval, debug))
  
         # Public Attributs
         self.taskid = taskid
@@ -66,15 +85,59 @@ class Launch(object):
             timeout = 30 
             
         self.timeout = int(timeout)
+        if feedback_interval is None:
+            feedback_interval = 5
+
+        # Minimum delay in seconds between 2 writes of the feedback in db
+        self.feedback_interval = float(feedback_interval)
+
+        # Feedback file is compacted above this size in bytes (None: never)
+        self.compact_size = None
+        if compact_size:
+            self.compact_size = int(compact_size)
+
+        # Bytes from the end of the feedback file kept in history (0: none)
+        self.feedback_tail = int(feedback_tail or 0)
+
+        # Supervisor daemon unix socket (None: the task is watched by this process)
+        self.supervisor = supervisor
+
+        # Fork server unix socket (None: this process is the launcher)
+        self.forkserver = forkserver
+
+        # fork : os.fork() then exec, posix_spawn : os.posix_spawnp (no copy of our memory mappings)
+        self.spawn = spawn
+
+        # Seconds between 2 resource samples of the task tree (None: no sampling)
+        # Above max_samples, samples are merged by pairs and the interval doubled
+        self.sample_interval = None
+        if sample_interval:
+            self.sample_interval = float(sample_interval)
+        self.max_samples = 720
         self.command = None
         self.forked_pid = None 
         self.will_feedback = False
         self.starttime = None
         self.father_check_delay = 2
+        self.watch_interval = 0.5
+        self.kill_grace = 5
+        self.pidfd = True
 
         # Private attributs
         self._DB = Database(db=db, debug=debug) 
-        self._check_feedback_retry = 0
+        self._lastbeat = None
+        self._termerror = "TBD"
+        self._exit_fd = None
+        self._exit_status = None
+        self._sigchld = None
+        self._parser = Parse(debug=debug)
+        self._feedback_pending = False
+        self._feedback_written = None
+        self._compacted_size = 0
+        self._watch = None
+        self._sample_start = None
+        self._next_sample = None
+        self._last_usage = None
 
 
     def clear_to_start_task(self):
@@ -94,6 +157,8 @@ class Launch(object):
     def execute(self, command=""):
         """
         Execute provided command in a child process
+        command is the argv list, or a string split as a shell would
+        (see command_argv)
         If program is expected to feedback, it should have an option --feedback
         to provide feedback file name.
         If feedback is expected, a reservation is required (so feedback file is
@@ -101,10 +166,28 @@ class Launch(object):
         """
         log.info("Enter with command={}".format(command))
 
+        argv = command_argv(command)
+        if not argv:
+            log.error("command is required")
+            sys.exit("command is required")
+        self.command = argv
+
         # Learn if task is supposed to feedback
         if self._task_will_feedback(command=command):
             self.will_feedback = True
 
+        if self.supervisor:
+            ignored = self._supervisor_ignored_options()
+            if ignored:
+                log.warning("options {} are not supported with a supervisor, ignored".format(", ".join(ignored)))
+                print ("options {} are not supported with a supervisor, ignored\n".format(", ".join(ignored)))
+            return self.handoff(command=command, path=self.supervisor, cwd=os.getcwd(), env=dict(os.environ))
+        if self.forkserver:
+            return self.handoff(command=command, path=self.forkserver, cwd=os.getcwd(), env=dict(os.environ),
+                                feedback_interval=self.feedback_interval,
+                                compact_size=self.compact_size, spawn=self.spawn,
+                                sample_interval=self.sample_interval)
+
         # Sanity
         if not self.taskid:
             if self.will_feedback:
@@ -124,19 +207,87 @@ class Launch(object):
             log.error("taskid={} is not clear to start".format(self.taskid))
             sys.exit("taskid={} is not clear to start".format(self.taskid))
 
-        pid = os.fork()
+        pid = self.start_child(argv=argv)
         self.forked_pid = pid
 
+        log.debug("Father : started child with pid={} spawn={}".format(pid, self.spawn))
+        result = self.father_loop()
+        return result
+
+
+    def start_child(self, argv=None):
+        """
+        Starts argv in a child process and returns its pid
+        - fork : os.fork() then exec from the child (see child)
+        - posix_spawn : os.posix_spawnp, the child does not get a copy of the
+          father memory mappings (vfork-like) so the start does not slow
+          down as the father grows. An exec error is raised in the father.
+        The child runs in its own session and process group (see ProcTree)
+        """
+        log.info("Enter with argv={} spawn={}".format(argv, self.spawn))
+
+        if self.spawn == 'posix_spawn':
+            try:
+                return os.posix_spawnp(argv[0], argv, os.environ, setsid=True)
+            except OSError as e:
+                log.error("could not spawn argv={} error={}".format(argv, e))
+                sys.exit("could not spawn {} error={}".format(argv[0], e))
+
+        pid = os.fork()
         if not pid:
             log.debug("Son : I am a just forked child process")
-            self.child(command=command)
+            self.child(command=argv)
             sys.exit(1)
-
-        log.debug("Father : Forked child with pid={}".format(pid)) 
-        result = self.father_loop()
-        return result
+        return pid
     
        
+    def _supervisor_ignored_options(self):
+        """
+        Returns the list of the options set which the supervisor daemon does
+        not support (its tasks are not compacted, sampled or posix_spawned)
+        """
+        ignored = []
+        if self.compact_size:
+            ignored.append('compact_size')
+        if self.sample_interval:
+            ignored.append('sample_interval')
+        if self.spawn != 'fork':
+            ignored.append('spawn')
+        return ignored
+
+
+    def handoff(self, command="", path=None, **options):
+        """
+        Hands the task off to the daemon listening on unix socket path :
+        - supervisor (see supervisor.py) : it starts and watches the command
+        - fork server (see forkserver.py) : it forks a launcher for the command
+          (forked_pid is then the launcher pid)
+        options are added to the request. Same reservation rules as execute.
+        Returns True once the daemon has started the command
+        """
+        log.info("Enter with command={} path={} options={}".format(command, path, options))
+
+        request = { 'op' : 'launch', 'command' : command_argv(command), 'taskid' : self.taskid or None,
+                    'feedpath' : self.feedpath, 'timeout' : self.timeout, 'name' : self.name,
+                    'info1' : self.info1, 'info2' : self.info2, 'info3' : self.info3,
+                    'feedback_tail' : self.feedback_tail }
+        request.update(options)
+        try:
+            reply = send_request(path=path, request=request)
+        except (OSError, ValueError) as e:
+            log.error("path={} error={}".format(path, e))
+            sys.exit("path={} error={}".format(path, e))
+
+        if not reply.get('ok'):
+            log.error("path={} refused taskid={} error={}".format(path, self.taskid, reply.get('error')))
+            sys.exit("path={} refused taskid={} error={}".format(path, self.taskid, reply.get('error')))
+
+        self.taskid = reply['taskid']
+        self.forked_pid = reply['pid']
+        log.debug("taskid={} started by path={} pid={}".format(self.taskid, path, self.forked_pid))
+        return True
+
+
     def father_loop(self):
         """
         Father code after fork
@@ -145,17 +296,42 @@ class Launch(object):
 
         self._move_task_to_status_running()
 
+        # Heartbeat : feedback file writes are notified by the watcher
+        watch = None
+        if self.will_feedback:
+            watch = Watch(file=self.updatefile_name(), min_interval=self.watch_interval, debug=self.debug)
+        self._watch = watch
+        self._lastbeat = time.monotonic()
+        if self.sample_interval:
+            self._sample_start = self._lastbeat
+            self._next_sample = self._lastbeat + self.sample_interval
+            self._last_usage = {}
+
+        # Child exit : pidfd (or SIGCHLD) wakes the father up immediately
+        self._watch_child_exit()
+
         child_healthy = True
         while child_healthy:
 
             child_healthy = self.father_check_child_health()
-            time.sleep(self.father_check_delay)
+            if child_healthy:
+                self.father_wait(watch)
             log.debug("Father: still alive, child_healthy={}".format(child_healthy))
 
         log.debug("Father: child pid={} is not healthy".format(self.forked_pid))
-
-        # Prevent zombies!  Reap the child after exit
-        pid, status = os.waitpid(0, 0)
+        if watch:
+            watch.close()
+            self._watch = None
+
+        if self._termerror == 'timeout':
+            pid, status = self._kill_child()
+        elif self._exit_status is not None:
+            # Already reaped by the process check
+            pid, status = self.forked_pid, self._exit_status
+        else:
+            # Prevent zombies!  Reap the child after exit
+            pid, status = os.waitpid(self.forked_pid, 0)
+        self._unwatch_child_exit()
         log.debug("Child exited: pid {} returned status {}".format(pid,status))
         if pid == self.forked_pid:
             self._remove_running_task(pid=pid,status=status)
@@ -164,17 +340,47 @@ class Launch(object):
             sys.exit("should not see this")
 
 
+    def father_wait(self, watch=None):
+        """
+        Waits until the next child check : father_check_delay seconds, or
+        less if the heartbeat deadline (last feedback write + timeout) or the
+        next resource sample comes first, or the child exits. Feedback writes notified meanwhile refresh
+        the heartbeat without waking up the checks.
+        """
+        log.info("Enter")
+
+        wakeup = []
+        if self._exit_fd is not None:
+            wakeup.append(self._exit_fd)
+
+        end = time.monotonic() + self.father_check_delay
+        if self._next_sample is not None:
+            end = min(end, self._next_sample)
+        while True:
+            now = time.monotonic()
+            deadline = end
+            if watch:
+                deadline = min(end, self._lastbeat + self.timeout)
+            if now >= deadline:
+                return
+
+            if not watch:
+                self._child_exit_ready(timeout=deadline - now)
+                return
+
+            if watch.wait(timeout=deadline - now, wakeup=wakeup):
+                self._lastbeat = watch.lastwrite
+            elif self._child_exit_ready():
+                return
+
+
     def father_check_child_health(self):
         """
         Returns True if child is alive
         If childs provide feedback, check the heartbeat   
-        Heartbeat should be checked from feedback file update time
+        Heartbeat is the last feedback file write seen by the watcher
         """
         log.info("Enter")
-   
-        # Avoid race condition, make sure child had time to
-        # open the feedback file
-        time.sleep(1)
 
         # check process status
         healthy = self.father_checks_child_process_status_ok()
@@ -189,6 +395,12 @@ class Launch(object):
 
         if healthy:
             self._update_running_task()
+            if self.will_feedback:
+                self._ingest_feedback()
+                if self.compact_size:
+                    self._compact_feedback()
+            if self._next_sample is not None and time.monotonic() >= self._next_sample:
+                self._sample_task()
 
         log.debug("healthy={}".format(healthy))
         return healthy
@@ -196,58 +408,155 @@ class Launch(object):
 
     def father_checks_child_process_status_ok(self):
         """
-        Check process pid is known and child is not a zombie
+        Check child has not exited, reaps it if it has (no zombie)
+        Once the child has exited, the task is alive while a process of its
+        process group is (one /proc scan per check)
         """
         log.info("Enter")
 
         healthy = True
-        # check process still exists
-        if psutil.pid_exists(self.forked_pid):
-            log.debug("Father: taskid={} process pid={} exists".
-                        format(self.taskid, self.forked_pid))
-
-            # Process may be in defunct state if child has finished
-            status = psutil.Process(self.forked_pid).status()
-            if status == 'zombie':
-                log.warning("Father: taskid={} process pid={} status={}".
-                            format(self.taskid, self.forked_pid, status))
+        if self._exit_status is None:
+            try:
+                pid, status = os.waitpid(self.forked_pid, os.WNOHANG)
+            except ChildProcessError as e:
+                log.warning("Father: taskid={} process pid={} error={}".
+                            format(self.taskid, self.forked_pid, e))
+                pid, status = self.forked_pid, -1
+
+            if pid:
+                log.debug("Father: taskid={} process pid={} has exited status={}".
+                          format(self.taskid, self.forked_pid, status))
+                self._exit_status = status
+                # Nothing more to be notified of
+                self._unwatch_child_exit()
+
+        if self._exit_status is not None:
+            group = ProcTree(debug=self.debug).group(self.forked_pid)
+            if group:
+                log.debug("Father: taskid={} process group={} still alive pids={}".
+                          format(self.taskid, self.forked_pid, sorted(group)))
+            else:
                 healthy = False
 
-        else:
-            log.debug("Father: taskid={} process pid={} is dead".
-                      format(self.taskid, self.forked_pid))
-            healthy = False
-
         log.debug("healthy={}".format(healthy))
         return healthy
 
 
+    def _watch_child_exit(self):
+        """
+        Gets a file descriptor readable when the child exits : a pidfd
+        (linux 5.3+) or else a pipe written on SIGCHLD (signal wakeup fd).
+        Without both (not in main thread), child is only checked periodically.
+        A child which exited before is found by the first process check.
+        """
+        log.info("Enter")
+
+        if self.pidfd and hasattr(os, 'pidfd_open'):
+            try:
+                self._exit_fd = os.pidfd_open(self.forked_pid)
+                log.debug("pidfd={} for pid={}".format(self._exit_fd, self.forked_pid))
+                return
+            except OSError as e:
+                log.debug("no pidfd error={}, using SIGCHLD".format(e))
+
+        (rfd, wfd) = os.pipe()
+        os.set_blocking(rfd, False)
+        os.set_blocking(wfd, False)
+        try:
+            previous_fd = signal.set_wakeup_fd(wfd)
+            previous_handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        except ValueError as e:
+            log.warning("no child exit notification error={}".format(e))
+            os.close(rfd)
+            os.close(wfd)
+            return
+
+        self._sigchld = (wfd, previous_fd, previous_handler)
+        self._exit_fd = rfd
+        log.debug("SIGCHLD wakeup fd={}".format(rfd))
+
+
+    def _child_exit_ready(self, timeout=0):
+        """
+        Waits up to timeout seconds for the child exit notification
+        Returns True if notified (the SIGCHLD pipe is drained)
+        """
+        if self._exit_fd is None:
+            time.sleep(timeout)
+            return False
+
+        (ready, _, _) = select.select([self._exit_fd], [], [], timeout)
+        if ready and self._sigchld:
+            try:
+                while os.read(self._exit_fd, 512):
+                    pass
+            except BlockingIOError:
+                pass
+        return bool(ready)
+
+
+    def _unwatch_child_exit(self):
+        """
+        Releases the child exit notification
+        """
+        log.info("Enter")
+
+        if self._sigchld:
+            (wfd, previous_fd, previous_handler) = self._sigchld
+            signal.signal(signal.SIGCHLD, previous_handler)
+            signal.set_wakeup_fd(previous_fd)
+            os.close(wfd)
+            self._sigchld = None
+
+        if self._exit_fd is not None:
+            os.close(self._exit_fd)
+            self._exit_fd = None
+
+
     def father_checks_child_feedback_ok(self):
         """
         If process is supposed to feedback,
         check if it updates feedbackfile in time
+        (last write, or start, seen less than timeout seconds ago)
         """
         log.info("Enter")
 
         healthy = True
-        try:
-            currenttime = int(time.time())
-            updatetime = int(os.path.getmtime(self.updatefile_name()))
-            
-            if (currenttime - updatetime) > self.timeout:
-                log.debug("taskid {} pid {} has timeout: {} > {}"
-                       .format(self.taskid, self.forked_pid, (currenttime - updatetime), self.timeout))
-                healthy = False
+        silence = time.monotonic() - self._lastbeat
+        if silence >= self.timeout:
+            log.debug("taskid {} pid {} has timeout: {:.3f} >= {}"
+                   .format(self.taskid, self.forked_pid, silence, self.timeout))
+            self._termerror = 'timeout'
+            healthy = False
 
-        except Exception as e:
-            log.warning("attempt={} : error: {}".format(self._check_feedback_retry, e))
-            self._check_feedback_retry = self._check_feedback_retry + 1
+        return healthy
 
-        if self._check_feedback_retry > 2:
-            log.error("Could not check feedback file after 3 attempts")
-            sys.exit("Could not check feedback file after 3 attempts")
 
-        return healthy
+    def _kill_child(self):
+        """
+        Terminates the child with its process tree (SIGTERM, then SIGKILL
+        after kill_grace seconds)
+        Returns (pid, status) of the reaped child
+        """
+        log.info("Enter")
+
+        log.warning("taskid={} pid={} killed".format(self.taskid, self.forked_pid))
+        ProcTree(debug=self.debug).kill(self.forked_pid, signal.SIGTERM)
+        status = self._exit_status
+        end = time.monotonic() + self.kill_grace
+        while time.monotonic() < end:
+            if status is None:
+                pid, status = os.waitpid(self.forked_pid, os.WNOHANG)
+                if not pid:
+                    status = None
+            if status is not None and not ProcTree(debug=self.debug).tree(self.forked_pid):
+                return (self.forked_pid, status)
+            time.sleep(0.1)
+
+        ProcTree(debug=self.debug).kill(self.forked_pid, signal.SIGKILL)
+        if status is None:
+            pid, status = os.waitpid(self.forked_pid, 0)
+        return (self.forked_pid, status)
 
 
     def child(self, command=""):
@@ -261,10 +570,12 @@ class Launch(object):
         # ./launch.py --taskid 1 --db sqlite.db -- tests/testprog.py --scenario sleeping
         #  ==> cmd_list ['tests/testprog.py', '--scenario', 'sleeping']
         
-        cmd_list = command.split()
+        cmd_list = command_argv(command)
         log.debug("cmd_list {}".format(cmd_list))
 
         try:
+            # Own session and process group : the task tree is killed as a whole
+            os.setsid()
             log.debug("Child : exec with command={}".format(command))
             env_path = os.getenv('PATH')
             log.debug("Child : PATH={}".format(env_path))
@@ -284,7 +595,7 @@ class Launch(object):
         """
         log.info ("Enter with command={}".format(command))
 
-        cmd_split = command.split()
+        cmd_split = command_argv(command)
 
         if '--feedback' in cmd_split:
             log.debug("task will feedback")
@@ -315,6 +626,8 @@ class Launch(object):
         update['info3'] = self.info3
         update['pid'] = self.forked_pid
         update['feedback']= self.will_feedback
+        if self.will_feedback:
+            update['feedfile'] = self.updatefile_name()
         self.starttime =  int(time.time())
         update['starttime'] = self.starttime 
         update['timeout']= self.timeout 
@@ -340,29 +653,134 @@ class Launch(object):
         """
         log.info("Enter with pid={} status={}".format(pid,status))
 
-        entry = {}
-        task = json.loads(self._DB.get_tasks(taskid=self.taskid))
+        feedfile = self.updatefile_name() if self.will_feedback else None
+        archive_task(database=self._DB, taskid=self.taskid, termsignal=status, termerror=self._termerror,
+                     parser=self._parser, feedfile=feedfile, feedback_tail=self.feedback_tail,
+                     with_stats=bool(self.sample_interval))
+
+
+    def _sample_task(self):
+        """
+        Stores a resource sample of the task tree (one /proc scan) : cpu and
+        io as deltas from the previous sample, rss and threads as read.
+        Long tasks keep at most max_samples : samples are merged by pairs
+        and the interval is doubled.
+        """
+        log.info("Enter")
+
+        now = time.monotonic()
+        tree = ProcTree(debug=self.debug)
+        usage = tree.usage(tree.tree(self.forked_pid))
+
+        sample = dict(usage)
+        sample['elapsed'] = int((now - self._sample_start) * 1000)
+        for key in ('cpu', 'io_read', 'io_write'):
+            # Processes leaving the tree take their counters with them
+            sample[key] = max(0, usage[key] - self._last_usage.get(key, 0))
+        self._last_usage = usage
+
+        count = self._DB.add_task_sample(taskid=self.taskid, sample=sample)
+        if count >= self.max_samples:
+            self._DB.downsample_task_samples(taskid=self.taskid)
+            self.sample_interval = self.sample_interval * 2
+            log.debug("taskid={} downsampled, sample_interval={}".format(self.taskid, self.sample_interval))
+
+        self._next_sample = now + self.sample_interval
+
+
+    def _ingest_feedback(self):
+        """
+        Parses what the child appended to its feedback file and stores the
+        resulting key/values in the feedbacks table.
+        The database is only written if the parsed state has changed and not
+        more than once every feedback_interval seconds.
+        Returns True if the feedback was written
+        """
+        log.info("Enter")
+
+        if self._parser.poll_file(file=self.updatefile_name()):
+            self._feedback_pending = True
+
+        if not self._feedback_pending:
+            log.debug("feedback unchanged")
+            return False
+
+        now = time.monotonic()
+        if self._feedback_written is not None and (now - self._feedback_written) < self.feedback_interval:
+            log.debug("feedback changed, write delayed")
+            return False
+
+        self._DB.update_feedback(taskid=self.taskid, feedback=self._parser.get_data())
+        self._feedback_pending = False
+        self._feedback_written = now
+        return True
+
+
+    def _compact_feedback(self):
+        """
+        Compacts the feedback file when it is above compact_size and has at
+        least doubled since the previous compaction (a large state does not
+        get compacted on every check)
+        Only done if the child writes the file in append mode
+        Returns True if the file was compacted
+        """
+        log.info("Enter")
+
+        feedfile = self.updatefile_name()
+        try:
+            size = os.path.getsize(feedfile)
+        except OSError as e:
+            log.debug("no feedback file error={}".format(e))
+            return False
+
+        if size <= self.compact_size or size < 2 * self._compacted_size:
+            return False
+
+        if not self._writer_appends(feedfile):
+            log.warning("taskid={} feedback file is not written in append mode, no compaction".format(self.taskid))
+            self._compacted_size = size
+            return False
+
+        (before, after) = self._parser.compact_file(file=feedfile)
+        log.debug("taskid={} feedback compacted size={} to size={}".format(self.taskid, before, after))
 
-        # taskid must be a string to be used in dictionary
-        taskid = str(self.taskid)
+        # The compaction is not a heartbeat of the task
+        if self._watch:
+            self._watch.ignore_write()
+        self._compacted_size = after
+        return True
+
+
+    def _writer_appends(self, feedfile):
+        """
+        Returns True if the child has not opened feedfile for writing other
+        than in append mode (checked from /proc/<pid>/fdinfo)
+        """
+        log.info("Enter with feedfile={}".format(feedfile))
 
-        # Add history entry from the latest task info
-        entry['taskid'] = taskid
-        entry['taskname'] = task[taskid]['name']
-        entry['info1'] = task[taskid]['info1']
-        entry['info2'] = task[taskid]['info2']
-        entry['info3'] = task[taskid]['info3']
-        entry['termsignal'] = status
-        entry['termerror'] = "TBD"
-        entry['starttime'] = task[taskid]['starttime']
-        endtime = int(time.time())
-        entry['endtime'] = endtime
-        entry['duration'] = endtime - task[taskid]['starttime']
-        entry['feedback'] = "to be implemented"
-        self._DB.add_history(entry=entry)
+        target = os.path.realpath(feedfile)
+        fddir = "/proc/{}/fd".format(self.forked_pid)
+        try:
+            for fd in os.listdir(fddir):
+                try:
+                    if os.readlink(os.path.join(fddir, fd)) != target:
+                        continue
+                    with open("/proc/{}/fdinfo/{}".format(self.forked_pid, fd)) as F:
+                        for line in F:
+                            if line.startswith('flags:'):
+                                flags = int(line.split()[1], 8)
+                except OSError:
+                    # fd closed meanwhile
+                    continue
+                if (flags & os.O_ACCMODE) != os.O_RDONLY and not (flags & os.O_APPEND):
+                    log.debug("fd={} flags={:o} is not append".format(fd, flags))
+                    return False
+
+        except OSError as e:
+            log.warning("could not check child files error={}".format(e))
+            return False
 
-        # Delete task
-        self._DB.delete_task(taskid=taskid)
+        return True
 
 
     def updatefile_name(self):
@@ -375,6 +793,101 @@ class Launch(object):
         return update_file_name
 
 
+
+def command_argv(command=None):
+    """
+    Returns the argv list of command : a list is kept as is (the arguments
+    given after -- to launch.py), a string is split as a shell would do
+    (a quoted argument is kept whole)
+    """
+    if isinstance(command, (list, tuple)):
+        return [ str(arg) for arg in command ]
+    return shlex.split(command or "")
+
+
+def feedback_file_tail(file='', size=0):
+    """
+    Returns the last size bytes of the feedback file as text
+    None if not requested or not readable
+    """
+    if not size:
+        return None
+    try:
+        with open(file, 'rb') as F:
+            end = F.seek(0, os.SEEK_END)
+            F.seek(max(0, end - size))
+            return F.read().decode('utf-8', 'replace')
+    except IOError as e:
+        log.debug("could not read feedback file tail error={}".format(e))
+        return None
+
+
+def archive_task(database=None, taskid=None, termsignal='', termerror=None, parser=None,
+                 feedfile=None, feedback_tail=0, with_stats=False):
+    """
+    Task has ended (launch.py, supervisor.py) : archives it in history from
+    its latest task info and deletes it.
+    If feedfile is given, the final state of the parser and the file tail
+    are kept, with_stats keeps the summary of the task samples.
+    Returns False if the task is unknown
+    """
+    log.info("Enter with taskid={} termsignal={}".format(taskid, termsignal))
+
+    tasks = database.fetch_tasks(taskid=taskid)
+    if not tasks:
+        log.warning("taskid={} is unknown, not archived".format(taskid))
+        return False
+    task = tasks[0]
+
+    # Add history entry from the latest task info
+    entry = {}
+    entry['taskid'] = task.id
+    entry['taskname'] = task.name
+    entry['info1'] = task.info1
+    entry['info2'] = task.info2
+    entry['info3'] = task.info3
+    entry['termsignal'] = termsignal
+    entry['termerror'] = termerror
+    entry['starttime'] = task.starttime
+    endtime = int(time.time())
+    entry['endtime'] = endtime
+    entry['duration'] = endtime - task.starttime
+    entry['feedback'] = None
+    if feedfile:
+        # Final state, including a last line without end of line
+        parser.poll_file(file=feedfile, final=True)
+        entry['feedback'] = dict(parser.dict)
+        entry['tail'] = feedback_file_tail(file=feedfile, size=feedback_tail)
+    if with_stats:
+        # Samples are deleted with the task, their summary is archived
+        entry['stats'] = summarize_samples(database.fetch_task_samples(taskid=task.id))
+    database.add_history(entry=entry)
+
+    # Delete task
+    database.delete_task(taskid=task.id)
+    return True
+
+
+def send_request(path='', request=None, timeout=10):
+    """
+    Sends one request (dictionary) to the daemon (supervisor.py,
+    forkserver.py) listening on unix socket path and returns its reply
+    (dictionary)
+    """
+    log.info("Enter with path={} request={}".format(path, request))
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall(json.dumps(request).encode()+b"\n")
+        with client.makefile('rb') as F:
+            line = F.readline()
+
+    if not line:
+        raise ConnectionError("no reply from {}".format(path))
+    return json.loads(line)
+
+
                  
 if __name__ == '__main__': #pragma: no cover
 
@@ -387,6 +900,13 @@ if __name__ == '__main__': #pragma: no cover
     parser.add_argument('--db', help="sqlite db file", required=True)
     parser.add_argument('--feedpath', help="Path where feedback file is expected")
     parser.add_argument('--timeout', help="timeout timer for the task")
+    parser.add_argument('--feedback-interval', help="minimum seconds between 2 feedback writes in db (default 5)")
+    parser.add_argument('--compact-size', help="compacts the feedback file above this size in bytes (append mode writers only)")
+    parser.add_argument('--feedback-tail', help="bytes from the end of the feedback file kept in history (default 0)")
+    parser.add_argument('--supervisor', help="unix socket of a supervisor daemon (supervisor.py) to hand the task off to")
+    parser.add_argument('--forkserver', help="unix socket of a fork server (forkserver.py) to start the launcher from")
+    parser.add_argument('--spawn', help="how the command process is started (default fork)", choices=SPAWN, default='fork')
+    parser.add_argument('--sample-interval', help="seconds between 2 resource samples of the task (default none)")
     parser.add_argument('--debug', '-d', help="Debugging on", action="store_true")
 
 
@@ -394,19 +914,11 @@ if __name__ == '__main__': #pragma: no cover
     parser.add_argument('command', nargs=argparse.REMAINDER, help="Our command to run (ex: ./command -option1 -option2 foo)")
     args = parser.parse_args()
 
-    # Retrieve command line to run with its options after the --
-    command_line = ""
-    i=1
-    for item in args.command:
-        if item=='--':
-            continue
-        if i==1:
-            space=""
-        else:
-            space=" "
-        command_line=command_line+space+str(item)
-        i=i+1
-    print ("Command_line={}".format(command_line))
+    # Retrieve command to run with its arguments after the --, kept as given
+    command = list(args.command)
+    if command and command[0] == '--':
+        command = command[1:]
+    print ("Command_line={}".format(shlex.join(command)))
 
     # If no name is provided, use program name
     #if not args.name:
@@ -415,8 +927,11 @@ if __name__ == '__main__': #pragma: no cover
 
     launcher=Launch(taskid=args.taskid, name=args.name, info1=args.info1,
                     info2=args.info2, info3=args.info3, db=args.db,
-                    feedpath=args.feedpath, timeout=args.timeout, debug=args.debug)
+                    feedpath=args.feedpath, timeout=args.timeout,
+                    feedback_interval=args.feedback_interval, compact_size=args.compact_size,
+                    feedback_tail=args.feedback_tail, supervisor=args.supervisor, forkserver=args.forkserver, spawn=args.spawn,
+                    sample_interval=args.sample_interval, debug=args.debug)
 
-    launcher.execute(command_line)
+    launcher.execute(command)
 
 
@@ -12,13 +12,104 @@ import argparse
 import json
 import sys
 import re
+import os
+import fcntl
+import threading
+import ctypes
+import ctypes.util
+from collections import OrderedDict
+
+# Feedback lines : [key]value ([] clears all), matched on a block of lines
+# in bytes. Leading blanks are ignored, value is right stripped after decoding.
+FEEDBACK_LINES = re.compile(rb"^[ \t\r\f\v\x1c-\x1f]*\[([A-Za-z0-9\-_]*)\]([^\n]*)", re.M)
+
+# fallocate mode (linux/falloc.h) removing a block aligned range of a file
+FALLOC_FL_COLLAPSE_RANGE = 0x08
+
+# fallocate(fd, mode, offset, len) from libc (None if not available)
+try:
+    _fallocate = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError):
+    _fallocate = None
+
+
+class ParseCache(object):
+    """
+    Bounded LRU cache of parsed feedback files, shared between Parse objects
+    (and threads). Entries are keyed on the file identity and modification :
+    (device, inode, size, mtime_ns) so a changed file is never served.
+    """
+
+    def __init__(self, size=256):
+        self.size = int(size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Private attributs
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def key(stat):
+        """
+        Returns the cache key of a file from its os.stat result
+        """
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+    def get(self, key):
+        """
+        Returns a copy of the cached key/values for key, None if unknown
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses = self.misses + 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits = self.hits + 1
+            return dict(self._entries[key])
+
+
+    def put(self, key, data):
+        """
+        Stores a copy of the key/values data for key
+        The least recently used entries are evicted above size
+        """
+        with self._lock:
+            self._entries[key] = dict(data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions = self.evictions + 1
+
+
+    def clear(self):
+        """
+        Removes all entries (counters are kept)
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+    def stats(self):
+        """
+        Returns a dictionary with the cache counters
+        """
+        with self._lock:
+            return { 'entries' : len(self._entries), 'size' : self.size, 'hits' : self.hits,
+                     'misses' : self.misses, 'evictions' : self.evictions }
+
 
 class Parse(object):
     """
     Feedback file parser from the taskwatcher suite
+    Optional : cache (ParseCache) used by load_file and load_file_reverse
     """
     
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, cache=None):
 
         # create logger
         log.basicConfig(
@@ -41,12 +132,24 @@ class Parse(object):
         # Attributs
         self.file = None
         self.dict = {}
+        self.chunk_size = 1024*1024
+        self.tail_size = 64
+        self.cache = cache
+
+        # How the last compact_file shrank the file (collapse or copy)
+        self.compaction = None
+
+        # Private attributs (incremental parsing state)
+        self._identity = None
+        self._offset = 0
+        self._tail = b''
 
 
     def load_file(self, file=""):
         """
         Loads feedback file in memory
         Extract key/value pairs
+        With a cache, an unchanged file is not parsed again
         """
         log.info("Enter with file={}".format(file))
 
@@ -56,33 +159,385 @@ class Parse(object):
             sys.exit("file is required")
 
         try:
-            with open(file, 'r',encoding='utf-8') as F:
-                for line in F:
-                    line=line.strip()
-                    log.debug("read line={}".format(line))
-
-					# Extract data from feedback lines
-                    match_feedback = re.search("^(?:\[)(?P<key>[A-Za-z0-9\-_]+)(?:\])(?P<value>.*)",line)
-                    if match_feedback:
-                        key = match_feedback.group('key')
-                        value = match_feedback.group('value')
-                        log.debug("found key={} value={}".format(key,value))
-
-                        # See if we need to remove an entry
-                        if not value:
-                            log.debug("delete request for key={}".format(key))
-                            if key in self.dict:
-                                log.debug("key exists, deleting key={}".format(key))
-                                self.dict.pop(key)
-                        else:
-                            log.debug("adding key={} value={} to data".format(key,value))
-                            self.dict[key] = value
-
-                        
-            F.close()
+            with open(file, 'rb') as F:
+                fcntl.flock(F.fileno(), fcntl.LOCK_SH)
+                key = self._cache_key(F)
+                if self._cache_load(key):
+                    return
+                self._consume(F, final=True)
+                self._cache_put(key)
+
+        except IOError as e:
+            log.debug("I/O error filename={} error={}".format(file,e.strerror))
+
+
+    def load_file_reverse(self, file="", keys=None):
+        """
+        Loads feedback file reading it backwards from its end
+        Feedback is last-write-wins : going backwards, the first line seen for
+        a key decides its value (or its deletion) and a [] line (clear all)
+        decides all the remaining keys, so reading stops there.
+        If keys (list) is given, reading also stops as soon as all these keys
+        are decided and the resulting state is restricted to these keys.
+        Gives the same state as load_file but only reads the tail of files
+        ending with a clear all or when only some keys are needed.
+        """
+        log.info("Enter with file={} keys={}".format(file, keys))
+
+        # Sanity
+        if not file:
+            log.debug("file is required")
+            sys.exit("file is required")
+
+        decided = {}
+        cleared = False
+        wanted = None
+        cache_key = None
+        if keys is not None:
+            wanted = set([ key.encode('ascii') for key in keys ])
+
+        try:
+            with open(file, 'rb') as F:
+                fcntl.flock(F.fileno(), fcntl.LOCK_SH)
+                if wanted is None:
+                    cache_key = self._cache_key(F)
+                    if self._cache_load(cache_key):
+                        return
+                position = F.seek(0, os.SEEK_END)
+                pending = b''
+                done = False
+                while position > 0 and not done:
+                    size = min(self.chunk_size, position)
+                    position = position - size
+                    F.seek(position)
+                    data = F.read(size) + pending
+
+                    # first line may continue in the previous chunk
+                    if position > 0:
+                        start = data.find(b'\n') + 1
+                        pending = data[:start]
+                        data = data[start:]
+                        if not start:
+                            pending = data
+                            continue
+
+                    for (key, value) in reversed(FEEDBACK_LINES.findall(data)):
+                        if not key:
+                            cleared = True
+                            done = True
+                            break
+                        if key not in decided:
+                            decided[key] = value
+                            if wanted is not None and wanted.issubset(decided):
+                                done = True
+                                break
+
+            log.debug("stopped at position={} cleared={}".format(position, cleared))
 
         except IOError as e:
             log.debug("I/O error filename={} error={}".format(file,e.strerror))
+            return
+
+        if wanted is not None:
+            self.dict = {}
+        elif cleared:
+            self.dict.clear()
+
+        for key in decided:
+            if wanted is not None and key not in wanted:
+                continue
+            value = decided[key].decode('utf-8', 'replace').rstrip()
+            key = key.decode('ascii')
+            if value:
+                self.dict[key] = value
+            elif key in self.dict:
+                self.dict.pop(key)
+
+        self._cache_put(cache_key)
+
+
+    def poll_file(self, file="", final=False):
+        """
+        Incremental load of a feedback file which is being appended
+        Only the bytes appended since the previous call are parsed, the
+        current key/value state is kept between calls.
+        If the file was replaced (other inode), truncated or rewritten,
+        the state is reset and the file is fully parsed again.
+        An incomplete last line (no end of line yet) is left for the next call,
+        unless final is set (writer is done).
+
+        Returns True if the key/value state has changed
+        """
+        log.info("Enter with file={} final={}".format(file, final))
+
+        # Sanity
+        if not file:
+            log.debug("file is required")
+            sys.exit("file is required")
+
+        before = dict(self.dict)
+        try:
+            with open(file, 'rb') as F:
+                fcntl.flock(F.fileno(), fcntl.LOCK_SH)
+                stat = os.fstat(F.fileno())
+                identity = (stat.st_dev, stat.st_ino)
+                if not self._is_same_content(F, identity, stat.st_size):
+                    log.debug("file={} is new, truncated or rewritten, full parse".format(file))
+                    self.reset()
+                    self._identity = identity
+
+                F.seek(self._offset)
+                self._offset = self._offset + self._consume(F, final=final)
+
+        except IOError as e:
+            log.debug("I/O error filename={} error={}".format(file,e.strerror))
+
+        changed = self.dict != before
+        log.debug("file={} offset={} changed={}".format(file, self._offset, changed))
+        return changed
+
+
+    def compact_file(self, file=""):
+        """
+        Rewrites a feedback file with the minimal set of [key]value lines
+        giving the same key/value state (comments, overwritten values and
+        clears are dropped). An incomplete last line is kept as is.
+        The file is rewritten in place (same inode) under an exclusive flock,
+        readers of this module hold a shared flock so they never see it half
+        written. A writer must have the file opened in append mode (O_APPEND)
+        so its next lines go after the compacted content. It does not take
+        the flock, so the file is shrunk without losing its lines :
+        - collapse : the compacted lines (padded with a comment line) are
+          written to end where the parsed lines ended, the block aligned
+          start of the file is then removed by fallocate(COLLAPSE_RANGE),
+          serialized with the writes by the kernel (ext4, xfs)
+        - copy (other filesystems, small files) : the compacted lines are
+          written at the start of the file, the lines appended meanwhile
+          (after the former end of file) are copied after them until the
+          size stops changing, then the file is truncated. A line appended
+          between the last size check and the truncate is lost.
+        compaction is set to the method used.
+        The incremental state (poll_file) is set on the compacted file.
+
+        Returns (size before, size after) in bytes
+        """
+        log.info("Enter with file={}".format(file))
+
+        # Sanity
+        if not file:
+            log.debug("file is required")
+            sys.exit("file is required")
+
+        with open(file, 'r+b') as F:
+            fcntl.flock(F.fileno(), fcntl.LOCK_EX)
+            stat = os.fstat(F.fileno())
+            self.reset()
+            consumed = self._consume(F)
+
+            lines = []
+            for key in self.dict:
+                lines.append("[{}]{}\n".format(key, self.dict[key]).encode('utf-8'))
+            compacted = b''.join(lines)
+
+            # bytes appended since the parse (incomplete line or more)
+            F.seek(consumed)
+            remaining = F.read()
+            before = consumed + len(remaining)
+
+            if len(compacted) >= consumed:
+                log.debug("file={} already compact size={}".format(file, before))
+                self.compaction = None
+                self._identity = (stat.st_dev, stat.st_ino)
+                self._offset = consumed
+                return (before, before)
+
+            # collapsed range : whole blocks, leaving room for a comment line
+            start = (consumed - len(compacted) - 2) // stat.st_blksize * stat.st_blksize
+            padded = compacted + b'#' + b' ' * (consumed - start - len(compacted) - 2) + b'\n'
+            if start > 0 and self._collapse(F, start, padded):
+                self.compaction = 'collapse'
+                compacted = padded
+                after = os.fstat(F.fileno()).st_size
+            else:
+                self.compaction = 'copy'
+                after = self._copy_compacted(F, compacted, remaining, before)
+
+            self._identity = (stat.st_dev, stat.st_ino)
+            self._offset = len(compacted)
+            self._tail = compacted[-self.tail_size:]
+
+        log.debug("file={} compacted by {} from size={} to size={}".format(file, self.compaction, before, after))
+        return (before, after)
+
+
+    def _collapse(self, F, start, content):
+        """
+        Writes content so it ends at start + len(content) and removes the
+        start bytes of the file (fallocate COLLAPSE_RANGE)
+        Returns False if the filesystem does not support it
+        """
+        if _fallocate is None:
+            return False
+        try:
+            F.seek(start)
+            F.write(content)
+            F.flush()
+            if _fallocate(F.fileno(), FALLOC_FL_COLLAPSE_RANGE, 0, start) < 0:
+                raise OSError(ctypes.get_errno(), "fallocate failed")
+
+        except OSError as e:
+            log.debug("collapse not available error={}".format(e))
+            return False
+
+        return True
+
+
+    def _copy_compacted(self, F, compacted, remaining, end):
+        """
+        Writes compacted then remaining at the start of the file, copies
+        after them the bytes appended after end (former end of file) until
+        the size stops changing, then truncates the file
+        Returns the file size
+        """
+        F.seek(0)
+        F.write(compacted + remaining)
+        F.flush()
+
+        position = len(compacted) + len(remaining)
+        while True:
+            size = os.fstat(F.fileno()).st_size
+            if size <= end:
+                os.ftruncate(F.fileno(), position)
+                return position
+            F.seek(end)
+            appended = F.read(size - end)
+            end = end + len(appended)
+            F.seek(position)
+            F.write(appended)
+            F.flush()
+            position = position + len(appended)
+
+
+    def reset(self):
+        """
+        Forgets the key/value state and the incremental position
+        """
+        log.info("Enter")
+        self.dict = {}
+        self._identity = None
+        self._offset = 0
+        self._tail = b''
+
+
+    def _cache_key(self, F):
+        """
+        Returns the cache key of the open file F, None if the cache can't be
+        used (no cache, or a state is already loaded)
+        """
+        if self.cache is None or self.dict:
+            return None
+        return ParseCache.key(os.fstat(F.fileno()))
+
+
+    def _cache_load(self, key):
+        """
+        Loads the cached state for key
+        Returns True on a cache hit
+        """
+        if key is None:
+            return False
+        data = self.cache.get(key)
+        if data is None:
+            return False
+        log.debug("cache hit key={}".format(key))
+        self.dict = data
+        return True
+
+
+    def _cache_put(self, key):
+        """
+        Stores the current state in the cache under key
+        """
+        if key is not None:
+            self.cache.put(key, self.dict)
+
+
+    def _is_same_content(self, F, identity, size):
+        """
+        Returns True if the already parsed part of the file is unchanged :
+        same inode, not shorter than the parsed offset and the last parsed
+        bytes are still the same (detects a rewrite in place)
+        """
+        if identity != self._identity or size < self._offset:
+            return False
+
+        if self._tail:
+            F.seek(self._offset - len(self._tail))
+            if F.read(len(self._tail)) != self._tail:
+                return False
+
+        return True
+
+
+    def _consume(self, F, final=False):
+        """
+        Parses the complete lines from the current position of the binary
+        file F up to its end, by chunks of chunk_size bytes
+        If final is set, the last line is parsed even without end of line
+        Returns the number of bytes consumed (up to the last end of line)
+        """
+        consumed = 0
+        pending = b''
+        while True:
+            chunk = F.read(self.chunk_size)
+            if not chunk:
+                break
+
+            data = pending + chunk
+            end = data.rfind(b'\n')
+            if end < 0:
+                pending = data
+                continue
+
+            self._scan(data[:end+1])
+            consumed = consumed + end + 1
+            self._tail = data[max(0, end+1-self.tail_size):end+1]
+            pending = data[end+1:]
+
+        if final and pending:
+            self._scan(pending)
+
+        return consumed
+
+
+    def _scan(self, data):
+        """
+        Applies a block of feedback lines (bytes) on the key/value state
+        Lines are matched in bytes and only the last value of each key in
+        the block is decoded (invalid utf-8 is replaced)
+        """
+        raw = {}
+        cleared = False
+        for (key, value) in FEEDBACK_LINES.findall(data):
+            if key:
+                raw[key] = value
+            else:
+                # [] clears all key/value pairs
+                raw = {}
+                cleared = True
+
+        if cleared:
+            self.dict.clear()
+
+        for key in raw:
+            value = raw[key].decode('utf-8', 'replace').rstrip()
+            key = key.decode('ascii')
+
+            # See if we need to remove an entry
+            if value:
+                self.dict[key] = value
+            elif key in self.dict:
+                self.dict.pop(key)
 
 
     def get_data(self):
@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18th, 2026
+@author: cgustave
+
+Process tree from the taskwatcher suite
+"""
+
+import logging as log
+import argparse
+import os
+import signal
+
+
+class ProcTree(object):
+    """
+    Process tree from the taskwatcher suite
+    A snapshot of the process table from a single scan of /proc : each
+    process with its parent, process group and state.
+    Tasks are started in their own session and process group (the task pid
+    is the group id) : a task is alive while a process of its group is
+    alive, and it is killed with its whole tree (group and descendants,
+    including the ones which left the group).
+    Resources used by a tree (cpu, memory, io, threads) are summed from
+    the same scan, see usage().
+    Optional : proc (procfs mount point)
+    """
+    def __init__(self, proc='/proc', debug=False):
+
+        # create logger
+        log.basicConfig(
+            format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-\
+            10.10s.%(funcName)-20.20s:%(lineno)5d] %(message)s',
+            datefmt='%Y%m%d:%H:%M:%S',
+            filename='debug.log',
+            level=log.NOTSET)
+
+        # Set debug level first
+        if debug:
+            self.debug = True
+            log.basicConfig(level='DEBUG')
+        else:
+            self.debug = False
+            log.basicConfig(level='ERROR')
+
+        # Public attributs
+        self.proc = proc
+
+        # { pid : (ppid, pgid, state) }
+        self.processes = {}
+
+        # Private attributs
+        self._children = None
+
+        # { pid : (cpu ticks, rss pages, threads) } from the last scan
+        self._usage = {}
+        self._clock_ticks = os.sysconf('SC_CLK_TCK')
+        self._page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+
+        self.scan()
+
+
+    def scan(self):
+        """
+        Reads the process table from /proc (one read of /proc/<pid>/stat
+        per process). Processes gone meanwhile are ignored.
+        Returns the number of processes
+        """
+        log.info("Enter")
+
+        processes = {}
+        usage = {}
+        for entry in os.listdir(self.proc):
+            if not entry.isdigit():
+                continue
+            try:
+                with open("{}/{}/stat".format(self.proc, entry), 'rb') as F:
+                    stat = F.read()
+            except OSError:
+                continue
+            # pid (comm) state ppid pgrp ... : comm may hold spaces and parenthesis
+            fields = stat[stat.rfind(b')')+2:].split()
+            processes[int(entry)] = (int(fields[1]), int(fields[2]), fields[0].decode())
+            # utime stime cutime cstime (reaped children), num_threads, rss
+            usage[int(entry)] = (int(fields[11]) + int(fields[12]) + int(fields[13]) + int(fields[14]),
+                                 int(fields[21]), int(fields[17]))
+
+        self.processes = processes
+        self._usage = usage
+        self._children = None
+        log.debug("processes={}".format(len(processes)))
+        return len(processes)
+
+
+    def alive(self, pid):
+        """
+        True if process pid exists and is not a zombie
+        """
+        process = self.processes.get(pid)
+        return process is not None and process[2] not in ('Z', 'X')
+
+
+    def group(self, pgid):
+        """
+        Returns the set of the living processes of process group pgid
+        """
+        return set([ pid for (pid, (ppid, group, state)) in self.processes.items()
+                     if group == pgid and state not in ('Z', 'X') ])
+
+
+    def descendants(self, pids):
+        """
+        Returns the set of the living descendants of the processes pids
+        """
+        if self._children is None:
+            self._children = {}
+            for (pid, (ppid, group, state)) in self.processes.items():
+                self._children.setdefault(ppid, []).append(pid)
+
+        found = set()
+        todo = list(pids)
+        while todo:
+            for child in self._children.get(todo.pop(), []):
+                if child not in found:
+                    found.add(child)
+                    todo.append(child)
+        return set([ pid for pid in found if self.alive(pid) ])
+
+
+    def tree(self, pid):
+        """
+        Returns the set of the living processes of the task started as pid :
+        its process group and all their descendants
+        """
+        roots = self.group(pid)
+        if self.alive(pid):
+            roots.add(pid)
+        return roots | self.descendants(roots | set([pid]))
+
+
+    def usage(self, pids):
+        """
+        Returns the resources used by the processes pids as a dictionary :
+        cpu (user+system ms, including their reaped children), rss (KB),
+        threads, io_read and io_write (storage bytes, only readable for the
+        processes of the same user)
+        """
+        cpu = rss = threads = io_read = io_write = 0
+        for pid in pids:
+            if pid not in self._usage:
+                continue
+            (ticks, pages, count) = self._usage[pid]
+            cpu = cpu + ticks
+            rss = rss + pages
+            threads = threads + count
+            try:
+                with open("{}/{}/io".format(self.proc, pid), 'rb') as F:
+                    for line in F:
+                        if line.startswith(b'read_bytes:'):
+                            io_read = io_read + int(line.split()[1])
+                        elif line.startswith(b'write_bytes:'):
+                            io_write = io_write + int(line.split()[1])
+            except (OSError, ValueError, IndexError):
+                pass
+
+        return { 'cpu' : cpu * 1000 // self._clock_ticks, 'rss' : rss * self._page_kb,
+                 'threads' : threads, 'io_read' : io_read, 'io_write' : io_write }
+
+
+    def kill(self, pid, signum=signal.SIGKILL):
+        """
+        Sends signum to the task started as pid : its process group, then
+        the processes of its tree out of the group
+        Returns the number of processes signaled
+        """
+        log.info("Enter with pid={} signum={}".format(pid, signum))
+
+        members = self.tree(pid)
+        group = self.group(pid)
+        if group:
+            try:
+                os.killpg(pid, signum)
+            except (ProcessLookupError, PermissionError) as e:
+                log.debug("killpg pgid={} error={}".format(pid, e))
+                group = set()
+
+        for member in members - group:
+            try:
+                os.kill(member, signum)
+            except (ProcessLookupError, PermissionError) as e:
+                log.debug("kill pid={} error={}".format(member, e))
+
+        log.debug("signaled {} processes pids={}".format(len(members), sorted(members)))
+        return len(members)
+
+
+
+if __name__ == '__main__': #pragma: no cover
+
+    parser = argparse.ArgumentParser(description='Process tree of a task')
+    parser.add_argument('--debug', '-d', help="turn on debug", action="store_true")
+    parser.add_argument('--pid', help="task pid (its process group id)", required=True)
+    args = parser.parse_args()
+
+    tree = ProcTree(debug=args.debug)
+    pid = int(args.pid)
+    print("group {} : {}".format(pid, sorted(tree.group(pid))))
+    print("tree  {} : {}".format(pid, sorted(tree.tree(pid))))
+    print("usage {} : {}".format(pid, tree.usage(tree.tree(pid))))
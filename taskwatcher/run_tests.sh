@@ -10,7 +10,7 @@ echo "" >> debug.log
 
 # Run testing for all objects
 
-for NAME in parse database control launch; do
+for NAME in parse database control launch watch supervisor forkserver proctree; do
 
 	echo
 	echo "==========================================="
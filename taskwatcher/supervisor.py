@@ -0,0 +1,514 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18th, 2026
+@author: cgustave
+
+Multi-task supervisor daemon from the taskwatcher suite
+"""
+
+import logging as log
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+from taskwatcher.database import Database
+from taskwatcher.parse import Parse
+from taskwatcher.proctree import ProcTree
+from taskwatcher.launch import archive_task, command_argv, send_request
+from taskwatcher.watch import file_signature
+
+
+class SupervisedTask(object):
+    """
+    A child owned by the supervisor (kept small : a few KB per task)
+    """
+    __slots__ = ('taskid', 'pid', 'pidfd', 'name', 'info1', 'info2', 'info3', 'feedfile',
+                 'timeout', 'feedback_tail', 'starttime', 'lastbeat', 'signature', 'parser',
+                 'feedback_pending', 'feedback_written', 'termerror', 'killtime', 'status')
+
+    def __init__(self, taskid, pid, feedfile=None, timeout=30, feedback_tail=0,
+                 name='', info1='', info2='', info3=''):
+        self.taskid = taskid
+        self.pid = pid
+        self.pidfd = None
+        self.name = name
+        self.info1 = info1
+        self.info2 = info2
+        self.info3 = info3
+        self.feedfile = feedfile
+        self.timeout = timeout
+        self.feedback_tail = feedback_tail
+        self.starttime = int(time.time())
+        self.lastbeat = time.monotonic()
+        self.signature = None
+        self.parser = None
+        self.feedback_pending = False
+        self.feedback_written = None
+        self.termerror = "TBD"
+        self.killtime = None
+        self.status = None
+
+
+class Supervisor(object):
+    """
+    Multi-task supervisor daemon from the taskwatcher suite
+    Called with db, socket (unix socket path to listen on)
+    Optional : tick (seconds between checks), feedback_interval, kill_grace
+    One asyncio process owns all the children handed off by launch.py
+    (--supervisor) instead of one launcher process per task : it spawns
+    them, checks their heartbeat (feedback file writes), kills them on
+    timeout and archives them in history when they exit.
+    Tasks run in their own process group : a task is over once its process
+    and its group are gone, it is killed with its process tree (ProcTree).
+    Child exits are notified by pidfd (SIGCHLD otherwise). Each tick does a
+    single /proc scan for all the tasks, running task and feedback updates
+    are written to the database in batch.
+
+    Protocol : one json object per line, one json reply per line
+      { "op" : "launch", "command" : "...", "taskid" : 1, "feedpath" : "/tmp",
+        "timeout" : 30, "name" : "", "info1" : "", "info2" : "", "info3" : "",
+        "feedback_tail" : 0, "cwd" : "/path", "env" : { ... } }
+      => { "ok" : true, "taskid" : 1, "pid" : 1234 }
+        (command : argv list, or a string split as a shell would do)
+        (cwd, env : directory and environment of the task, the caller ones
+         with launch.py, relative command and feedpath are resolved in cwd)
+      { "op" : "status" }   => { "ok" : true, "tasks" : { taskid : pid, ... } }
+      { "op" : "shutdown" } => { "ok" : true } (exits when all tasks are done)
+    Errors are replied as { "ok" : false, "error" : "..." }
+    """
+    def __init__(self, db='', socket='', tick=1, feedback_interval=5, kill_grace=5, debug=False):
+
+        # create logger
+        log.basicConfig(
+            format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-\
+            10.10s.%(funcName)-20.20s:%(lineno)5d] %(message)s',
+            datefmt='%Y%m%d:%H:%M:%S',
+            filename='debug.log',
+            level=log.NOTSET)
+
+        # Set debug level first
+        if debug:
+            self.debug = True
+            log.basicConfig(level='DEBUG')
+        else:
+            self.debug = False
+            log.basicConfig(level='ERROR')
+
+        log.info("Constructor with db={} socket={} tick={} feedback_interval={} kill_grace={} debug={}".
+                 format(db, socket, tick, feedback_interval, kill_grace, debug))
+
+        # Sanity checks
+        if not (os.path.isfile(db)):
+            log.error("db file {} does not exist".format(db))
+            raise SystemExit
+
+        if not socket:
+            log.error("socket is required")
+            raise SystemExit
+
+        # Public attributs
+        self.db = db
+        self.socket = socket
+        self.tick = float(tick)
+        self.feedback_interval = float(feedback_interval)
+        self.kill_grace = float(kill_grace)
+        self.pidfd = True
+
+        # Private attributs
+        self._DB = Database(db=db, debug=debug)
+        self._tasks = {}
+        self._loop = None
+        self._stopping = None
+        self._sigchld = False
+
+
+    def run(self):
+        """
+        Runs the daemon until a shutdown request (or SIGTERM) and all its
+        tasks are done
+        """
+        log.info("Enter")
+        asyncio.run(self.serve())
+
+
+    async def serve(self):
+        """
+        Listens on the unix socket and checks the tasks every tick
+        """
+        log.info("Enter")
+
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._watch_children()
+
+        if os.path.exists(self.socket):
+            os.unlink(self.socket)
+        # Commands are run as our user : socket only usable by our user
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._handle_client, path=self.socket)
+        finally:
+            os.umask(umask)
+        log.debug("listening on socket={}".format(self.socket))
+
+        try:
+            while True:
+                self.check_tasks()
+                if self._stopping.is_set():
+                    if not self._tasks:
+                        break
+                    await asyncio.sleep(self.tick)
+                    continue
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self.tick)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            server.close()
+            await server.wait_closed()
+            self._unwatch_children()
+            if os.path.exists(self.socket):
+                os.unlink(self.socket)
+            self._DB.close()
+
+        log.debug("supervisor stopped")
+
+
+    def stop(self):
+        """
+        Stops accepting tasks, the daemon exits when its tasks are done
+        """
+        log.info("Enter")
+        if self._stopping:
+            self._stopping.set()
+
+
+    def _watch_children(self):
+        """
+        SIGCHLD reaps the children when pidfd is not available
+        (SIGTERM stops the daemon). Not possible out of the main thread :
+        children are then only checked every tick.
+        """
+        log.info("Enter")
+        try:
+            self._loop.add_signal_handler(signal.SIGTERM, self.stop)
+            if not (self.pidfd and hasattr(os, 'pidfd_open')):
+                self._loop.add_signal_handler(signal.SIGCHLD, self._reap_children)
+                self._sigchld = True
+        except (ValueError, RuntimeError) as e:
+            log.warning("no signal handlers error={}".format(e))
+
+
+    def _unwatch_children(self):
+        """
+        Removes the signal handlers and the pidfd readers
+        """
+        log.info("Enter")
+        try:
+            self._loop.remove_signal_handler(signal.SIGTERM)
+            if self._sigchld:
+                self._loop.remove_signal_handler(signal.SIGCHLD)
+                self._sigchld = False
+        except (ValueError, RuntimeError):
+            pass
+        for task in self._tasks.values():
+            self._close_pidfd(task)
+
+
+    async def _handle_client(self, reader, writer):
+        """
+        Serves the json line requests of one client connection
+        """
+        log.info("Enter")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = self.handle_request(json.loads(line))
+                except (ValueError, TypeError) as e:
+                    reply = { 'ok' : False, 'error' : "invalid request: {}".format(e) }
+                writer.write(json.dumps(reply).encode()+b"\n")
+                await writer.drain()
+        except ConnectionError as e:
+            log.debug("client connection error={}".format(e))
+        finally:
+            writer.close()
+
+
+    def handle_request(self, request):
+        """
+        Returns the reply (dictionary) for the request (dictionary)
+        """
+        log.info("Enter with request={}".format(request))
+
+        op = request.get('op') if isinstance(request, dict) else None
+        if op == 'launch':
+            if self._stopping and self._stopping.is_set():
+                return { 'ok' : False, 'error' : "supervisor is shutting down" }
+            return self.launch(**{ k : v for (k, v) in request.items() if k != 'op' })
+        if op == 'status':
+            return { 'ok' : True, 'tasks' : { str(t.taskid) : t.pid for t in self._tasks.values() } }
+        if op == 'shutdown':
+            self.stop()
+            return { 'ok' : True }
+
+        log.warning("unknown op={}".format(op))
+        return { 'ok' : False, 'error' : "unknown op {}".format(op) }
+
+
+    def launch(self, command='', taskid=None, feedpath=None, timeout=30, name='', info1='', info2='',
+               info3='', feedback_tail=0, cwd=None, env=None):
+        """
+        Starts command as task taskid (same rules as Launch.execute : a
+        reservation is required if the command has --feedback), in directory
+        cwd with environment env (default : the supervisor ones)
+        Returns the reply dictionary
+        """
+        log.info("Enter with command={} taskid={} cwd={}".format(command, taskid, cwd))
+
+        argv = command_argv(command)
+        if not argv:
+            return { 'ok' : False, 'error' : "command is required" }
+
+        will_feedback = '--feedback' in argv
+        if not taskid:
+            if will_feedback:
+                return { 'ok' : False, 'error' : "taskid is required if task is expected to feedback, --feedback is set" }
+            taskid = self._DB.reserve_task(taskname=name)
+            log.debug("automatique reservation gave taskid={}".format(taskid))
+
+        if cwd and not os.path.isdir(cwd):
+            return { 'ok' : False, 'error' : "cwd {} is not a directory".format(cwd) }
+        if env is not None and not isinstance(env, dict):
+            return { 'ok' : False, 'error' : "env should be an object" }
+
+        taskid = int(taskid)
+        if taskid in self._tasks or not self._DB.is_task_reserved(taskid=taskid):
+            log.warning("taskid={} is not clear to start".format(taskid))
+            return { 'ok' : False, 'error' : "taskid={} is not clear to start".format(taskid) }
+
+        feedfile = None
+        if will_feedback:
+            if cwd and feedpath:
+                feedpath = os.path.join(cwd, feedpath)
+            feedfile = str(feedpath)+"/feedback_"+str(taskid)+".log"
+
+        try:
+            pid = self._spawn(argv, cwd=cwd, env=env)
+        except OSError as e:
+            log.error("taskid={} could not start command error={}".format(taskid, e))
+            return { 'ok' : False, 'error' : "could not start command: {}".format(e) }
+
+        task = SupervisedTask(taskid=taskid, pid=pid, feedfile=feedfile, timeout=int(timeout or 30),
+                              feedback_tail=int(feedback_tail or 0), name=name or '',
+                              info1=info1 or '', info2=info2 or '', info3=info3 or '')
+        if will_feedback:
+            task.parser = Parse(debug=self.debug)
+        self._tasks[taskid] = task
+        self._open_pidfd(task)
+
+        update = { 'status' : 'RUNNING', 'info1' : task.info1, 'info2' : task.info2,
+                   'info3' : task.info3, 'pid' : pid, 'feedback' : will_feedback,
+                   'starttime' : task.starttime, 'timeout' : task.timeout }
+        if name:
+            update['name'] = name
+        if feedfile:
+            update['feedfile'] = feedfile
+        self._DB.update_task(taskid=taskid, update=update)
+
+        log.debug("taskid={} started pid={}".format(taskid, pid))
+        return { 'ok' : True, 'taskid' : taskid, 'pid' : pid }
+
+
+    def _spawn(self, argv, cwd=None, env=None):
+        """
+        Starts argv in a child process, in its own session and process group,
+        in directory cwd with environment env, and returns its pid
+        (os.posix_spawnp can't change directory : fork, then chdir and exec
+        in the child). An exec error is raised as OSError in the supervisor.
+        """
+        if env is None:
+            env = os.environ
+        env = { str(k) : str(v) for (k, v) in env.items() }
+
+        # exec error reported on a close on exec pipe
+        (rfd, wfd) = os.pipe()
+        pid = os.fork()
+        if not pid:
+            try:
+                os.close(rfd)
+                os.setsid()
+                if cwd:
+                    os.chdir(cwd)
+                os.execvpe(argv[0], argv, env)
+            except OSError as e:
+                os.write(wfd, json.dumps([e.errno, e.strerror, e.filename]).encode())
+            finally:
+                os._exit(127)
+
+        os.close(wfd)
+        with os.fdopen(rfd, 'rb') as F:
+            error = F.read()
+        if error:
+            os.waitpid(pid, 0)
+            raise OSError(*json.loads(error))
+        return pid
+
+
+    def _open_pidfd(self, task):
+        """
+        Reaps the task as soon as it exits, from a pidfd in the event loop
+        """
+        if not (self.pidfd and hasattr(os, 'pidfd_open')):
+            return
+        try:
+            task.pidfd = os.pidfd_open(task.pid)
+        except OSError as e:
+            log.debug("no pidfd error={}".format(e))
+            return
+        self._loop.add_reader(task.pidfd, self._reap, task)
+
+
+    def _close_pidfd(self, task):
+        """
+        Releases the task pidfd
+        """
+        if task.pidfd is not None:
+            self._loop.remove_reader(task.pidfd)
+            os.close(task.pidfd)
+            task.pidfd = None
+
+
+    def _reap_children(self):
+        """
+        SIGCHLD : reaps all the exited children
+        """
+        log.info("Enter")
+        tree = ProcTree(debug=self.debug)
+        for task in list(self._tasks.values()):
+            self._reap(task, tree=tree)
+
+
+    def _reap(self, task, tree=None):
+        """
+        Reaps the task process if it has exited. The task is over, and
+        archived, once its process group is empty as well (checked from
+        tree, a ProcTree scan)
+        Returns True if the task is over
+        """
+        if task.status is None:
+            try:
+                pid, status = os.waitpid(task.pid, os.WNOHANG)
+            except ChildProcessError as e:
+                log.warning("taskid={} pid={} error={}".format(task.taskid, task.pid, e))
+                pid, status = task.pid, -1
+
+            if not pid:
+                return False
+
+            log.debug("taskid={} pid={} has exited status={}".format(task.taskid, task.pid, status))
+            self._close_pidfd(task)
+            task.status = status
+
+        if tree is None:
+            tree = ProcTree(debug=self.debug)
+        group = tree.group(task.pid)
+        if group:
+            log.debug("taskid={} process group still alive pids={}".format(task.taskid, sorted(group)))
+            return False
+
+        self._tasks.pop(task.taskid, None)
+        self._archive(task)
+        return True
+
+
+    def check_tasks(self):
+        """
+        One tick : reaps exited children, checks the heartbeats, kills tasks
+        in timeout and writes running tasks and feedbacks in one batch
+        """
+        log.info("Enter with {} tasks".format(len(self._tasks)))
+
+        now = time.monotonic()
+        updates = {}
+        feedbacks = {}
+        tree = None
+        if self._tasks:
+            tree = ProcTree(debug=self.debug)
+        for task in list(self._tasks.values()):
+            if self._reap(task, tree=tree):
+                continue
+
+            if task.killtime is not None:
+                if now - task.killtime >= self.kill_grace:
+                    log.warning("taskid={} pid={} SIGKILL".format(task.taskid, task.pid))
+                    tree.kill(task.pid, signal.SIGKILL)
+                continue
+
+            if task.feedfile:
+                signature = file_signature(task.feedfile)
+                if signature != task.signature:
+                    task.signature = signature
+                    task.lastbeat = now
+                    if task.parser.poll_file(file=task.feedfile):
+                        task.feedback_pending = True
+
+                if now - task.lastbeat >= task.timeout:
+                    log.warning("taskid={} pid={} has timeout, killed".format(task.taskid, task.pid))
+                    task.termerror = 'timeout'
+                    task.killtime = now
+                    tree.kill(task.pid, signal.SIGTERM)
+                    continue
+
+                if task.feedback_pending and (task.feedback_written is None
+                                              or now - task.feedback_written >= self.feedback_interval):
+                    feedbacks[task.taskid] = task.parser.get_data()
+                    task.feedback_pending = False
+                    task.feedback_written = now
+
+            lastupdate = int(time.time())
+            updates[task.taskid] = { 'lastupdate' : lastupdate, 'duration' : lastupdate - task.starttime }
+
+        self._DB.update_tasks(updates=updates, do_lastupdate=False)
+        self._DB.update_feedbacks(feedbacks=feedbacks)
+
+
+    def _archive(self, task):
+        """
+        Task has exited, removes it from running tasks and archives in history
+        """
+        log.info("Enter with taskid={} status={}".format(task.taskid, task.status))
+
+        archive_task(database=self._DB, taskid=task.taskid, termsignal=task.status, termerror=task.termerror,
+                     parser=task.parser, feedfile=task.feedfile, feedback_tail=task.feedback_tail)
+
+
+
+if __name__ == '__main__': #pragma: no cover
+
+    parser = argparse.ArgumentParser(description='Multi-task supervisor daemon from the taskwatcher suite.')
+    parser.add_argument('--db', help="sqlite db file", required=True)
+    parser.add_argument('--socket', help="unix socket to listen on", required=True)
+    parser.add_argument('--tick', help="seconds between 2 checks of the tasks (default 1)", default=1)
+    parser.add_argument('--feedback-interval', help="minimum seconds between 2 feedback writes in db (default 5)", default=5)
+    parser.add_argument('--kill-grace', help="seconds between SIGTERM and SIGKILL on timeout (default 5)", default=5)
+    parser.add_argument('--status', help="prints the tasks of a running supervisor", action="store_true")
+    parser.add_argument('--shutdown', help="stops a running supervisor once its tasks are done", action="store_true")
+    parser.add_argument('--debug', '-d', help="Debugging on", action="store_true")
+    args = parser.parse_args()
+
+    if args.status or args.shutdown:
+        reply = send_request(path=args.socket, request={ 'op' : 'status' if args.status else 'shutdown' })
+        print(json.dumps(reply))
+        sys.exit(0 if reply.get('ok') else 1)
+
+    supervisor = Supervisor(db=args.db, socket=args.socket, tick=args.tick,
+                            feedback_interval=args.feedback_interval, kill_grace=args.kill_grace,
+                            debug=args.debug)
+    supervisor.run()
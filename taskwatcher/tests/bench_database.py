@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+Created on Oct 18, 2026
+
+@author: cgustave
+
+Database micro-benchmark from the taskwatcher suite
+Measures operations/sec of a launcher-like workload on the database, with a
+plain sqlite connection opened and closed on each call (former behavior : no
+schema upgrade check, no pragmas, no checkpoint on close, rollback journal)
+and with the long-lived connection.
+
+Example : tests/bench_database.py --ops 2000
+'''
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from database import Database
+
+
+class ConnectPerCall(Database):
+    """
+    Database with the former connection handling : a plain sqlite3.connect
+    per call, closed after it (see BenchDatabase.workload)
+    """
+    def _connect(self):
+        if self._DB is None:
+            self._DB = sqlite3.connect(self.db)
+            self._DB_pid = os.getpid()
+        return self._DB
+
+    def close(self):
+        if self._DB is not None:
+            self._DB.close()
+        self._DB = None
+        self._DB_pid = None
+
+
+class BenchDatabase(object):
+
+    def __init__(self, ops=1000, db=None):
+        self.ops = int(ops)
+        if not db:
+            db = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        self.db = db
+
+
+    def workload(self, database, reconnect=False):
+        """
+        One reservation followed by launcher calls (reserved check, status
+        running, heartbeats) and history archiving.
+        Returns the number of database calls done
+        """
+        calls = 0
+        taskid = database.reserve_task(taskname='bench')
+        calls = calls + 1
+        if reconnect:
+            database.close()
+        steps = [
+            lambda: database.is_task_reserved(taskid=taskid),
+            lambda: database.update_task(taskid=taskid, update={'status': 'RUNNING', 'starttime': int(time.time())}),
+            lambda: database.update_task(taskid=taskid, update={'duration': 1}),
+            lambda: database.update_task(taskid=taskid, update={'duration': 2}),
+            lambda: database.get_tasks(taskid=taskid),
+            lambda: database.add_history(entry={'taskid': taskid, 'taskname': 'bench', 'info1': '', 'info2': '',
+                                                'info3': '', 'termsignal': 0, 'termerror': '', 'starttime': 0,
+                                                'endtime': 0, 'duration': 0, 'feedback': ''}),
+            lambda: database.delete_task(taskid=taskid),
+        ]
+        for step in steps:
+            step()
+            calls = calls + 1
+            if reconnect:
+                database.close()
+        return calls
+
+
+    def run(self, reconnect=False):
+        """
+        Runs the workload until 'ops' database calls are done
+        Returns operations per second
+        """
+        database = Database(db=self.db)
+        database.create()
+        if reconnect:
+            # Former database file : rollback journal
+            database._connect().execute("PRAGMA journal_mode=DELETE")
+            database.close()
+            database = ConnectPerCall(db=self.db)
+        calls = 0
+        start = time.perf_counter()
+        while calls < self.ops:
+            calls = calls + self.workload(database, reconnect=reconnect)
+        elapsed = time.perf_counter() - start
+        database.close()
+        return calls / elapsed
+
+
+if __name__ == '__main__': #pragma: no cover
+    parser = argparse.ArgumentParser(description='Database benchmark from taskwatcher suite.')
+    parser.add_argument('--ops', help="number of database calls per run", default=1000)
+    parser.add_argument('--db', help="sqlite db file (default in a temporary directory)")
+    args = parser.parse_args()
+
+    bench = BenchDatabase(ops=args.ops, db=args.db)
+    before = bench.run(reconnect=True)
+    after = bench.run(reconnect=False)
+    print("connect per call : {:>10.0f} ops/sec".format(before))
+    print("single connection: {:>10.0f} ops/sec".format(after))
+    print("speedup          : {:>10.2f}x".format(after / before))
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+Created on Oct 18, 2026
+
+@author: cgustave
+
+Launch benchmark from the taskwatcher suite
+Starts a burst of short tasks with cold launch.py processes and from the
+fork server (forkserver.py) and measures launches/sec and the time from the
+launch request to the exec of the command (p50/p99).
+The command is a small script writing its start time (time.time_ns() is
+compared with 'date +%s%N'), its own startup is included in both modes.
+
+Example : tests/bench_launch.py --count 200
+'''
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from database import Database
+from launch import send_request
+
+TASKWATCHER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class BenchLaunch(object):
+
+    def __init__(self, count=100, path=None):
+        self.count = int(count)
+        if not path:
+            path = tempfile.mkdtemp()
+        self.path = path
+        self.db = os.path.join(path, 'bench.db')
+        self.socket = os.path.join(path, 'forkserver.sock')
+        self.stamp = os.path.join(path, 'stamp.sh')
+        Database(db=self.db).create()
+        with open(self.stamp, 'w') as F:
+            F.write("#!/bin/sh\ndate +%s%N > \"$1\"\n")
+        os.chmod(self.stamp, 0o755)
+
+
+    def command(self, n):
+        return "{} {}".format(self.stamp, os.path.join(self.path, "stamp_{}".format(n)))
+
+
+    def cold(self):
+        """
+        One launch.py process per task, started without waiting
+        Returns the list of request times (time.time_ns())
+        """
+        database = Database(db=self.db)
+        taskids = [ database.reserve_task(taskname='bench') for n in range(self.count) ]
+        database.close()
+
+        requests = []
+        processes = []
+        for (n, taskid) in enumerate(taskids):
+            requests.append(time.time_ns())
+            processes.append(subprocess.Popen([sys.executable, os.path.join(TASKWATCHER, 'launch.py'),
+                                               '--db', self.db, '--taskid', str(taskid), '--'] + self.command(n).split(),
+                                              stdout=subprocess.DEVNULL))
+        for process in processes:
+            process.wait()
+        return requests
+
+
+    def forkserver(self):
+        """
+        One request to the fork server per task
+        Returns the list of request times (time.time_ns())
+        """
+        server = subprocess.Popen([sys.executable, os.path.join(TASKWATCHER, 'forkserver.py'),
+                                   '--db', self.db, '--socket', self.socket])
+        while not os.path.exists(self.socket):
+            time.sleep(0.05)
+
+        database = Database(db=self.db)
+        taskids = [ database.reserve_task(taskname='bench') for n in range(self.count) ]
+
+        requests = []
+        for (n, taskid) in enumerate(taskids):
+            requests.append(time.time_ns())
+            send_request(path=self.socket, request={ 'op' : 'launch', 'command' : self.command(n), 'taskid' : taskid })
+        send_request(path=self.socket, request={ 'op' : 'shutdown' })
+        server.wait()
+
+        # Launchers are detached : wait for all the tasks to be archived
+        while database.get_number_of_tasks():
+            time.sleep(0.05)
+        database.close()
+        return requests
+
+
+    def results(self, requests):
+        """
+        Returns (launches/sec, p50 ms, p99 ms) from the request times and
+        the start time written by each command
+        """
+        latencies = []
+        last = 0
+        for (n, request) in enumerate(requests):
+            file = os.path.join(self.path, "stamp_{}".format(n))
+            with open(file) as F:
+                started = int(F.read())
+            os.remove(file)
+            latencies.append((started - request) / 1e6)
+            last = max(last, started)
+        latencies.sort()
+        rate = len(requests) / ((last - requests[0]) / 1e9)
+        p50 = latencies[int(len(latencies) * 0.50)]
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        return (rate, p50, p99)
+
+
+if __name__ == '__main__': #pragma: no cover
+    parser = argparse.ArgumentParser(description='Launch benchmark from taskwatcher suite.')
+    parser.add_argument('--count', help="number of tasks launched in a burst (default 100)", default=100)
+    parser.add_argument('--no-cold', help="do not measure cold launch.py", action="store_true")
+    args = parser.parse_args()
+
+    bench = BenchLaunch(count=args.count)
+    print("{} tasks, db {}".format(bench.count, bench.db))
+    if not args.no_cold:
+        (rate, p50, p99) = bench.results(bench.cold())
+        print("cold launch.py : {:>8.1f} launches/sec  time-to-exec p50={:>8.1f}ms p99={:>8.1f}ms".format(rate, p50, p99))
+    (rate, p50, p99) = bench.results(bench.forkserver())
+    print("forkserver     : {:>8.1f} launches/sec  time-to-exec p50={:>8.1f}ms p99={:>8.1f}ms".format(rate, p50, p99))
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+Created on Oct 18, 2026
+
+@author: cgustave
+
+Feedback parser benchmark from the taskwatcher suite
+Generates a synthetic feedback file (progress-heavy program) and measures
+the forward parser (load_file) against the former line by line parser, and
+the reverse parser (load_file_reverse).
+
+Example : tests/bench_parse.py --size 2048 --clear --no-legacy
+'''
+import argparse
+import logging as log
+import os
+import re
+import tempfile
+import time
+
+from parse import Parse
+
+
+class BenchParse(object):
+
+    def __init__(self, size=25, clear=False, file=None):
+        self.size = int(size) * 1024 * 1024
+        self.clear = clear
+        if not file:
+            file = os.path.join(tempfile.mkdtemp(), 'feedback_bench.log')
+        self.file = file
+        self.lines = 0
+
+
+    def generate(self):
+        """
+        Writes the synthetic feedback file of about 'size' bytes
+        Ends with a clear all and a report if 'clear' is set
+        """
+        block = []
+        for tc in range(1, 101):
+            block.append("[testcase_progress]{}\n".format(tc))
+        block.append("# debug : testcase done\n")
+        block.append("[testcase_name]testcase_nb_{}\n")
+        block = "".join(block)
+
+        written = 0
+        with open(self.file, 'w') as F:
+            F.write("[playbook]benchmark\n[run]1\n")
+            self.lines = 2
+            nb = 0
+            while written < self.size:
+                data = block.format(nb)
+                F.write(data)
+                written = written + len(data)
+                self.lines = self.lines + 102
+                nb = nb + 1
+            if self.clear:
+                F.write("[]\n[result]passed\n[testcases]{}\n".format(nb))
+                self.lines = self.lines + 3
+
+
+    def measure(self, method, **kwargs):
+        """
+        Returns (seconds, state) for a parse of the file with 'method'
+        """
+        parser = Parse()
+        start = time.perf_counter()
+        getattr(parser, method)(file=self.file, **kwargs)
+        return (time.perf_counter() - start, parser.dict)
+
+
+    def measure_legacy(self):
+        """
+        Returns (seconds, state) for a parse of the file with the former
+        load_file : text decoding, uncompiled regex and debug logs per line
+        """
+        Parse()
+        state = {}
+        start = time.perf_counter()
+        with open(self.file, 'r',encoding='utf-8') as F:
+            for line in F:
+                line=line.strip()
+                log.debug("read line={}".format(line))
+                match_feedback = re.search("^(?:\\[)(?P<key>[A-Za-z0-9\\-_]+)(?:\\])(?P<value>.*)",line)
+                if match_feedback:
+                    key = match_feedback.group('key')
+                    value = match_feedback.group('value')
+                    log.debug("found key={} value={}".format(key,value))
+                    if not value:
+                        log.debug("delete request for key={}".format(key))
+                        if key in state:
+                            log.debug("key exists, deleting key={}".format(key))
+                            state.pop(key)
+                    else:
+                        log.debug("adding key={} value={} to data".format(key,value))
+                        state[key] = value
+        return (time.perf_counter() - start, state)
+
+
+if __name__ == '__main__': #pragma: no cover
+    parser = argparse.ArgumentParser(description='Feedback parser benchmark from taskwatcher suite.')
+    parser.add_argument('--size', help="feedback file size in MB (default 25, about 1.2M lines)", default=25)
+    parser.add_argument('--no-legacy', help="do not measure the former parser", action="store_true")
+    parser.add_argument('--clear', help="file ends with a clear all [] and a report", action="store_true")
+    parser.add_argument('--file', help="feedback file to generate (default in a temporary directory)")
+    args = parser.parse_args()
+
+    bench = BenchParse(size=args.size, clear=args.clear, file=args.file)
+    bench.generate()
+    size = os.path.getsize(bench.file)
+    print("file {} : {:.0f} MB, {} lines".format(bench.file, size/1024/1024, bench.lines))
+
+    (forward, state) = bench.measure('load_file')
+    print("forward load_file                 : {:>8.3f}s {:>12.0f} lines/sec".format(forward, bench.lines/forward))
+    if not args.no_legacy and not args.clear:
+        (legacy, legacy_state) = bench.measure_legacy()
+        print("former line by line load_file     : {:>8.3f}s {:>12.0f} lines/sec same state={} speedup={:.1f}x".
+              format(legacy, bench.lines/legacy, legacy_state == state, legacy/forward))
+    (reverse, reverse_state) = bench.measure('load_file_reverse')
+    print("reverse load_file_reverse         : {:>8.3f}s same state={}".format(reverse, reverse_state == state))
+    (keys, keys_state) = bench.measure('load_file_reverse', keys=['testcase_name', 'testcase_progress'])
+    print("reverse load_file_reverse (2 keys): {:>8.3f}s".format(keys))
+    os.remove(bench.file)
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+Created on Oct 18, 2026
+
+@author: cgustave
+
+Spawn benchmark from the taskwatcher suite
+Measures the time to start a command (Launch.start_child, until the child
+is reaped) with the fork path and the posix_spawn path while the launcher
+memory (RSS) grows : os.fork() copies the page tables of the father, the
+cost grows with its size, posix_spawn does not.
+
+Example : tests/bench_spawn.py --rss 0,256,1024 --spawns 200
+'''
+import argparse
+import os
+import tempfile
+import time
+
+from database import Database
+from launch import Launch
+
+
+class BenchSpawn(object):
+
+    def __init__(self, spawns=100, db=None):
+        self.spawns = int(spawns)
+        if not db:
+            db = os.path.join(tempfile.mkdtemp(), 'bench.db')
+            Database(db=db).create()
+        self.db = db
+        self.ballast = []
+
+
+    def grow(self, megabytes):
+        """
+        Adds megabytes of touched memory to the process RSS
+        """
+        chunk = bytearray(int(megabytes) * 1024 * 1024)
+        for offset in range(0, len(chunk), 4096):
+            chunk[offset] = 1
+        self.ballast.append(chunk)
+
+
+    def rss(self):
+        """
+        Returns the process RSS in MB
+        """
+        with open("/proc/self/status") as F:
+            for line in F:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+        return 0
+
+
+    def measure(self, spawn):
+        """
+        Returns (p50 ms, p99 ms) of the start and reap of /bin/true
+        """
+        launcher = Launch(db=self.db, spawn=spawn)
+        latencies = []
+        for n in range(self.spawns):
+            start = time.perf_counter()
+            pid = launcher.start_child(argv=['true'])
+            os.waitpid(pid, 0)
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+        return (latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))])
+
+
+if __name__ == '__main__': #pragma: no cover
+    parser = argparse.ArgumentParser(description='Spawn benchmark from taskwatcher suite.')
+    parser.add_argument('--rss', help="comma separated launcher sizes in MB (default 0,256,1024)", default="0,256,1024")
+    parser.add_argument('--spawns', help="number of commands started per measure (default 100)", default=100)
+    args = parser.parse_args()
+
+    bench = BenchSpawn(spawns=args.spawns)
+    grown = 0
+    for size in [ int(s) for s in args.rss.split(',') ]:
+        if size > grown:
+            bench.grow(size - grown)
+            grown = size
+        (fork50, fork99) = bench.measure('fork')
+        (spawn50, spawn99) = bench.measure('posix_spawn')
+        print("rss {:>6.0f} MB : fork p50={:>7.2f}ms p99={:>7.2f}ms   posix_spawn p50={:>7.2f}ms p99={:>7.2f}ms".
+              format(bench.rss(), fork50, fork99, spawn50, spawn99))
@@ -7,8 +7,13 @@ Created on May 6, 2020
 import logging as log
 import unittest
 import json
+import csv
+import os
+import time
 
-from control import Control
+from control import Control, parse_where
+from database import summarize_samples
+from proctree import ProcTree
 
 # create logger
 log.basicConfig(
@@ -45,6 +50,134 @@ class ControlTestCase(unittest.TestCase):
         result = self.ctrl.get_number_of_tasks()
         self.assertEqual(result, 1)
 
+    # Human formatted outputs
+    def test045_print_tasks(self):
+        self.ctrl.print_tasks()
+        self.ctrl.print_history()
+
+    # Durability profile
+    def test050_set_durability(self):
+        self.ctrl.set_durability(durability='paranoid')
+        self.assertEqual(self.ctrl._DB.get_config(key='durability'), 'paranoid')
+        self.ctrl.set_durability(durability='safe')
+
+    # History export
+    def test060_export_history(self):
+        for i in range(3):
+            self.ctrl._DB.add_history(entry={'taskid' : i, 'taskname' : 'Export', 'info1' : 'a,b', 'info2' : '',
+                                             'info3' : '', 'termsignal' : 0, 'termerror' : '', 'starttime' : 1588874292,
+                                             'endtime' : 1588875292, 'duration' : 1000, 'feedback' : None})
+        (rows, elapsed) = self.ctrl.export_history(format='ndjson', out='export.ndjson')
+        self.assertEqual(rows, 3)
+        with open('export.ndjson') as F:
+            lines = [ json.loads(line) for line in F ]
+        self.assertEqual(lines[2]['taskid'], 2)
+        (rows, elapsed) = self.ctrl.export_history(format='csv', out='export.csv', taskname='Export', limit=2)
+        self.assertEqual(rows, 2)
+        with open('export.csv') as F:
+            lines = list(csv.reader(F))
+        self.assertEqual(lines[0][:3], ['id', 'taskid', 'taskname'])
+        self.assertEqual(lines[1][3], 'a,b')
+        os.remove('export.ndjson')
+        os.remove('export.csv')
+
+    # Feedback of running tasks
+    def test070_get_feedback(self):
+        tasks = []
+        for i in range(4):
+            taskid = self.ctrl.reserve(taskname='Feedback')
+            feedfile = 'feedback_{}.log'.format(taskid)
+            with open(feedfile, 'w') as F:
+                F.write("[progress]0\n[]\n[progress]{}\n[result]".format(i))
+            self.ctrl._DB.update_task(taskid=taskid, update={'status' : 'RUNNING', 'feedfile' : feedfile})
+            tasks.append(taskid)
+        # running without feedback file, and reserved only
+        self.ctrl._DB.update_task(taskid=tasks[3], update={'feedfile' : None})
+        self.ctrl._DB.update_task(taskid=tasks[2], update={'status' : 'RESERVED'})
+
+        result = json.loads(self.ctrl.get_feedback(taskid='all', workers=2))
+        self.assertEqual(sorted(result), [str(tasks[0]), str(tasks[1]), str(tasks[3])])
+        self.assertEqual(result[str(tasks[1])]['feedback'], {'progress' : '1'})
+        self.assertGreater(result[str(tasks[1])]['size'], 0)
+        self.assertIsNone(result[str(tasks[3])]['feedback'])
+        # unchanged files are served from the parse cache
+        hits = self.ctrl.cache_stats()['hits']
+        self.assertEqual(json.loads(self.ctrl.get_feedback(taskid='all'))[str(tasks[1])]['feedback'], {'progress' : '1'})
+        self.assertEqual(self.ctrl.cache_stats()['hits'], hits + 2)
+        result = json.loads(self.ctrl.get_feedback(taskid=tasks[2]))
+        self.assertEqual(result[str(tasks[2])]['feedback'], {'progress' : '2'})
+        for taskid in tasks:
+            self.ctrl._DB.delete_task(taskid=taskid)
+            if os.path.exists('feedback_{}.log'.format(taskid)):
+                os.remove('feedback_{}.log'.format(taskid))
+
+    # Tasks selected on their feedback values
+    def test080_where(self):
+        self.assertEqual(parse_where(['testcase_id=002', 'url=a=b']), {'testcase_id' : '002', 'url' : 'a=b'})
+        self.assertIsNone(parse_where(None))
+        with self.assertRaises(SystemExit):
+            parse_where(['testcase_id'])
+        taskid = self.ctrl.reserve(taskname='Where')
+        self.ctrl._DB.update_feedback(taskid=taskid, feedback=json.dumps({'testcase_id' : '002'}))
+        result = json.loads(self.ctrl.get_tasks(where=parse_where(['testcase_id=002'])))
+        self.assertEqual(list(result), [str(taskid)])
+        self.assertEqual(json.loads(self.ctrl.get_tasks(where={'testcase_id' : '003'})), {})
+        self.ctrl._DB.delete_task(taskid=taskid)
+
+    # Kill : whole process tree, reserved tasks skipped
+    def test090_kill(self):
+        tasks = []
+        pids = []
+        for i in range(3):
+            taskid = self.ctrl.reserve(taskname='Kill')
+            pid = os.posix_spawnp('sh', ['sh', '-c', 'sleep 30 & sleep 30 & wait'], os.environ, setsid=True)
+            self.ctrl._DB.update_task(taskid=taskid, update={'status' : 'RUNNING', 'pid' : pid})
+            tasks.append(taskid)
+            pids.append(pid)
+        reserved = self.ctrl.reserve(taskname='Kill')
+        time.sleep(0.2)
+        self.assertEqual(len(ProcTree().tree(pids[0])), 3)
+        self.ctrl.kill_task(taskid=tasks[0])
+        self.ctrl.killall_tasks(taskname='Kill')
+        for pid in pids:
+            os.waitpid(pid, 0)
+        time.sleep(0.2)
+        tree = ProcTree()
+        self.assertEqual([ tree.tree(pid) for pid in pids ], [set(), set(), set()])
+        with self.assertRaises(SystemExit):
+            self.ctrl.kill_task(taskid=reserved)
+        for taskid in tasks + [reserved]:
+            self.ctrl._DB.delete_task(taskid=taskid)
+
+    def test100_stats(self):
+        taskid = self.ctrl.reserve(taskname='Stats')
+        js = json.loads(self.ctrl.get_stats(taskid=taskid))
+        self.assertEqual(js['samples'], 0)
+        # 2 samples of 1s : 50% then 100% of a cpu
+        self.ctrl._DB.add_task_sample(taskid=taskid, sample={ 'elapsed' : 1000, 'cpu' : 500, 'rss' : 1000, 'io_read' : 4096, 'io_write' : 0, 'threads' : 1 })
+        self.ctrl._DB.add_task_sample(taskid=taskid, sample={ 'elapsed' : 2000, 'cpu' : 1000, 'rss' : 3000, 'io_read' : 0, 'io_write' : 8192, 'threads' : 3 })
+        js = json.loads(self.ctrl.get_stats(taskid=taskid))
+        self.assertEqual(js['samples'], 2)
+        self.assertEqual(js['elapsed'], 2000)
+        self.assertEqual(js['cpu'], { 'peak' : 100.0, 'avg' : 75.0 })
+        self.assertEqual(js['rss'], { 'peak' : 3000, 'avg' : 2000 })
+        self.assertEqual(js['threads'], { 'peak' : 3, 'avg' : 2.0 })
+        self.assertEqual(js['io_read'], { 'total' : 4096, 'peak_rate' : 4096 })
+        self.assertEqual(js['io_write'], { 'total' : 8192, 'peak_rate' : 8192 })
+        self.assertTrue(js['running'])
+        # once ended : the summary archived in its latest history entry
+        stats = summarize_samples(self.ctrl._DB.fetch_task_samples(taskid=taskid))
+        self.ctrl._DB.delete_task(taskid=taskid)
+        self.ctrl._DB.add_history(entry={ 'taskid' : taskid, 'taskname' : 'Stats', 'info1' : '', 'info2' : '', 'info3' : '',
+                                          'termsignal' : '0', 'termerror' : '', 'starttime' : 0, 'endtime' : 2,
+                                          'duration' : 2, 'feedback' : None, 'stats' : stats })
+        js = json.loads(self.ctrl.get_stats(taskid=taskid))
+        self.assertFalse(js['running'])
+        self.assertEqual(js['cpu'], { 'peak' : 100.0, 'avg' : 75.0 })
+        self.assertEqual(js['historyid'], self.ctrl._DB.fetch_history(newest_first=True, limit=1)[0].id)
+        with self.assertRaises(SystemExit):
+            self.ctrl.get_stats(taskid=999999)
+
 
 if __name__ == '__main__':
     unittest.main()
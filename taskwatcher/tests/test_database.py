@@ -8,7 +8,9 @@ import logging as log
 import unittest
 import json
 import time
-from database import Database
+import os
+import sqlite3
+from database import Database, SCHEMA_VERSION, FEEDBACK_FORMAT, Task, HistoryEntry, TaskSample, summarize_samples
 
 # create logger
 log.basicConfig(
@@ -30,6 +32,67 @@ class DatabaseTestCase(unittest.TestCase):
     def test010_create(self):
         self.db.create()
 
+    # Indexes used by the hot queries
+    def test012_query_plans(self):
+        plans = {
+            'tasks_name' : ("SELECT id, name, status FROM tasks WHERE name=?", ['MyTask']),
+            'tasks_status' : ("DELETE FROM tasks WHERE status='RESERVED' AND reservetime < ?", [0]),
+            'history_taskname' : ("SELECT id FROM history WHERE taskname=? ORDER BY id DESC", ['MyTask']),
+            'history_endtime' : ("SELECT id FROM history WHERE endtime >= ? AND endtime < ?", [0, 1]),
+            'history_taskid' : ("SELECT id FROM history WHERE taskid=?", [1]),
+            'feedback_kv_key' : ("SELECT id FROM tasks WHERE id IN (SELECT taskid FROM feedback_kv WHERE key=? AND value=?)", ['k', 'v']),
+            'history_kv_key' : ("SELECT id FROM history WHERE id IN (SELECT historyid FROM history_kv WHERE key=? AND value=?)", ['k', 'v']),
+        }
+        for index in plans:
+            (statement, params) = plans[index]
+            plan = " ".join(self.db.query_plan(statement=statement, params=params))
+            self.assertIn("USING", plan)
+            self.assertIn(index, plan)
+
+    # Connection reuse
+    def test015_connection_reused(self):
+        connection = self.db._connect()
+        self.assertIs(self.db._connect(), connection)
+        self.db.close()
+        self.assertIsNot(self.db._connect(), connection)
+
+    def test016_context_manager(self):
+        with Database(db='sqlite.db') as db:
+            self.assertEqual(db.get_number_of_tasks(), 0)
+        self.assertIsNone(db._DB)
+
+    # Durability profile
+    def test017_durability(self):
+        self.assertEqual(self.db.get_config(key='durability'), 'safe')
+        self.assertEqual(self.db._connect().execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        self.db.set_durability(durability='fast')
+        db = Database(db='sqlite.db')
+        self.assertEqual(db._connect().execute("PRAGMA synchronous").fetchone()[0], 0)
+        db.set_durability(durability='safe')
+        db.close()
+
+    # Schema upgrade from a database created before schema versioning
+    def test018_upgrade(self):
+        if os.path.isfile('legacy.db'):
+            os.remove('legacy.db')
+        connection = sqlite3.connect('legacy.db')
+        connection.execute('''CREATE TABLE tasks (id INTEGER PRIMARY KEY, name TEXT, info1
+                           TEXT, info2 TEXT, info3 TEXT, pid INTEGER, status TEXT, feedback INTEGER,
+                           reservetime INTEGER, starttime INTEGER, duration INTEGER, lastupdate INTEGER, timeout INTEGER)''')
+        connection.execute('''CREATE TABLE feedbacks (id INTEGER PRIMARY KEY, feedback BLOB, lastupdate INTEGER)''')
+        connection.execute('''CREATE TABLE history (id INTEGER PRIMARY KEY, taskid INTEGER,
+                           taskname TEXT, info1 TEXT, info2 TEXT, info3 TEXT, termsignal TEXT, termerror TEXT,
+                           starttime INTEGER, endtime INTEGER, duration INTEGER, feedback BLOB)''')
+        connection.commit()
+        connection.close()
+        with Database(db='legacy.db') as db:
+            self.assertEqual(db.get_number_of_tasks(), 0)
+            self.assertEqual(db._connect().execute("PRAGMA user_version").fetchone()[0], SCHEMA_VERSION)
+            db.set_config(key='durability', value='paranoid')
+        for f in ['legacy.db', 'legacy.db-wal', 'legacy.db-shm']:
+            if os.path.isfile(f):
+                os.remove(f)
+
     # Reserve task
     def test020_reserve(self):
         self.db.reserve_task()
@@ -50,6 +113,15 @@ class DatabaseTestCase(unittest.TestCase):
         nb_tasks = self.db.get_number_of_tasks()
         self.assertEqual(nb_tasks, 3)
 
+    # Native records
+    def test045_fetch_tasks(self):
+        tasks = self.db.fetch_tasks(taskid=1)
+        self.assertEqual(len(tasks), 1)
+        self.assertIsInstance(tasks[0], Task)
+        self.assertEqual(tasks[0].id, 1)
+        self.assertEqual(tasks[0].status, 'RESERVED')
+        self.assertEqual(self.db.fetch_tasks(reserved=False), [])
+
     # Update task
     def test050_update_task(self):
         update = {}
@@ -64,6 +136,16 @@ class DatabaseTestCase(unittest.TestCase):
         js = json.loads(self.db.get_tasks(taskid='1'))
         self.assertEqual(js['1']['status'], 'RUNNING')
 
+    def test055_update_task_partial(self):
+        js = json.loads(self.db.get_tasks(taskid='1'))
+        self.db.update_task(taskid='1', update={'duration' : 42}, do_lastupdate=False)
+        updated = json.loads(self.db.get_tasks(taskid='1'))
+        self.assertEqual(updated['1']['duration'], 42)
+        self.assertEqual(updated['1']['lastupdate'], js['1']['lastupdate'])
+        self.assertEqual(updated['1']['info1'], 'information1')
+        with self.assertRaises(SystemExit):
+            self.db.update_task(taskid='1', update={'id=0, name' : 'injected'})
+
     # Database update
     def force_task_started(self, taskid='1'):
         # Force some tasks to be started (in timeout state)
@@ -77,7 +159,26 @@ class DatabaseTestCase(unittest.TestCase):
 
     def test060_update(self):
         self.force_task_started(taskid='1')
-        self.db.update()
+        summary = self.db.update()
+        self.assertIn(1, summary['timeout'])
+        js = json.loads(self.db.get_tasks(taskid='1'))
+        self.assertGreaterEqual(js['1']['duration'], 100)
+
+    def test065_update_many(self):
+        now = int(time.time())
+        connection = self.db._connect()
+        connection.executemany('''INSERT INTO tasks(id, name, status, reservetime, starttime, timeout)
+                               VALUES(?,?,?,?,?,?)''',
+                               [ (1000+i, 'Sweep', 'RUNNING', now-50, now-50, 10+i%100) for i in range(10000) ]
+                               + [ (20000+i, 'Sweep', 'RESERVED', now-50, None, None) for i in range(10) ])
+        connection.commit()
+        summary = self.db.update()
+        self.assertEqual(summary['expired'], 10)
+        self.assertGreaterEqual(summary['updated'], 10000)
+        self.assertIn(1000, summary['timeout'])
+        self.assertNotIn(1090, summary['timeout'])
+        connection.execute("DELETE FROM tasks WHERE name='Sweep'")
+        connection.commit()
 
     def test070_timeout_status(self):
         self.force_task_started(taskid='1')
@@ -99,9 +200,75 @@ class DatabaseTestCase(unittest.TestCase):
         js = json.loads(self.db.get_feedbacks(taskid='1'))
         self.assertEqual(js['1']['feedback'], feedback)
 
+    def test095_feedback_follows_task(self):
+        # Feedback is stored under the taskid and deleted with its task
+        taskid = self.db.reserve_task(taskname='Feedback')
+        self.db.update_feedback(taskid=taskid, feedback='{"progress": "1"}')
+        self.db.update_feedback(taskid=taskid, feedback='{"progress": "2"}')
+        feedbacks = self.db.fetch_feedbacks(taskid=taskid)
+        self.assertEqual(len(feedbacks), 1)
+        self.assertEqual(feedbacks[0].id, taskid)
+        self.assertEqual(feedbacks[0].feedback, '{"progress": "2"}')
+        self.db.delete_task(taskid=taskid)
+        self.assertEqual(self.db.fetch_feedbacks(taskid=taskid), [])
+
+    def test097_feedback_kv(self):
+        # Feedback key/values indexed, only changed pairs written
+        tasks = [ self.db.reserve_task(taskname='KV') for i in range(3) ]
+        for (i, taskid) in enumerate(tasks):
+            self.db.update_feedback(taskid=taskid, feedback=json.dumps({'testcase_id' : '00{}'.format(i%2), 'progress' : i}))
+        self.assertEqual([ t.id for t in self.db.fetch_tasks(where={'testcase_id' : '000'}) ], [tasks[0], tasks[2]])
+        self.assertEqual([ t.id for t in self.db.fetch_tasks(where={'testcase_id' : '000', 'progress' : 2}) ], [tasks[2]])
+        self.db.update_feedback(taskid=tasks[2], feedback=json.dumps({'testcase_id' : '001'}))
+        self.assertEqual([ t.id for t in self.db.fetch_tasks(where={'testcase_id' : '001'}) ], [tasks[1], tasks[2]])
+        rows = self.db._connect().execute("SELECT key, value FROM feedback_kv WHERE taskid=?", [tasks[2]]).fetchall()
+        self.assertEqual(rows, [('testcase_id', '001')])
+        for taskid in tasks:
+            self.db.delete_task(taskid=taskid)
+        self.assertEqual(self.db._connect().execute("SELECT count(*) FROM feedback_kv").fetchone()[0], 0)
+
+    def test098_update_tasks_batch(self):
+        # Several tasks and feedbacks written in one transaction (supervisor tick)
+        tasks = [ self.db.reserve_task(taskname='Batch') for i in range(4) ]
+        updates = { taskid : { 'duration' : taskid } for taskid in tasks }
+        updates[tasks[0]] = { 'duration' : 0, 'info1' : 'first' }
+        self.assertEqual(self.db.update_tasks(updates=updates), 4)
+        self.assertEqual(self.db.update_tasks(updates={}), 0)
+        js = json.loads(self.db.get_tasks())
+        self.assertEqual(js[str(tasks[1])]['duration'], tasks[1])
+        self.assertEqual(js[str(tasks[0])]['info1'], 'first')
+        with self.assertRaises(SystemExit):
+            self.db.update_tasks(updates={ tasks[0] : { 'id=0, name' : 'injected' } })
+        self.db.update_feedbacks(feedbacks={ taskid : json.dumps({'progress' : taskid}) for taskid in tasks })
+        self.assertEqual([ t.id for t in self.db.fetch_tasks(where={'progress' : tasks[3]}) ], [tasks[3]])
+        for taskid in tasks:
+            self.db.delete_task(taskid=taskid)
+
+    def test099_task_samples(self):
+        # Resource samples of a running task, merged by pairs, deleted with the task
+        taskid = self.db.reserve_task(taskname='Sampled')
+        for i in range(1, 6):
+            sample = { 'elapsed' : i * 100, 'cpu' : 10, 'rss' : 1000 * i, 'io_read' : 1, 'io_write' : 2, 'threads' : i % 3 }
+            self.assertEqual(self.db.add_task_sample(taskid=taskid, sample=sample), i)
+        samples = self.db.fetch_task_samples(taskid=taskid)
+        self.assertIsInstance(samples[0], TaskSample)
+        self.assertEqual([ s.elapsed for s in samples ], [100, 200, 300, 400, 500])
+        self.assertEqual(self.db.downsample_task_samples(taskid=taskid), 3)
+        samples = self.db.fetch_task_samples(taskid=taskid)
+        self.assertEqual(samples[0], TaskSample(elapsed=200, cpu=20, rss=2000, io_read=2, io_write=4, threads=2))
+        self.assertEqual(samples[-1], TaskSample(elapsed=500, cpu=10, rss=5000, io_read=1, io_write=2, threads=2))
+        stats = summarize_samples(samples)
+        self.assertEqual(stats['samples'], 3)
+        self.assertEqual(stats['rss']['peak'], 5000)
+        self.db.delete_task(taskid=taskid)
+        self.assertEqual(self.db.fetch_task_samples(taskid=taskid), [])
+
     # history
 
     def add_history(self):
+        self.db.add_history(entry=self.history_entry())
+
+    def history_entry(self):
         entry = {}
         entry['taskid'] = 100
         entry['taskname'] = 'MyTestTask'
@@ -114,12 +281,71 @@ class DatabaseTestCase(unittest.TestCase):
         entry['endtime'] = 1588875292
         entry['duration'] = 1000
         entry['feedback'] = "{ 'person' : 'john', 'animal' : { 'name' : 'Lune', 'color' : 'black', 'gender' : 'female'} }"
-        self.db.add_history(entry=entry)
+        return entry
 
     def test100_get_history(self):
         self.add_history()
         js = json.loads(self.db.get_history())
         self.assertEqual(js['1']['taskname'],"MyTestTask")
+        entry = self.db.fetch_history()[0]
+        self.assertIsInstance(entry, HistoryEntry)
+        self.assertEqual(entry.taskid, 100)
+
+    def test105_history_feedback_snapshot(self):
+        # Final feedback stored compressed, decoded only on request
+        feedback = { 'progress' : '100', 'result' : 'passed ' * 100 }
+        self.db.add_history(entry=dict(self.history_entry(), feedback=feedback, tail='[result]passed\n'))
+        entry = self.db.fetch_history(newest_first=True, limit=1)[0]
+        self.assertIsNone(entry.feedback)
+        entry = self.db.fetch_history(newest_first=True, limit=1, with_feedback=True)[0]
+        self.assertEqual(entry.feedback, { 'feedback' : feedback, 'tail' : '[result]passed\n' })
+        blob = self.db._connect().execute("SELECT feedback FROM history WHERE id=?", [entry.id]).fetchone()[0]
+        self.assertEqual(blob[0], FEEDBACK_FORMAT)
+        self.assertLess(len(blob), len(feedback['result']))
+        self.assertEqual([ e.id for e in self.db.fetch_history(where={'progress' : '100'}) ], [entry.id])
+        self.assertEqual(self.db.fetch_history(where={'progress' : '99'}), [])
+        # text feedback from former entries is returned as is
+        entry = self.db.fetch_history(limit=1, with_feedback=True)[0]
+        self.assertEqual(entry.feedback, self.history_entry()['feedback'])
+        self.db._connect().execute("DELETE FROM history WHERE id > 1")
+        self.db._connect().execute("DELETE FROM history_kv")
+        self.db._connect().commit()
+
+    def test110_get_history_pages(self):
+        for i in range(10):
+            self.add_history()
+        self.db.add_history(entry=dict(self.history_entry(), taskname='Other', endtime=1588879000))
+        latest = self.db.fetch_history(limit=4, newest_first=True)
+        self.assertEqual([ e.id for e in latest ], [12, 11, 10, 9])
+        page = self.db.fetch_history(limit=4, after_id=latest[-1].id, newest_first=True)
+        self.assertEqual([ e.id for e in page ], [8, 7, 6, 5])
+        page = self.db.fetch_history(limit=5, after_id=8)
+        self.assertEqual([ e.id for e in page ], [9, 10, 11, 12])
+        self.assertEqual(len(self.db.fetch_history(taskname='MyTestTask')), 11)
+        self.assertEqual(len(self.db.fetch_history(since=1588876000)), 1)
+        self.assertEqual(len(self.db.fetch_history(until=1588876000, status='SIGTERM')), 11)
+        js = json.loads(self.db.get_history(taskname='Other'))
+        self.assertEqual(list(js), ['12'])
+
+    def test120_purge_history(self):
+        # 12 entries : 11 MyTestTask and 1 Other (id 12)
+        self.assertEqual(self.db.purge_history(keep_per_name=8, batch=2), 3)
+        self.assertEqual([ e.id for e in self.db.fetch_history() ][:2], [4, 5])
+        if os.path.isfile('archive.db'):
+            os.remove('archive.db')
+        self.assertEqual(self.db.purge_history(keep_rows=6, batch=4, archive='archive.db'), 3)
+        self.assertEqual([ e.id for e in self.db.fetch_history() ], [7, 8, 9, 10, 11, 12])
+        archived = list(self.db.iter_archive(archive='archive.db'))
+        self.assertEqual([ e['id'] for e in archived ], [4, 5, 6])
+        self.assertEqual(archived[0]['taskname'], 'MyTestTask')
+        self.db.add_history(entry=dict(self.history_entry(), endtime=int(time.time()), feedback={'result' : 'passed'}))
+        self.assertEqual(self.db.purge_history(keep_days=1), 6)
+        self.assertEqual(len(self.db.fetch_history(where={'result' : 'passed'})), 1)
+        self.assertEqual(self.db.purge_history(keep_rows=0), 1)
+        self.assertEqual(self.db.fetch_history(), [])
+        self.assertEqual(self.db._connect().execute("SELECT count(*) FROM history_kv").fetchone()[0], 0)
+        os.remove('archive.db')
+
 
 if __name__ == '__main__':
     unittest.main()
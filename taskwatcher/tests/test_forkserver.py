@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+'''
+Created on Oct 18, 2026
+
+@author: cgustave
+'''
+import logging as log
+import unittest
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from database import Database
+from launch import Launch, send_request
+
+# create logger
+log.basicConfig(
+    format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-10.10s.\
+    %(funcName)-20.20s:%(lineno)5d] %(message)s',
+    datefmt='%Y%m%d:%H:%M:%S',
+    filename='debug.log',
+    level=log.DEBUG)
+
+log.debug("Start unittest")
+
+class ForkServerTestCase(unittest.TestCase):
+
+    # One fork server process for all tests
+    @classmethod
+    def setUpClass(cls):
+        cls.path = tempfile.mkdtemp()
+        cls.db = os.path.join(cls.path, 'sqlite.db')
+        cls.socket = os.path.join(cls.path, 'forkserver.sock')
+        Database(db=cls.db).create()
+        forkserver = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'forkserver.py')
+        cls.process = subprocess.Popen([sys.executable, forkserver, '--db', cls.db, '--socket', cls.socket, '--debug'])
+        end = time.monotonic() + 10
+        while not os.path.exists(cls.socket) and time.monotonic() < end:
+            time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        reply = send_request(path=cls.socket, request={ 'op' : 'shutdown' })
+        cls.process.wait(timeout=10)
+        assert reply['ok']
+
+    # Always run before any test
+    def setUp(self):
+        self.DB = Database(db=self.db)
+        history = self.DB.fetch_history(newest_first=True, limit=1)
+        self.after_id = history[0].id if history else 0
+
+    def tearDown(self):
+        self.DB.close()
+
+    def wait_history(self, count=1, timeout=10):
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            entries = self.DB.fetch_history(after_id=self.after_id)
+            if len(entries) >= count:
+                return entries
+            time.sleep(0.1)
+        return []
+
+    def test010_launch(self):
+        # Launchers forked from the server, tasks archived as with launch.py
+        taskids = []
+        for i in range(3):
+            taskid = self.DB.reserve_task(taskname='Forked')
+            command = "tests/testprog.py --scenario feedbacking --textfile tests/textfile_progress.txt --delay 0.01 --feedback {}/feedback_{}.log".format(self.path, taskid)
+            reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : command, 'taskid' : taskid,
+                                                             'feedpath' : self.path, 'timeout' : 10, 'cwd' : os.getcwd() })
+            self.assertTrue(reply['ok'])
+            self.assertEqual(reply['taskid'], taskid)
+            taskids.append(taskid)
+        entries = self.wait_history(count=3)
+        self.assertEqual(sorted([ e.taskid for e in entries ]), sorted(taskids))
+        self.assertEqual([ e.termsignal for e in entries ], ['0', '0', '0'])
+
+    def test020_reservation(self):
+        # Automatic reservation without feedback, refused otherwise
+        reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : "tests/sayhi.sh", 'name' : 'Auto', 'cwd' : os.getcwd() })
+        self.assertTrue(reply['ok'])
+        self.assertEqual(self.wait_history()[0].taskname, 'Auto')
+        reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : "tests/sayhi.sh", 'taskid' : 9999 })
+        self.assertFalse(reply['ok'])
+        reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : "tests/sayhi.sh --feedback /tmp/f.log" })
+        self.assertFalse(reply['ok'])
+        reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : "tests/sayhi.sh", 'feedpath' : '/nonexistent' })
+        self.assertFalse(reply['ok'])
+        reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : "tests/sayhi.sh", 'unknown' : 1 })
+        self.assertFalse(reply['ok'])
+        # Launch options a client may not set
+        for key in ('supervisor', 'forkserver', 'db', 'debug'):
+            reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : "tests/sayhi.sh", key : self.socket })
+            self.assertFalse(reply['ok'])
+            self.assertIn(key, reply['error'])
+
+    def test030_launch_forkserver(self):
+        # launch.py --forkserver : returns once the launcher is forked
+        taskid = self.DB.reserve_task(taskname='Zygote')
+        lnc = Launch(db=self.db, taskid=taskid, name='Zygote', forkserver=self.socket, debug=True)
+        self.assertTrue(lnc.execute(command="tests/testprog.py --scenario sleeping --sleep 1"))
+        self.assertTrue(lnc.forked_pid)
+        entries = self.wait_history()
+        self.assertEqual(entries[0].taskid, taskid)
+        self.assertEqual(entries[0].taskname, 'Zygote')
+
+    def test040_socket_mode(self):
+        # Only our user may ask the fork server to run commands
+        self.assertEqual(os.stat(self.socket).st_mode & 0o777, 0o600)
+
+    def test050_caller_env(self):
+        # The task runs with the environment of launch.py, not the fork server one
+        script = os.path.join(self.path, 'feeder.sh')
+        with open(script, 'w') as F:
+            F.write('#!/bin/sh\necho "[var]$TW_TEST_VAR" > "$2"\n')
+        os.chmod(script, stat.S_IRWXU)
+        taskid = self.DB.reserve_task(taskname='Exported')
+        lnc = Launch(db=self.db, taskid=taskid, feedpath=self.path, feedback_tail=100, forkserver=self.socket, debug=True)
+        os.environ['TW_TEST_VAR'] = 'from the caller'
+        try:
+            self.assertTrue(lnc.execute(command="{} --feedback {}/feedback_{}.log".format(script, self.path, taskid)))
+        finally:
+            del os.environ['TW_TEST_VAR']
+        entries = self.wait_history()
+        self.assertEqual(entries[0].taskid, taskid)
+        snapshot = self.DB.fetch_history(taskid=taskid, with_feedback=True, newest_first=True, limit=1)[0].feedback
+        self.assertIn('[var]from the caller', snapshot['tail'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,8 +7,12 @@ Created on May 8, 2020
 import logging as log
 import unittest
 import json
+import os
+import tempfile
+import time
 
-from launch import Launch
+from launch import Launch, command_argv
+from proctree import ProcTree
 from control import Control
 
 # create logger
@@ -34,11 +38,150 @@ class LaunchTestCase(unittest.TestCase):
         self.ctl = Control(db='sqlite.db')
         self.ctl.initialize()
         self.ctl.reserve()
-        self.lnc = Launch(db='sqlite.db', feedpath='/tmp', taskid=1, info1='INFO1', info2='INFO2', info3='INFO3', timeout=10, debug=True)
+        self.lnc = Launch(db='sqlite.db', feedpath='/tmp', taskid=1, info1='INFO1', info2='INFO2', info3='INFO3', timeout=10, feedback_tail=100, debug=True)
         command = "tests/testprog.py --scenario progressing --feedback /tmp/feedback_1.log --delay 0.002 --debug"
         result = self.lnc.execute(command=command)
         print("test20 result={}".format(result))
         self.assertTrue(result)
+        entry = self.lnc._DB.fetch_history(newest_first=True, limit=1, with_feedback=True)[0]
+        self.assertEqual(entry.taskid, 1)
+        self.assertTrue(entry.feedback['feedback'])
+        self.assertLessEqual(len(entry.feedback['tail']), 100)
+
+    def test30_ingest_feedback(self):
+        # Feedback stored in db only on change, at most once per interval
+        self.ctl = Control(db='sqlite.db')
+        taskid = self.ctl.reserve(taskname='Ingest')
+        self.lnc = Launch(db='sqlite.db', feedpath=tempfile.mkdtemp(), taskid=taskid, feedback_interval=3600)
+        with open(self.lnc.updatefile_name(), 'w') as F:
+            F.write("[progress]1\n")
+        self.assertTrue(self.lnc._ingest_feedback())
+        with open(self.lnc.updatefile_name(), 'a') as F:
+            F.write("[progress]2\n")
+        self.assertFalse(self.lnc._ingest_feedback())
+        self.lnc.feedback_interval = 0
+        self.assertTrue(self.lnc._ingest_feedback())
+        self.assertFalse(self.lnc._ingest_feedback())
+        feedbacks = json.loads(self.lnc._DB.get_feedbacks(taskid=taskid))
+        self.assertEqual(json.loads(feedbacks[str(taskid)]['feedback']), {'progress': '2'})
+        self.lnc._DB.delete_task(taskid=taskid)
+
+    def test40_compact_feedback(self):
+        # Compaction above compact_size, only for append mode writers
+        self.lnc = Launch(db='sqlite.db', feedpath=tempfile.mkdtemp(), taskid=1, compact_size=1000)
+        self.lnc.forked_pid = os.getpid()
+        with open(self.lnc.updatefile_name(), 'w') as writer:
+            writer.write("[progress]0\n" * 100)
+            writer.flush()
+            self.assertFalse(self.lnc._compact_feedback())
+        self.lnc._compacted_size = 0
+        with open(self.lnc.updatefile_name(), 'a') as writer:
+            self.assertTrue(self.lnc._compact_feedback())
+            self.assertEqual(os.path.getsize(self.lnc.updatefile_name()), len("[progress]0\n"))
+            # below compact_size again
+            writer.write("[progress]1\n" * 10)
+            writer.flush()
+            self.assertFalse(self.lnc._compact_feedback())
+        os.remove(self.lnc.updatefile_name())
+
+    def test50_heartbeat_timeout(self):
+        # Child not writing its feedback file is killed after timeout
+        self.ctl = Control(db='sqlite.db')
+        taskid = self.ctl.reserve(taskname='Silent')
+        feedpath = tempfile.mkdtemp()
+        self.lnc = Launch(db='sqlite.db', feedpath=feedpath, taskid=taskid, timeout=2, debug=True)
+        command = "tests/testprog.py --scenario sleeping --sleep 30 --feedback {}/feedback_{}.log".format(feedpath, taskid)
+        start = time.monotonic()
+        self.assertTrue(self.lnc.execute(command=command))
+        self.assertLess(time.monotonic() - start, 4)
+        entry = self.lnc._DB.fetch_history(newest_first=True, limit=1)[0]
+        self.assertEqual(entry.taskid, taskid)
+        self.assertEqual(entry.termerror, 'timeout')
+
+    def test60_child_exit_wakeup(self):
+        # Child exit wakes the father up before father_check_delay (pidfd, then SIGCHLD)
+        self.ctl = Control(db='sqlite.db')
+        for pidfd in (True, False):
+            taskid = self.ctl.reserve(taskname='Quick')
+            feedpath = tempfile.mkdtemp()
+            self.lnc = Launch(db='sqlite.db', feedpath=feedpath, taskid=taskid, timeout=10, debug=True)
+            self.lnc.pidfd = pidfd
+            self.lnc.father_check_delay = 5
+            command = "tests/testprog.py --scenario sleeping --sleep 0 --feedback {}/feedback_{}.log".format(feedpath, taskid)
+            start = time.monotonic()
+            self.assertTrue(self.lnc.execute(command=command))
+            self.assertLess(time.monotonic() - start, 3)
+            self.assertIsNone(self.lnc._exit_fd)
+            entry = self.lnc._DB.fetch_history(newest_first=True, limit=1)[0]
+            self.assertEqual(entry.taskid, taskid)
+
+    def test70_spawn_argv(self):
+        # Arguments kept whole (list, or quoted string), with fork and posix_spawn
+        self.assertEqual(command_argv("a 'b c' d\\ e"), ['a', 'b c', 'd e'])
+        self.ctl = Control(db='sqlite.db')
+        feedpath = tempfile.mkdtemp()
+        textfile = os.path.join(feedpath, 'text file.txt')
+        with open(textfile, 'w') as F:
+            F.write("[argv]kept\n")
+        for spawn in ('posix_spawn', 'fork'):
+            taskid = self.ctl.reserve(taskname='Argv')
+            feedfile = "{}/feedback_{}.log".format(feedpath, taskid)
+            self.lnc = Launch(db='sqlite.db', feedpath=feedpath, taskid=taskid, timeout=10, spawn=spawn, debug=True)
+            if spawn == 'fork':
+                command = "tests/testprog.py --scenario feedbacking --delay 0 --textfile '{}' --feedback {}".format(textfile, feedfile)
+            else:
+                command = ['tests/testprog.py', '--scenario', 'feedbacking', '--delay', '0', '--textfile', textfile, '--feedback', feedfile]
+            self.assertTrue(self.lnc.execute(command=command))
+            entry = self.lnc._DB.fetch_history(newest_first=True, limit=1, with_feedback=True)[0]
+            self.assertEqual(entry.taskid, taskid)
+            self.assertEqual(entry.termsignal, '0')
+            self.assertEqual(entry.feedback['feedback'], {'argv' : 'kept'})
+        with self.assertRaises(SystemExit):
+            Launch(db='sqlite.db', spawn='vfork')
+
+    def test80_process_group(self):
+        # Task alive while its process group is, killed with its whole tree on timeout
+        self.ctl = Control(db='sqlite.db')
+        taskid = self.ctl.reserve(taskname='Group')
+        self.lnc = Launch(db='sqlite.db', taskid=taskid, debug=True)
+        self.lnc.father_check_delay = 0.2
+        start = time.monotonic()
+        self.assertTrue(self.lnc.execute(command=['sh', '-c', 'sleep 1.5 & exit 0']))
+        self.assertGreaterEqual(time.monotonic() - start, 1.4)
+        self.assertEqual(self.lnc._DB.fetch_history(newest_first=True, limit=1)[0].termsignal, '0')
+
+        taskid = self.ctl.reserve(taskname='GroupTimeout')
+        feedpath = tempfile.mkdtemp()
+        self.lnc = Launch(db='sqlite.db', feedpath=feedpath, taskid=taskid, timeout=1, spawn='posix_spawn', debug=True)
+        command = ['sh', '-c', 'sleep 30 & sleep 30', 'sh', '--feedback', '{}/feedback_{}.log'.format(feedpath, taskid)]
+        self.assertTrue(self.lnc.execute(command=command))
+        self.assertEqual(self.lnc._DB.fetch_history(newest_first=True, limit=1)[0].termerror, 'timeout')
+        self.assertEqual(ProcTree().tree(self.lnc.forked_pid), set())
+
+    def test90_samples(self):
+        # Resource samples while the task runs, downsampled above max_samples
+        self.ctl = Control(db='sqlite.db')
+        taskid = self.ctl.reserve(taskname='Sampled')
+        self.lnc = Launch(db='sqlite.db', taskid=taskid, sample_interval=0.1, debug=True)
+        self.lnc.max_samples = 4
+        counts = []
+        add_task_sample = self.lnc._DB.add_task_sample
+        def add(**kwargs):
+            counts.append(add_task_sample(**kwargs))
+            self.assertGreaterEqual(kwargs['sample']['threads'], 1)
+            return counts[-1]
+        self.lnc._DB.add_task_sample = add
+        self.assertTrue(self.lnc.execute(command=['sleep', '1']))
+        self.assertTrue(counts)
+        self.assertLessEqual(max(counts), 4)
+        self.assertGreater(self.lnc.sample_interval, 0.1)
+        self.assertEqual(self.lnc._DB.fetch_task_samples(taskid=taskid), [])
+        # summary archived with the history entry
+        entry = self.lnc._DB.fetch_history(taskid=taskid, newest_first=True, limit=1, with_feedback=True)[0]
+        self.assertEqual(entry.taskname, 'Sampled')
+        self.assertTrue(entry.feedback['stats']['samples'])
+        self.assertGreater(entry.feedback['stats']['elapsed'], 0)
+        self.assertGreaterEqual(entry.feedback['stats']['threads']['peak'], 1)
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,8 +7,13 @@ Created on May 12, 2020
 import logging as log
 import unittest
 import json
+import os
+import random
+import re
+import subprocess
+import sys
 
-from parse import Parse
+from parse import Parse, ParseCache
 
 # create logger
 log.basicConfig(
@@ -20,6 +25,24 @@ log.basicConfig(
 
 log.debug("Start unittest")
 
+
+def reference(lines):
+    # line by line application of the feedback syntax
+    state = {}
+    for line in lines:
+        match = re.search(r"^\[([A-Za-z0-9\-_]*)\](.*)", line.strip())
+        if not match:
+            continue
+        (key, value) = match.groups()
+        if not key:
+            state = {}
+        elif value:
+            state[key] = value
+        else:
+            state.pop(key, None)
+    return state
+
+
 class ParseTestCase(unittest.TestCase):
 
     # Always run before any test
@@ -31,6 +54,224 @@ class ParseTestCase(unittest.TestCase):
         js = json.loads(self.parse.get_data())
         self.assertEqual(js['town'], "Paris")
 
+    def test_poll_file(self):
+        feedback = 'feedback_poll.log'
+        with open(feedback, 'w') as F:
+            F.write("[town]London\n[progress]1\n[person]jo")
+        self.assertTrue(self.parse.poll_file(feedback))
+        self.assertEqual(self.parse.dict, {'town' : 'London', 'progress' : '1'})
+
+        # nothing new, then the end of the incomplete line and more lines
+        self.assertFalse(self.parse.poll_file(feedback))
+        with open(feedback, 'a') as F:
+            F.write("e\n[progress]2\n[town]\n")
+        self.assertTrue(self.parse.poll_file(feedback))
+        self.assertEqual(self.parse.dict, {'progress' : '2', 'person' : 'joe'})
+
+        # truncated and rewritten : full parse
+        with open(feedback, 'w') as F:
+            F.write("[country]France\n")
+        self.assertTrue(self.parse.poll_file(feedback))
+        self.assertEqual(self.parse.dict, {'country' : 'France'})
+
+        # rewritten in place with a longer content
+        with open(feedback, 'w') as F:
+            F.write("[country]Italy\n[town]Roma\n")
+        self.parse.poll_file(feedback)
+        self.assertEqual(self.parse.dict, {'country' : 'Italy', 'town' : 'Roma'})
+
+        # replaced by a new file
+        os.remove(feedback)
+        with open(feedback, 'w') as F:
+            F.write("[town]Paris\n")
+        self.parse.poll_file(feedback)
+        self.assertEqual(self.parse.dict, {'town' : 'Paris'})
+        os.remove(feedback)
+
+    def test_poll_file_same_as_load_file(self):
+        self.parse.chunk_size = 7
+        self.parse.poll_file("tests/textfile_mixed.txt")
+        parse = Parse()
+        parse.load_file("tests/textfile_mixed.txt")
+        self.assertEqual(self.parse.dict, parse.dict)
+
+    def test_clear_all(self):
+        feedback = 'feedback_clear.log'
+        with open(feedback, 'w') as F:
+            F.write("[town]London\n[]\n[progress]100\n")
+        self.parse.load_file(feedback)
+        self.assertEqual(self.parse.dict, {'progress' : '100'})
+        os.remove(feedback)
+
+    def test_cache(self):
+        # Unchanged files are served from the cache, changed files are parsed
+        cache = ParseCache(size=2)
+        files = [ 'feedback_cache_{}.log'.format(i) for i in range(3) ]
+        for (i, feedback) in enumerate(files):
+            with open(feedback, 'w') as F:
+                F.write("[progress]{}\n".format(i))
+        for method in ('load_file', 'load_file', 'load_file_reverse'):
+            parser = Parse(cache=cache)
+            getattr(parser, method)(files[0])
+            self.assertEqual(parser.dict, {'progress' : '0'})
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        # result is a copy
+        parser.dict['progress'] = 'changed'
+        parser = Parse(cache=cache)
+        parser.load_file(files[0])
+        self.assertEqual(parser.dict, {'progress' : '0'})
+        # changed file
+        with open(files[0], 'a') as F:
+            F.write("[progress]10\n")
+        parser = Parse(cache=cache)
+        parser.load_file(files[0])
+        self.assertEqual(parser.dict, {'progress' : '10'})
+        self.assertEqual(cache.misses, 2)
+        # eviction of least recently used
+        for feedback in files:
+            Parse(cache=cache).load_file(feedback)
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['evictions'], 2)
+        for feedback in files:
+            os.remove(feedback)
+
+    def test_compact_file(self):
+        # Minimal equivalent file, writer in append mode keeps appending
+        feedback = 'feedback_compact.log'
+        writer = open(feedback, 'a')
+        for i in range(20000):
+            writer.write("[progress]{}\n# comment\n[town]Paris\n".format(i))
+        writer.write("[gone]soon\n[gone]\n[person]jo")
+        writer.flush()
+        self.parse.poll_file(feedback)
+        (before, after) = self.parse.compact_file(feedback)
+        self.assertEqual(after, os.path.getsize(feedback))
+        self.assertLess(after, before / 100)
+        with open(feedback, 'rb') as F:
+            lines = [ line for line in F if not line.startswith(b'#') ]
+        self.assertEqual(b''.join(lines), b"[progress]19999\n[town]Paris\n[person]jo")
+        writer.write("hn\n[progress]20000\n")
+        writer.close()
+        self.assertTrue(self.parse.poll_file(feedback))
+        full = Parse()
+        full.load_file(feedback)
+        self.assertEqual(self.parse.dict, full.dict)
+        self.assertEqual(self.parse.dict, {'progress' : '20000', 'town' : 'Paris', 'person' : 'john'})
+        os.remove(feedback)
+
+    def test_compact_file_copy(self):
+        # Less than a block to remove : compacted content copied, file truncated
+        feedback = 'feedback_compact_copy.log'
+        with open(feedback, 'w') as F:
+            for i in range(50):
+                F.write("[progress]{}\n# comment\n".format(i))
+            F.write("[person]jo")
+        (before, after) = self.parse.compact_file(feedback)
+        self.assertEqual(self.parse.compaction, 'copy')
+        self.assertEqual(after, os.path.getsize(feedback))
+        with open(feedback, 'rb') as F:
+            self.assertEqual(F.read(), b"[progress]49\n[person]jo")
+        os.remove(feedback)
+
+    def test_compact_file_already_compact(self):
+        # Nothing to drop : file untouched, next poll_file reads incrementally
+        feedback = 'feedback_compact_noop.log'
+        with open(feedback, 'w') as F:
+            F.write("[progress]1\n[town]Paris\n")
+        (before, after) = self.parse.compact_file(feedback)
+        self.assertEqual(before, after)
+        self.assertIsNone(self.parse.compaction)
+        with open(feedback, 'a') as F:
+            F.write("[progress]2\n")
+        offset = self.parse._offset
+        self.assertEqual(offset, before)
+        self.parse.dict['incremental'] = 'yes'
+        self.assertTrue(self.parse.poll_file(feedback))
+        self.assertEqual(self.parse.dict, {'progress' : '2', 'town' : 'Paris', 'incremental' : 'yes'})
+        self.assertEqual(self.parse._offset, offset + len("[progress]2\n"))
+        os.remove(feedback)
+
+    def test_compact_file_concurrent_writer(self):
+        # Lines appended by another process while the file is compacted are kept
+        feedback = 'feedback_compact_writer.log'
+        open(feedback, 'w').close()
+        writer = subprocess.Popen([sys.executable, '-c', """
+import os, sys, time
+fd = os.open(sys.argv[1], os.O_WRONLY | os.O_APPEND)
+for i in range(5000):
+    os.write(fd, "[marker{0}]x\\n[progress]{0}\\n# comment comment comment comment\\n".format(i).encode())
+    time.sleep(0.0001)
+""", feedback])
+        compactions = []
+        size = 0
+        while writer.poll() is None:
+            if os.path.getsize(feedback) > size + 16384:
+                (before, size) = self.parse.compact_file(feedback)
+                compactions.append(self.parse.compaction)
+        self.assertTrue(compactions)
+        full = Parse()
+        full.load_file(feedback)
+        lost = [ i for i in range(5000) if 'marker{}'.format(i) not in full.dict ]
+        if 'copy' in compactions and lost:
+            self.skipTest("filesystem without collapse, {} lines lost in the copy window".format(len(lost)))
+        self.assertEqual(lost, [])
+        self.assertEqual(full.dict['progress'], '4999')
+        os.remove(feedback)
+
+    def test_invalid_utf8(self):
+        feedback = 'feedback_utf8.log'
+        with open(feedback, 'wb') as F:
+            F.write(b"[a]\xff\xfeok\n\xff\n[b]caf\xc3\xa9\n")
+        self.parse.load_file(feedback)
+        self.assertEqual(self.parse.dict, {'a' : '\ufffd\ufffdok', 'b' : 'caf\u00e9'})
+        os.remove(feedback)
+
+    # Property : reverse reading gives the same state as forward reading
+    # checked on randomly generated feedback files (fixed seed)
+    def test_reverse_same_as_forward(self):
+        rnd = random.Random(20200512)
+        keys = ['a', 'b', 'c', 'dd', 'e_1', 'f-2']
+        values = ['1', 'value with spaces', 'caf\u00e9 \u20ac', ' x ', '[z]y', '0']
+        feedback = 'feedback_reverse.log'
+        for i in range(300):
+            lines = []
+            for n in range(rnd.randint(0, 40)):
+                kind = rnd.random()
+                if kind < 0.04:
+                    lines.append('[]')
+                elif kind < 0.08:
+                    lines.append('# comment [a]x')
+                elif kind < 0.12:
+                    lines.append('')
+                elif kind < 0.3:
+                    lines.append(' [{}]  '.format(rnd.choice(keys)))
+                else:
+                    lines.append('[{}]{}'.format(rnd.choice(keys), rnd.choice(values)))
+            with open(feedback, 'w', encoding='utf-8') as F:
+                F.write("\n".join(lines) + rnd.choice(['', '\n']))
+
+            forward = Parse()
+            forward.dict = {'a' : 'before', 'zz' : 'before'}
+            forward.load_file(feedback)
+            for chunk_size in [1, 3, 16, 4096]:
+                reverse = Parse()
+                reverse.dict = {'a' : 'before', 'zz' : 'before'}
+                reverse.chunk_size = chunk_size
+                reverse.load_file_reverse(feedback)
+                self.assertEqual(reverse.dict, forward.dict, "content={}".format(lines))
+
+            forward = Parse()
+            forward.load_file(feedback)
+            self.assertEqual(forward.dict, reference(lines), "content={}".format(lines))
+            reverse = Parse()
+            reverse.chunk_size = 5
+            reverse.load_file_reverse(feedback, keys=['a', 'dd'])
+            expected = dict([ (k, v) for (k, v) in forward.dict.items() if k in ['a', 'dd'] ])
+            self.assertEqual(reverse.dict, expected, "content={}".format(lines))
+        os.remove(feedback)
+
+
 if __name__ == '__main__':
     unittest.main()
 
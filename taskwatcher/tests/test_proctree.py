@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+'''
+Created on Oct 18, 2026
+
+@author: cgustave
+'''
+import logging as log
+import unittest
+import os
+import signal
+import time
+
+from proctree import ProcTree
+
+# create logger
+log.basicConfig(
+    format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-10.10s.\
+    %(funcName)-20.20s:%(lineno)5d] %(message)s',
+    datefmt='%Y%m%d:%H:%M:%S',
+    filename='debug.log',
+    level=log.DEBUG)
+
+log.debug("Start unittest")
+
+class ProcTreeTestCase(unittest.TestCase):
+
+    def spawn_tree(self):
+        # A task in its own group with a child in the group and one which left it
+        pid = os.posix_spawnp('sh', ['sh', '-c', 'setsid sleep 30 & sleep 30 & wait'], os.environ, setsid=True)
+        end = time.monotonic() + 5
+        while time.monotonic() < end:
+            tree = ProcTree(debug=True)
+            if len(tree.tree(pid)) == 3:
+                break
+            time.sleep(0.05)
+        return (pid, tree)
+
+    def test010_scan(self):
+        tree = ProcTree(debug=True)
+        self.assertIn(os.getpid(), tree.processes)
+        self.assertEqual(tree.processes[os.getpid()][0], os.getppid())
+        self.assertTrue(tree.alive(os.getpid()))
+        self.assertIn(os.getpid(), tree.group(os.getpgid(0)))
+
+    def test020_tree(self):
+        (pid, tree) = self.spawn_tree()
+        self.assertEqual(len(tree.tree(pid)), 3)
+        self.assertEqual(len(tree.group(pid)), 2)
+        self.assertEqual(len(tree.descendants([pid])), 2)
+        self.assertEqual(tree.kill(pid, signal.SIGKILL), 3)
+        os.waitpid(pid, 0)
+        end = time.monotonic() + 5
+        while ProcTree().tree(pid) and time.monotonic() < end:
+            time.sleep(0.05)
+        self.assertEqual(ProcTree().tree(pid), set())
+
+    def test030_usage(self):
+        end = time.process_time() + 0.05
+        while time.process_time() < end:
+            pass
+        tree = ProcTree(debug=True)
+        usage = tree.usage([os.getpid()])
+        self.assertGreater(usage['cpu'], 0)
+        self.assertGreater(usage['rss'], 0)
+        self.assertGreaterEqual(usage['threads'], 1)
+        self.assertGreaterEqual(usage['io_read'], 0)
+        self.assertEqual(tree.usage([]), { 'cpu' : 0, 'rss' : 0, 'threads' : 0, 'io_read' : 0, 'io_write' : 0 })
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+'''
+Created on Oct 18, 2026
+
+@author: cgustave
+'''
+import logging as log
+import unittest
+import json
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from database import Database
+from launch import Launch
+from supervisor import Supervisor, send_request
+
+# create logger
+log.basicConfig(
+    format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-10.10s.\
+    %(funcName)-20.20s:%(lineno)5d] %(message)s',
+    datefmt='%Y%m%d:%H:%M:%S',
+    filename='debug.log',
+    level=log.DEBUG)
+
+log.debug("Start unittest")
+
+class SupervisorTestCase(unittest.TestCase):
+
+    # One supervisor daemon (in a thread) for all tests
+    @classmethod
+    def setUpClass(cls):
+        cls.path = tempfile.mkdtemp()
+        cls.db = os.path.join(cls.path, 'sqlite.db')
+        cls.socket = os.path.join(cls.path, 'supervisor.sock')
+        Database(db=cls.db).create()
+        cls.supervisor = Supervisor(db=cls.db, socket=cls.socket, tick=0.2, feedback_interval=0, kill_grace=1, debug=True)
+        cls.thread = threading.Thread(target=cls.supervisor.run)
+        cls.thread.start()
+        end = time.monotonic() + 5
+        while not os.path.exists(cls.socket) and time.monotonic() < end:
+            time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        send_request(path=cls.socket, request={ 'op' : 'shutdown' })
+        cls.thread.join(timeout=10)
+
+    # Always run before any test
+    def setUp(self):
+        self.DB = Database(db=self.db)
+        history = self.DB.fetch_history(newest_first=True, limit=1)
+        self.after_id = history[0].id if history else 0
+
+    def tearDown(self):
+        self.DB.close()
+
+    def wait_history(self, taskid, timeout=10):
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            # taskids are reused once archived
+            for entry in self.DB.fetch_history(after_id=self.after_id):
+                if entry.taskid == taskid:
+                    return entry
+            time.sleep(0.1)
+        return None
+
+    def test010_launch_many(self):
+        # Several tasks owned by the same supervisor, archived when they exit
+        taskids = []
+        for i in range(5):
+            taskid = self.DB.reserve_task(taskname='Supervised')
+            command = "tests/testprog.py --scenario feedbacking --textfile tests/textfile_progress.txt --delay 0.01 --feedback {}/feedback_{}.log".format(self.path, taskid)
+            reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : command, 'taskid' : taskid,
+                                                             'feedpath' : self.path, 'timeout' : 10, 'feedback_tail' : 50 })
+            self.assertTrue(reply['ok'])
+            self.assertEqual(reply['taskid'], taskid)
+            taskids.append(taskid)
+
+        status = send_request(path=self.socket, request={ 'op' : 'status' })
+        self.assertTrue(status['ok'])
+
+        for taskid in taskids:
+            entry = self.wait_history(taskid)
+            self.assertIsNotNone(entry)
+            self.assertEqual(entry.termsignal, '0')
+            snapshot = self.DB.fetch_history(taskid=taskid, with_feedback=True, newest_first=True, limit=1)[0].feedback
+            self.assertIn('feedback', snapshot)
+            self.assertTrue(snapshot['tail'])
+            self.assertFalse(self.DB.fetch_tasks(taskid=taskid))
+
+    def test020_timeout(self):
+        # A task not writing its feedback file is killed after its timeout
+        taskid = self.DB.reserve_task(taskname='Silent')
+        command = "tests/testprog.py --scenario sleeping --sleep 30 --feedback {}/feedback_{}.log".format(self.path, taskid)
+        start = time.monotonic()
+        reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : command, 'taskid' : taskid,
+                                                         'feedpath' : self.path, 'timeout' : 1 })
+        self.assertTrue(reply['ok'])
+        entry = self.wait_history(taskid)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(entry.termerror, 'timeout')
+
+    def test030_refused(self):
+        # Unknown reservation, feedback without taskid, bad requests
+        reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : "tests/testprog.py --scenario sleeping", 'taskid' : 9999 })
+        self.assertFalse(reply['ok'])
+        reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : "tests/testprog.py --scenario sleeping --feedback /tmp/f.log" })
+        self.assertFalse(reply['ok'])
+        reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : "ls", 'unknown' : 1 })
+        self.assertFalse(reply['ok'])
+        reply = send_request(path=self.socket, request={ 'op' : 'dance' })
+        self.assertFalse(reply['ok'])
+
+    def test040_launch_handoff(self):
+        # launch.py --supervisor : task started by the supervisor, launcher returns at once
+        taskid = self.DB.reserve_task(taskname='Handoff')
+        lnc = Launch(db=self.db, feedpath=self.path, taskid=taskid, name='Handoff', supervisor=self.socket, debug=True)
+        start = time.monotonic()
+        self.assertTrue(lnc.execute(command="tests/testprog.py --scenario sleeping --sleep 1"))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(lnc.forked_pid)
+        task = json.loads(self.DB.get_tasks(taskid=taskid))
+        self.assertEqual(task[str(taskid)]['status'], 'RUNNING')
+        entry = self.wait_history(taskid)
+        self.assertEqual(entry.taskname, 'Handoff')
+
+    def test050_process_group(self):
+        # Task over once its process group is empty
+        taskid = self.DB.reserve_task(taskname='Group')
+        start = time.monotonic()
+        reply = send_request(path=self.socket, request={ 'op' : 'launch', 'command' : ['sh', '-c', 'sleep 1 & exit 0'], 'taskid' : taskid })
+        self.assertTrue(reply['ok'])
+        entry = self.wait_history(taskid)
+        self.assertGreaterEqual(time.monotonic() - start, 0.9)
+        self.assertEqual(entry.termsignal, '0')
+
+    def test060_socket_mode(self):
+        # Only our user may ask the supervisor to run commands
+        self.assertEqual(os.stat(self.socket).st_mode & 0o777, 0o600)
+
+    def test070_ignored_options(self):
+        # Options the supervisor does not support are reported, the task still runs
+        taskid = self.DB.reserve_task(taskname='Ignored')
+        lnc = Launch(db=self.db, taskid=taskid, supervisor=self.socket, compact_size=1000,
+                     sample_interval=1, spawn='posix_spawn', debug=True)
+        self.assertEqual(lnc._supervisor_ignored_options(), ['compact_size', 'sample_interval', 'spawn'])
+        self.assertTrue(lnc.execute(command="tests/sayhi.sh"))
+        self.assertIsNotNone(self.wait_history(taskid))
+        lnc = Launch(db=self.db, supervisor=self.socket, debug=True)
+        self.assertEqual(lnc._supervisor_ignored_options(), [])
+
+    def test080_caller_cwd_env(self):
+        # Supervisor process started elsewhere : relative command and feedpath
+        # resolved in the caller directory, task run with the caller environment
+        other = tempfile.mkdtemp()
+        work = tempfile.mkdtemp()
+        os.mkdir(os.path.join(work, 'feed'))
+        script = os.path.join(work, 'feeder.sh')
+        with open(script, 'w') as F:
+            F.write('#!/bin/sh\necho "[var]$TW_TEST_VAR" > "$2"\n')
+        os.chmod(script, stat.S_IRWXU)
+        socket = os.path.join(other, 'supervisor.sock')
+        supervisor = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'supervisor.py')
+        process = subprocess.Popen([sys.executable, supervisor, '--db', self.db, '--socket', socket,
+                                    '--tick', '0.2', '--feedback-interval', '0'], cwd=other)
+        end = time.monotonic() + 10
+        while not os.path.exists(socket) and time.monotonic() < end:
+            time.sleep(0.05)
+
+        taskid = self.DB.reserve_task(taskname='Elsewhere')
+        cwd = os.getcwd()
+        os.environ['TW_TEST_VAR'] = 'from the caller'
+        try:
+            os.chdir(work)
+            lnc = Launch(db=self.db, feedpath='feed', taskid=taskid, supervisor=socket, feedback_tail=100, debug=True)
+            self.assertTrue(lnc.execute(command="./feeder.sh --feedback feed/feedback_{}.log".format(taskid)))
+        finally:
+            os.chdir(cwd)
+            del os.environ['TW_TEST_VAR']
+        try:
+            entry = self.wait_history(taskid)
+            self.assertEqual(entry.termsignal, '0')
+            snapshot = self.DB.fetch_history(taskid=taskid, with_feedback=True, newest_first=True, limit=1)[0].feedback
+            self.assertIn('[var]from the caller', snapshot['tail'])
+        finally:
+            send_request(path=socket, request={ 'op' : 'shutdown' })
+            process.wait(timeout=10)
+
+if __name__ == '__main__':
+    unittest.main()
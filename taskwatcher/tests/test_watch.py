@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+'''
+Created on Oct 18, 2026
+
+@author: cgustave
+'''
+import logging as log
+import unittest
+import os
+import tempfile
+import threading
+import time
+
+from watch import Watch
+
+# create logger
+log.basicConfig(
+    format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-10.10s.\
+    %(funcName)-20.20s:%(lineno)5d] %(message)s',
+    datefmt='%Y%m%d:%H:%M:%S',
+    filename='debug.log',
+    level=log.DEBUG)
+
+log.debug("Start unittest")
+
+class WatchTestCase(unittest.TestCase):
+
+    # Always run before any test
+    def setUp(self):
+        self.file = os.path.join(tempfile.mkdtemp(), 'feedback_1.log')
+
+    def write_later(self, delay, line="[progress]1\n", count=1):
+        def writer():
+            time.sleep(delay)
+            with open(self.file, 'a') as F:
+                for i in range(count):
+                    F.write(line)
+                    F.flush()
+        thread = threading.Thread(target=writer)
+        thread.start()
+        return thread
+
+    def check_wait(self, watch):
+        # timeout without write
+        start = time.monotonic()
+        self.assertFalse(watch.wait(timeout=0.3))
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        # wakes up on a write (file created), not at the timeout
+        thread = self.write_later(0.2)
+        start = time.monotonic()
+        self.assertTrue(watch.wait(timeout=5))
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertIsNotNone(watch.lastwrite)
+        thread.join()
+
+    def test010_inotify(self):
+        with Watch(file=self.file, debug=True) as watch:
+            self.assertTrue(watch.inotify)
+            self.check_wait(watch)
+            # other files of the directory are ignored
+            while watch.wait(timeout=0.2):
+                pass
+            with open(os.path.join(os.path.dirname(self.file), 'other.log'), 'w') as F:
+                F.write("[progress]1\n")
+            self.assertFalse(watch.wait(timeout=0.2))
+
+    def test020_polling(self):
+        watch = Watch(file=self.file, poll_interval=0.1)
+        watch.close()
+        self.assertFalse(watch.inotify)
+        self.check_wait(watch)
+
+    def test030_debounce(self):
+        # a busy writer wakes the watcher at most once per min_interval
+        with Watch(file=self.file, min_interval=0.3) as watch:
+            thread = self.write_later(0, count=1)
+            thread.join()
+            self.assertTrue(watch.wait(timeout=1))
+            wakeups = watch.wakeups
+            start = time.monotonic()
+            thread = self.write_later(0, count=1000)
+            while watch.wait(timeout=0.5):
+                pass
+            thread.join()
+            elapsed = time.monotonic() - start
+            # a wake up for the debounce pause, one for the collected events
+            self.assertLessEqual(watch.wakeups - wakeups, 2 * (elapsed / 0.3 + 2))
+
+    def test040_ignore_write(self):
+        # the caller own rewrite (compaction) is not reported, the next write is
+        with open(self.file, 'w') as F:
+            F.write("[progress]1\n[progress]2\n")
+        polling = Watch(file=self.file, min_interval=0, poll_interval=0.1)
+        polling.close()
+        for watch in (Watch(file=self.file, min_interval=0), polling):
+            while watch.wait(timeout=0.2):
+                pass
+            with open(self.file, 'r+') as F:
+                F.write("[progress]2\n")
+                F.truncate()
+            watch.ignore_write()
+            self.assertFalse(watch.wait(timeout=0.3))
+            thread = self.write_later(0)
+            self.assertTrue(watch.wait(timeout=2))
+            thread.join()
+            watch.close()
+
+    def test050_sibling_no_wakeup(self):
+        # writes to the other files of the directory never wake the watcher up
+        sibling = os.path.join(os.path.dirname(self.file), 'feedback_2.log')
+        for file in (self.file, sibling):
+            with open(file, 'w') as F:
+                F.write("[progress]1\n")
+        with Watch(file=self.file, min_interval=0) as watch:
+            while watch.wait(timeout=0.2):
+                pass
+            stop = threading.Event()
+            def writer():
+                with open(sibling, 'a') as F:
+                    while not stop.is_set():
+                        F.write("[progress]1\n")
+                        F.flush()
+                        time.sleep(0.01)
+            thread = threading.Thread(target=writer)
+            thread.start()
+            wakeups = watch.wakeups
+            self.assertFalse(watch.wait(timeout=0.5))
+            stop.set()
+            thread.join()
+            self.assertEqual(watch.wakeups - wakeups, 1)
+            # a file replaced (renamed over) is still watched
+            os.rename(sibling, self.file)
+            self.assertTrue(watch.wait(timeout=2))
+            thread = self.write_later(0.1)
+            self.assertTrue(watch.wait(timeout=2))
+            thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
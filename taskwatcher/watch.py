@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18th, 2026
+@author: cgustave
+
+Feedback file watcher from the taskwatcher suite
+"""
+
+import logging as log
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# inotify constants (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Writes are watched on the file itself, its directory only tells when the
+# file is created or replaced (other files of the directory never wake us)
+IN_FILE_EVENTS = IN_MODIFY | IN_CLOSE_WRITE
+IN_DIRECTORY_EVENTS = IN_CREATE | IN_MOVED_TO
+
+# struct inotify_event header : wd, mask, cookie, len (followed by name)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Watch(object):
+    """
+    Feedback file watcher from the taskwatcher suite
+    Called with file : the feedback file (may not exist yet)
+    Optional : min_interval (debounce seconds), poll_interval (fallback)
+    On Linux, writes are notified by inotify on the file (and its creation
+    or replacement on its directory) so wait() only wakes up on a write or
+    on its timeout. Elsewhere (or if inotify can't be used) the file
+    modification time and size are polled.
+    wakeups counts the returns from select/sleep (each time the process
+    was woken up).
+    """
+    def __init__(self, file='', min_interval=0.5, poll_interval=1, debug=False):
+
+        # create logger
+        log.basicConfig(
+            format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-\
+            10.10s.%(funcName)-20.20s:%(lineno)5d] %(message)s',
+            datefmt='%Y%m%d:%H:%M:%S',
+            filename='debug.log',
+            level=log.NOTSET)
+
+        # Set debug level first
+        if debug:
+            self.debug = True
+            log.basicConfig(level='DEBUG')
+        else:
+            self.debug = False
+            log.basicConfig(level='ERROR')
+
+        log.info("Constructor with file={} min_interval={} poll_interval={} debug={}".
+                 format(file, min_interval, poll_interval, debug))
+
+        if not file:
+            log.error("file is required")
+            raise SystemExit
+
+        # Public attributs
+        self.file = file
+        self.min_interval = float(min_interval)
+        self.poll_interval = float(poll_interval)
+        self.lastwrite = None
+        self.wakeups = 0
+
+        # Private attributs
+        self._name = os.fsencode(os.path.basename(file))
+        self._fd = None
+        self._libc = None
+        self._file_wd = None
+        self._last_event = None
+        self._signature = file_signature(self.file)
+        self._ignored = None
+        self._open_inotify()
+
+
+    @property
+    def inotify(self):
+        """
+        True if writes are notified by inotify (False : polling)
+        """
+        return self._fd is not None
+
+
+    def _open_inotify(self):
+        """
+        Sets up the inotify watches (via libc with ctypes) : creation and
+        replacement on the file directory, writes on the file if it exists
+        Keeps the polling fallback if not available
+        """
+        log.info("Enter")
+
+        if not sys.platform.startswith('linux'):
+            log.debug("no inotify on platform={}, polling".format(sys.platform))
+            return
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            directory = os.fsencode(os.path.dirname(os.path.abspath(self.file)))
+            if libc.inotify_add_watch(fd, directory, IN_DIRECTORY_EVENTS) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, "inotify_add_watch failed")
+
+        except (OSError, AttributeError) as e:
+            log.warning("inotify not available, polling file={} error={}".format(self.file, e))
+            return
+
+        self._fd = fd
+        self._libc = libc
+        self._watch_file()
+        log.debug("inotify fd={} on file={}".format(fd, self.file))
+
+
+    def _watch_file(self):
+        """
+        Adds the inotify watch on the writes of the file (current inode),
+        the watch of a replaced file is removed
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(os.path.abspath(self.file)), IN_FILE_EVENTS)
+        if wd < 0:
+            # not created yet, or removed meanwhile : the directory watch tells
+            log.debug("no watch on file={} errno={}".format(self.file, ctypes.get_errno()))
+            return
+        if self._file_wd is not None and self._file_wd != wd:
+            self._libc.inotify_rm_watch(self._fd, self._file_wd)
+        self._file_wd = wd
+
+
+    def ignore_write(self):
+        """
+        Ignores the writes done so far by the caller itself (feedback file
+        compaction) : they are not reported while the file keeps its current
+        modification time and size
+        """
+        log.info("Enter")
+        self._ignored = file_signature(self.file)
+        self._signature = self._ignored
+
+
+    def close(self):
+        """
+        Releases the inotify file descriptor
+        """
+        log.info("Enter")
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._file_wd = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def wait(self, timeout=0, wakeup=()):
+        """
+        Blocks until the file is written or for timeout seconds
+        Writes following the previous one within min_interval are collected
+        together after min_interval (debounce : a busy writer wakes the
+        caller at most once per min_interval)
+        wakeup : other file descriptors ending the wait when readable
+        Returns True if the file was written, lastwrite is then the
+        time.monotonic() of the wake up
+        """
+        end = time.monotonic() + max(0, timeout)
+        wakeup = list(wakeup)
+
+        written = False
+        quiet = 0
+        if self._last_event is not None:
+            quiet = self._last_event + self.min_interval - time.monotonic()
+        if quiet <= 0 or not self._pause(min(quiet, max(0, timeout)), wakeup):
+            if self._fd is not None:
+                written = self._wait_inotify(end, wakeup)
+            else:
+                written = self._wait_poll(end, wakeup)
+
+        if written:
+            self._last_event = time.monotonic()
+            self.lastwrite = self._last_event
+        return written
+
+
+    def _pause(self, delay, wakeup):
+        """
+        Sleeps for delay seconds, unless one of the wakeup file descriptors
+        becomes readable. Returns True if woken up
+        """
+        if not wakeup:
+            time.sleep(delay)
+            self.wakeups = self.wakeups + 1
+            return False
+        (ready, _, _) = select.select(wakeup, [], [], delay)
+        self.wakeups = self.wakeups + 1
+        return bool(ready)
+
+
+    def _wait_inotify(self, end, wakeup):
+        """
+        Waits for inotify events on the file until monotonic time end
+        Returns True if the file was written
+        """
+        while True:
+            remaining = max(0, end - time.monotonic())
+            (ready, _, _) = select.select([self._fd] + wakeup, [], [], remaining)
+            self.wakeups = self.wakeups + 1
+            if not ready:
+                return False
+            if self._fd in ready and self._read_events():
+                return True
+            if self._fd not in ready:
+                return False
+
+
+    def _read_events(self):
+        """
+        Reads all the pending inotify events
+        Returns True if one of them is about the file : a write, or the file
+        created or replaced (then watched from now on)
+        """
+        written = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+                offset = offset + EVENT_HEADER.size
+                name = data[offset:offset+length].rstrip(b'\0')
+                offset = offset + length
+                if wd == self._file_wd:
+                    if mask & IN_IGNORED:
+                        self._file_wd = None
+                    else:
+                        written = True
+                elif name == self._name:
+                    self._watch_file()
+                    written = True
+
+        if written and self._ignored is not None:
+            if file_signature(self.file) == self._ignored:
+                log.debug("own write ignored file={}".format(self.file))
+                return False
+            self._ignored = None
+
+        return written
+
+
+    def _wait_poll(self, end, wakeup):
+        """
+        Polls the file modification time and size every poll_interval until
+        monotonic time end
+        Returns True if the file was written
+        """
+        while True:
+            signature = file_signature(self.file)
+            if signature != self._signature:
+                self._signature = signature
+                return True
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self._pause(min(self.poll_interval, remaining), wakeup):
+                return False
+
+
+
+def file_signature(file=''):
+    """
+    Returns (mtime_ns, size) of the file, None if it does not exist
+    """
+    try:
+        stat = os.stat(file)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+
+
+if __name__ == '__main__': #pragma: no cover
+
+    argparser = argparse.ArgumentParser(description='Feedback file watcher')
+    argparser.add_argument('--debug', '-d', help="turn on debug", action="store_true")
+    argparser.add_argument('--file', metavar='filename', help="feedback file to watch", required=True)
+    argparser.add_argument('--timeout', help="seconds without write before giving up (default 30)", default=30)
+    argparser.add_argument('--poll', help="force the polling fallback", action="store_true")
+
+    args = argparser.parse_args()
+
+    watch = Watch(file=args.file, debug=args.debug)
+    if args.poll:
+        watch.close()
+    print("watching {} with {}".format(args.file, 'inotify' if watch.inotify else 'polling'))
+    while watch.wait(timeout=float(args.timeout)):
+        print("written at {:.3f}".format(watch.lastwrite))
+    print("no write for {} seconds".format(args.timeout))
+    watch.close()